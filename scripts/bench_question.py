@@ -0,0 +1,125 @@
+"""
+Benchmark of prompt assembly on a 50-example TaskSpec.
+
+Compares the rope-backed Question against flat-list concatenation (the
+previous storage, where every append copied the whole element list). Reports
+the time per assembly, and the bytes allocated over an assembly: the sum, over
+its appends, of what each append allocated at its peak (traced by
+tracemalloc). Flat appends copy the whole prompt each time, so what they
+allocate grows quadratically with the number of examples; rope appends
+allocate a node each.
+
+Usage (from anywhere, the repository is added to sys.path):
+    python scripts/bench_question.py [--examples 50] [--repeats 20]
+"""
+
+import os
+import sys
+import argparse
+import time
+import tracemalloc
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tasksolver.common import Question, TaskSpec
+from tasksolver.answer_types import TextAnswer
+
+
+def flat_append(question:Question, other:Question) -> Question:
+    # previous behaviour of `append_question`: copy both element lists.
+    return Question(question.eval() + other.eval())
+
+
+def build_task(num_examples:int) -> TaskSpec:
+    task = TaskSpec(name="benchmark",
+                    description="Answer the question about the image.",
+                    answer_type=TextAnswer,
+                    followup_func=None,
+                    completed_func=None)
+    task.add_background(Question(["Some background information."]))
+    for idx in range(num_examples):
+        image = Image.new("RGB", (64, 64), color=(idx, idx, idx))
+        task.add_example(Question([f"Example question {idx}", image]),
+                         TextAnswer(f"Example answer {idx}"),
+                         explanation=f"Reasoning for example {idx}")
+    return task
+
+
+def parts(task:TaskSpec, question:Question):
+    # the questions appended, in order, to assemble the prompt.
+    for ex_idx, ex_dict in enumerate(task.examples):
+        yield Question([(f"(Ex #{ex_idx}) Question:", f"EXAMPLE_{ex_idx}")])
+        yield Question([(ex_dict["question"], f"EXAMPLE_{ex_idx}")])
+        yield Question([(str(ex_dict["answer"]), f"EXAMPLE_{ex_idx}")])
+    yield question
+
+
+def run(func):
+    return func()
+
+
+def assemble_flat(task:TaskSpec, question:Question, step=run) -> int:
+    prompt = Question([])
+    for part in parts(task, question):
+        prompt = step(lambda: flat_append(prompt, part))
+    return step(lambda: len(prompt.question_components))
+
+
+def assemble_rope(task:TaskSpec, question:Question, step=run) -> int:
+    prompt = Question([])
+    for part in parts(task, question):
+        step(lambda: prompt.append_question(part))
+    # the rope is only flattened once, when its elements are read.
+    return step(lambda: len(prompt.question_components))
+
+
+def first_question(task:TaskSpec, question:Question, step=run) -> int:
+    return step(lambda: len(task.first_question(question).question_components))
+
+
+class AllocationCounter(object):
+    """ Sums the bytes allocated by a sequence of steps, each at its peak.
+    """
+    def __init__(self):
+        self.allocated = 0
+
+    def __call__(self, func):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+        self.allocated += peak - before
+        return result
+
+
+def measure(name:str, func, repeats:int, *args):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func(*args)
+    elapsed = time.perf_counter() - start
+
+    counter = AllocationCounter()
+    tracemalloc.start()
+    func(*args, step=counter)
+    tracemalloc.stop()
+    print(f"{name:<28} {1000 * elapsed / repeats:9.3f} ms/iter   allocated {counter.allocated / 1024:9.1f} KiB/iter")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--examples", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    task = build_task(args.examples)
+    question = Question(["What is in this image?", Image.new("RGB", (64, 64))])
+    assert assemble_flat(task, question) == assemble_rope(task, question)
+
+    print(f"{args.examples} examples, {args.repeats} repeats")
+    measure("append (flat list copies)", assemble_flat, args.repeats, task, question)
+    measure("append (rope)", assemble_rope, args.repeats, task, question)
+    measure("TaskSpec.first_question", first_question, args.repeats, task, question)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,5 +16,10 @@ setup(
         "ollama",
         "anthropic",
         "google-generativeai"
-    ]
+    ],
+    entry_points={
+        "console_scripts": [
+            "tasksolver-run=tasksolver.runner:main",
+        ]
+    }
 )
@@ -11,50 +11,76 @@ from abc import abstractmethod
 from typing import Union, Dict
 from bson import ObjectId
 from .event import *
-from .keychain import KeyChain
+from .keychain import KeyChain, KeyPool
 import time
 
 import pickle
 
+def make_model(api_key:Union[str, KeyPool, KeyChain, None], task:TaskSpec,
+               vision_model:str="gpt-4-vision-preview"):
+    """ Creates the model named `vision_model`.
+
+    Args:
+        api_key: openAI/Claude/Gemini api key (or pool of keys), or a KeyChain.
+            Unused by Ollama models.
+        task: Task specification for the model
+        vision_model: string identifier to the vision model used.
+    """
+    if vision_model in ('gpt-4-vision-preview', 'gpt-4', 'gpt-4-turbo', 'gpt-4o-mini',  "o1-preview", "o1-mini"):
+        # using the open ai key.
+        logger.info(f"creating GPT-based agent of type: {vision_model}")
+        if isinstance(api_key, KeyChain):
+            api_key = api_key.get_pool("openai") # requests are spread over its keys
+        return GPTModel(api_key, task, model=vision_model)
+    elif vision_model == 'claude':
+        # using the claude key.
+        logger.info(f"creating GPT-based agent of type: {vision_model}")
+        if isinstance(api_key, KeyChain):
+            api_key = api_key.get_pool("claude")
+        return ClaudeModel(api_key, task)
+    elif vision_model in ('gemini-pro' , 'gemini-pro-vision'):
+        # using the gemini key.
+        logger.info(f"creating Gemini-based agent of type: {vision_model}")
+        
+        if isinstance(api_key, KeyChain):
+            api_key = api_key.get_pool("gemini")
+
+        return GeminiModel(api_key=api_key, task=task, model=vision_model)
+    else:
+        logger.info(f"creating Ollama-based agent of type: {vision_model}")
+        return OllamaModel(task, vision_model)
+
+
 class Agent(object):
-    def __init__(self, api_key:Union[str, KeyChain], task:TaskSpec,
+    def __init__(self, api_key:Union[str, KeyPool, KeyChain], task:TaskSpec,
                  vision_model:str="gpt-4-vision-preview",
                  followup_func=None,
-                 session_token=None): 
+                 session_token=None,
+                 warmup:bool=False,
+                 visual_interface=None): 
         """
         Args:
-            api_key: openAI/Claude api key
+            api_key: openAI/Claude/Gemini api key (or pool of keys), or a KeyChain
             task: Task specification for this agent
             vision_model: string identifier to the vision model used.
+            warmup: if True, connects to the model's API right away, so that
+                the first question doesn't pay for connection setup.
+            visual_interface: if not None, a model (or ModelRouter) to use instead
+                of the one named by `vision_model`.
         """
         self.followup_func = followup_func 
         self.api_key = api_key # if this is a string, then 
         self.vision_model = vision_model
         self.task = task
         
-        if vision_model in ('gpt-4-vision-preview', 'gpt-4', 'gpt-4-turbo', 'gpt-4o-mini',  "o1-preview", "o1-mini"):
-            # using the open ai key.
-            logger.info(f"creating GPT-based agent of type: {vision_model}")
-            if isinstance(api_key, KeyChain):
-                api_key = api_key["openai"]
-            self.visual_interface = GPTModel(api_key, task, model=vision_model)
-        elif vision_model == 'claude':
-            # using the claude key.
-            logger.info(f"creating GPT-based agent of type: {vision_model}")
-            if isinstance(api_key, KeyChain):
-                api_key = api_key["claude"]
-            self.visual_interface = ClaudeModel(api_key, task)
-        elif vision_model in ('gemini-pro' , 'gemini-pro-vision'):
-            # using the gemini key.
-            logger.info(f"creating Gemini-based agent of type: {vision_model}")
-            
-            # DEBUG
-            logger.info(f"api:{api_key}, task:{type(task)}, model:{vision_model}")
-            
-            self.visual_interface = GeminiModel(api_key=api_key, task=task, model=vision_model)
+        if visual_interface is not None:
+            logger.info(f"creating agent with a given visual interface: {type(visual_interface).__name__}")
+            self.visual_interface = visual_interface
         else:
-            logger.info(f"creating Ollama-based agent of type: {vision_model}")
-            self.visual_interface = OllamaModel(task, vision_model)
+            self.visual_interface = make_model(api_key, task, vision_model)
+
+        if warmup:
+            self.visual_interface.warmup()
          
         # TODO: loadable session from before?
         if session_token is None:
@@ -101,6 +127,23 @@ class Agent(object):
     
         # update events_collection
         return p_ans, ans, meta, p 
+
+    async def athink(self, question:Question) -> ParsedAnswer:
+        """ Same as `think`, without blocking the event loop, so that many
+        agents can think concurrently.
+
+        Example usage:
+            results = await asyncio.gather(*[agent.athink(q) for agent, q in zip(agents, questions)])
+        """
+        if len(self.event_buffer.filter_to('ACT')) == 0: 
+            p_ans, ans, meta, p = await self.visual_interface.arun_once(question)
+        else:
+            p_ans, ans, meta, p = await self.visual_interface.arough_guess(question)
+
+        ev = ThinkEvent(session_token=self.session_token, 
+                        qa_sequence=[(question, p_ans)]) 
+        self.event_buffer.add_event(ev)
+        return p_ans, ans, meta, p 
         
 
     @abstractmethod 
@@ -0,0 +1,82 @@
+"""
+asyncio counterparts of the model methods.
+
+Each model implements `aask` on top of its provider's async client (or, by
+default, runs its blocking `ask` in an executor). The methods built on top of
+it (`arough_guess`, `amany_rough_guesses`, `arun_once`) are shared here, so
+that one event loop can drive many agent sessions at once.
+"""
+
+import asyncio
+import functools
+from typing import List, Tuple, Union
+from .common import Question, ParsedAnswer
+
+
+class AsyncModelMixin(object):
+    """ Async methods of `BaseModel`, shared by GPTModel, ClaudeModel, GeminiModel and OllamaModel.
+
+    Example usage:
+        model = GPTModel(api_key, task)
+        p_ans, ans, meta, p = await model.arun_once(question)
+    """
+
+    async def aask(self, payload:dict, n_choices=1) -> Tuple[List[dict], List[dict]]:
+        """ Same as `ask`. Models without an async client run `ask` in an executor.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.ask, payload, n_choices=n_choices))
+
+    async def _aask(self, payload:dict, n_choices=1, stream:bool=False):
+        if stream:
+            # streams are read (and cancelled) by the blocking `ask`.
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, functools.partial(
+                self.ask, payload, n_choices=n_choices, stream=True))
+        return await self.aask(payload, n_choices=n_choices)
+
+    async def aprepare_payload(self, question:Question, max_tokens=1000, verbose=False) -> dict:
+        """ `prepare_payload` reads, encodes and downloads images, so it runs in
+        an executor to keep the event loop free.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(
+            self.payload, question, max_tokens=max_tokens, verbose=verbose))
+
+    async def arough_guess(self, question:Question, max_tokens=1000, verbose=False,
+                           max_tries=10, query_id:int=0, stream:bool=False,
+                           max_wait:Union[float, None]=None, **kwargs) -> Tuple[ParsedAnswer, str, dict, dict]:
+        """ Same as `rough_guess`.
+        """
+        p = await self.aprepare_payload(question, max_tokens=max_tokens, verbose=verbose)
+
+        async def attempt():
+            response, meta_data = await self._aask(p, stream=stream)
+            response = response[0]
+            parsed_response = self.parse(response["content"])
+            return parsed_response, response, meta_data, p
+
+        return await self.retry_policy.acall(attempt, max_parse_retries=max_tries, max_wait=max_wait)
+
+    async def amany_rough_guesses(self, num_threads:int,
+                                  question:Question, max_tokens=1000,
+                                  verbose=False, max_tries=10,
+                                  stream:bool=False, max_wait:Union[float, None]=None,
+                                  **kwargs) -> List[Tuple[ParsedAnswer, str, dict, dict]]:
+        """ Same as `many_rough_guesses`. `num_threads` is the number of
+        independent answers; no threads are started.
+        """
+        p = await self.aprepare_payload(question, max_tokens=max_tokens, verbose=verbose)
+
+        async def attempt():
+            response, meta_data = await self._aask(p, n_choices=num_threads, stream=stream)
+            parsed_response = [self.parse(r["content"]) for r in response]
+            return parsed_response, response, meta_data, p
+
+        return await self.retry_policy.acall(attempt, max_parse_retries=max_tries, max_wait=max_wait)
+
+    async def arun_once(self, question:Question, max_tokens=1000, **kwargs):
+        """ Same as `run_once`.
+        """
+        q = self.task.first_question(question)
+        return await self.arough_guess(q, max_tokens=max_tokens, **kwargs)
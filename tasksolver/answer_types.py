@@ -56,6 +56,15 @@ class LeftOrRight(ParsedAnswer):
         left_or_right = LeftOrRight.remove_answer_text(gpt_raw)
         return LeftOrRight(left_or_right, gpt_raw=gpt_raw) 
 
+    @staticmethod
+    def decided_prefix(partial:str):
+        # the format is a single text block: decided once the first block is
+        # closed, if it holds "left" or "right". Otherwise the whole response is read.
+        match = re.search(r'```\s*([^`]+)```', partial)
+        if match is None or match.group(1).lower().strip() not in ('left', 'right'):
+            return None
+        return match.end()
+
     def __str__(self):
         return self.data
 
@@ -186,6 +195,16 @@ class PythonExecutableAnswer(ParsedAnswer):
         code_string = PythonExecutableAnswer.remove_markdown_code(gpt_raw)     
         return PythonExecutableAnswer(code=code_string, gpt_raw=gpt_raw)
 
+    @staticmethod
+    def decided_prefix(partial:str):
+        # the format is a single code block: decided at the ``` closing the
+        # first ```python block, where a response following it has its last block.
+        start = partial.find("```python")
+        if start < 0:
+            return None
+        end = partial.find("```", start + len("```python"))
+        return None if end < 0 else end + len("```")
+
     def __str__(self):
         return str(self.code)
 
@@ -255,6 +274,17 @@ class YesNoWhy(ParsedAnswer):
                 gpt_raw=gpt_raw
         )
 
+    @staticmethod
+    def decided_prefix(partial:str):
+        # the format ends with the yes/no after [#finalanswer]: decided once a
+        # complete "yes" or "no" word (followed by a non-word character) is there.
+        reason = partial.find("[#reason]")
+        final = partial.find("[#finalanswer]")
+        if reason < 0 or final < reason:
+            return None
+        match = re.compile(r'\W*(yes|no)\W', re.IGNORECASE).match(partial, final + len("[#finalanswer]"))
+        return None if match is None else match.end()
+
     def success(self):
         return self.final_answer== "yes"
 
@@ -0,0 +1,327 @@
+"""
+Offline batch mode.
+
+Bulk evaluations don't need their answers right away. `run_batch` compiles
+the first questions of many Questions into provider batch jobs (OpenAI Batch
+API, Anthropic Message Batches), which are billed at about half price and
+scheduled by the provider, polls them until they end, and parses the answers.
+Items that failed or could not be parsed are resubmitted in a new job, up to
+`max_rounds` times. LocalBatchProvider is a file-based stand-in provider, to
+run batches offline.
+"""
+
+import io
+import os
+import json
+import time
+from abc import ABC, abstractmethod
+from typing import List, Tuple, Dict, Union, Callable
+from loguru import logger
+from bson import ObjectId
+from .common import Question, ParsedAnswer
+from .payload import materialize
+from .clients import registry
+from .concurrency import fan_out
+from .keychain import all_keys
+from .exceptions import GPTOutputParseException
+
+IN_PROGRESS = "in_progress"
+ENDED = "ended"
+
+
+class BatchProvider(ABC):
+    """ A service running batches of requests.
+
+    `results` maps the custom id of each request to either
+        {"message": {"role": "assistant", "content": ...}, "metadata": {...}}
+    or {"error": ...}. Requests missing from it failed too.
+    """
+    max_requests:int = 50000 # per batch
+
+    @abstractmethod
+    def submit(self, requests:List[Tuple[str, dict]]) -> str:
+        """ Starts a batch of (custom id, payload) requests, and returns its id.
+        """
+        ...
+
+    @abstractmethod
+    def status(self, batch_id:str) -> str:
+        """ IN_PROGRESS or ENDED.
+        """
+        ...
+
+    @abstractmethod
+    def results(self, batch_id:str) -> Dict[str, dict]:
+        ...
+
+
+class OpenAIBatchProvider(BatchProvider):
+    """ OpenAI's Batch API, for the payloads of a GPTModel.
+    """
+    max_requests:int = 50000
+
+    def __init__(self, model, completion_window:str="24h"):
+        """
+        Args:
+            model: the GPTModel whose payloads are submitted. Batches are
+                files of an account, so they all use the model's first key.
+        """
+        self.model = model
+        self.completion_window = completion_window
+        self.api_key = all_keys(model.open_ai_key)[0]
+
+    def client(self):
+        return registry.get("openai", self.api_key, base_url=self.model.base_url)
+
+    def submit(self, requests:List[Tuple[str, dict]]) -> str:
+        lines = io.BytesIO()
+        for custom_id, payload in requests:
+            body = self.model.request_kwargs(payload)
+            extra_body = body.pop("extra_body") or {}
+            body.update(extra_body)
+            lines.write(json.dumps({"custom_id": custom_id,
+                                    "method": "POST",
+                                    "url": "/v1/chat/completions",
+                                    "body": body}).encode("utf-8") + b"\n")
+        client = self.client()
+        input_file = client.files.create(file=("batch.jsonl", lines.getvalue()), purpose="batch")
+        batch = client.batches.create(input_file_id=input_file.id,
+                                      endpoint="/v1/chat/completions",
+                                      completion_window=self.completion_window)
+        return batch.id
+
+    def status(self, batch_id:str) -> str:
+        batch = self.client().batches.retrieve(batch_id)
+        if batch.status in ("completed", "failed", "expired", "cancelled"):
+            return ENDED
+        return IN_PROGRESS
+
+    def results(self, batch_id:str) -> Dict[str, dict]:
+        client = self.client()
+        batch = client.batches.retrieve(batch_id)
+        results = {}
+        for file_id in (batch.error_file_id, batch.output_file_id):
+            if file_id is None:
+                continue
+            for line in client.files.content(file_id).text.splitlines():
+                if line.strip() == "":
+                    continue
+                line = json.loads(line)
+                response = line.get("response") or {}
+                if line.get("error") is not None or response.get("status_code") != 200:
+                    results[line["custom_id"]] = {"error": line.get("error") or response.get("body")}
+                    continue
+                body = response["body"]
+                results[line["custom_id"]] = {"message": body["choices"][0]["message"],
+                                              "metadata": body["usage"]}
+        return results
+
+
+class AnthropicBatchProvider(BatchProvider):
+    """ Anthropic's Message Batches API, for the payloads of a ClaudeModel.
+    """
+    max_requests:int = 100000
+
+    def __init__(self, model):
+        """
+        Args:
+            model: the ClaudeModel whose payloads are submitted. Batches belong
+                to an account, so they all use the model's first key.
+        """
+        self.model = model
+        self.api_key = all_keys(model.claude_key)[0]
+
+    def client(self):
+        return registry.get("claude", self.api_key, base_url=self.model.base_url)
+
+    def submit(self, requests:List[Tuple[str, dict]]) -> str:
+        batch = self.client().messages.batches.create(
+            requests=[{"custom_id": custom_id, "params": self.model.request_kwargs(payload)}
+                      for custom_id, payload in requests])
+        return batch.id
+
+    def status(self, batch_id:str) -> str:
+        batch = self.client().messages.batches.retrieve(batch_id)
+        return ENDED if batch.processing_status == "ended" else IN_PROGRESS
+
+    def results(self, batch_id:str) -> Dict[str, dict]:
+        results = {}
+        for entry in self.client().messages.batches.results(batch_id):
+            if entry.result.type == "succeeded":
+                results[entry.custom_id] = self.model.parse_response(entry.result.message)
+            else:
+                results[entry.custom_id] = {"error": entry.result.type}
+        return results
+
+
+class LocalBatchProvider(BatchProvider):
+    """ Batches as files in a directory, for running offline.
+
+    Each batch is a folder holding `requests.jsonl` (one {"custom_id", "body"}
+    line per request, with the materialized payload as body). The batch ends
+    once `results.jsonl` exists, with one {"custom_id", "content"} or
+    {"custom_id", "error"} line per request. It is written by `respond` if
+    given, or else by anything else, e.g. another process.
+
+    Example usage:
+        provider = LocalBatchProvider("batches/", respond=lambda body: "```left```")
+        answers = run_batch(model, questions, provider=provider, poll_interval=0)
+    """
+    max_requests:int = 50000
+
+    def __init__(self, directory:str, respond:Union[Callable[[dict], str], None]=None):
+        """
+        Args:
+            directory: where batches are stored.
+            respond: if not None, answers the body of a request with the text of
+                the response. It is run on every request of a batch the first time
+                its status is polled.
+        """
+        self.directory = directory
+        self.respond = respond
+
+    def _path(self, batch_id:str, name:str) -> str:
+        return os.path.join(self.directory, batch_id, name)
+
+    def submit(self, requests:List[Tuple[str, dict]]) -> str:
+        batch_id = str(ObjectId())
+        os.makedirs(os.path.join(self.directory, batch_id))
+        with open(self._path(batch_id, "requests.jsonl"), "w") as f:
+            for custom_id, payload in requests:
+                f.write(json.dumps({"custom_id": custom_id, "body": materialize(payload)}) + "\n")
+        return batch_id
+
+    def status(self, batch_id:str) -> str:
+        if os.path.exists(self._path(batch_id, "results.jsonl")):
+            return ENDED
+        if self.respond is None:
+            return IN_PROGRESS
+
+        lines = []
+        with open(self._path(batch_id, "requests.jsonl"), "r") as f:
+            for line in f:
+                request = json.loads(line)
+                try:
+                    lines.append({"custom_id": request["custom_id"], "content": self.respond(request["body"])})
+                except Exception as e:
+                    lines.append({"custom_id": request["custom_id"], "error": f"{type(e).__name__}: {e}"})
+        tmp = self._path(batch_id, "results.jsonl.tmp")
+        with open(tmp, "w") as f:
+            for line in lines:
+                f.write(json.dumps(line) + "\n")
+        os.replace(tmp, self._path(batch_id, "results.jsonl")) # the batch only ends once complete
+        return ENDED
+
+    def results(self, batch_id:str) -> Dict[str, dict]:
+        results = {}
+        with open(self._path(batch_id, "results.jsonl"), "r") as f:
+            for line in f:
+                if line.strip() == "":
+                    continue
+                line = json.loads(line)
+                if "error" in line:
+                    results[line["custom_id"]] = {"error": line["error"]}
+                else:
+                    results[line["custom_id"]] = {"message": {"role": "assistant", "content": line["content"]},
+                                                  "metadata": {"batch": True}}
+        return results
+
+
+def default_provider(model) -> BatchProvider:
+    """ The batch API of `model`'s provider.
+    """
+    from .gpt4v import GPTModel
+    from .claude import ClaudeModel
+    if isinstance(model, GPTModel):
+        return OpenAIBatchProvider(model)
+    if isinstance(model, ClaudeModel):
+        return AnthropicBatchProvider(model)
+    raise ValueError(f"No batch API for {type(model).__name__}, pass a provider.")
+
+
+def wait_for_batch(provider:BatchProvider, batch_id:str, poll_interval:float=60.0,
+                   deadline:Union[float, None]=None):
+    """ Polls `batch_id` until it ends. Raises TimeoutError once `deadline`
+    (a `time.time()` timestamp) passes; the batch keeps running on the provider.
+    """
+    while provider.status(batch_id) != ENDED:
+        if deadline is not None and time.time() + poll_interval > deadline:
+            raise TimeoutError(f"batch {batch_id} is still running.")
+        time.sleep(poll_interval)
+
+
+def run_batch(model, questions:List[Question],
+              provider:Union[BatchProvider, None]=None,
+              max_tokens:int=1000,
+              max_rounds:int=3,
+              poll_interval:float=60.0,
+              timeout:Union[float, None]=None,
+              ) -> List[Union[Tuple[ParsedAnswer, dict, dict, dict], None]]:
+    """ Same as calling `model.run_once` on every question, through batch jobs.
+
+    Example usage:
+        model = GPTModel(api_key, task, model="gpt-4o-mini")
+        answers = run_batch(model, questions)
+        for p_ans, ans, meta, p in filter(None, answers):
+            ...
+
+    Args:
+        model: the model whose task, payload format and settings are used.
+        questions: questions, as passed to `run_once`.
+        provider: where batches are run. Defaults to the batch API of `model`'s provider.
+        max_rounds: number of batches an item is submitted in, before giving up on it.
+        poll_interval: seconds between status checks.
+        timeout: if not None, seconds after which TimeoutError is raised.
+    Returns:
+        for each question, a tuple like the one returned by `run_once`, or None
+        if it still failed after `max_rounds` rounds.
+    """
+    if len(questions) == 0:
+        return []
+    if provider is None:
+        provider = default_provider(model)
+    deadline = None if timeout is None else time.time() + timeout
+
+    def prepare(idx):
+        return model.payload(model.task.first_question(questions[idx]), max_tokens=max_tokens)
+
+    payloads = fan_out(prepare, len(questions))
+    custom_ids = [f"item-{idx}" for idx in range(len(questions))]
+    index = {custom_id: idx for idx, custom_id in enumerate(custom_ids)}
+    answers:List[Union[Tuple[ParsedAnswer, dict, dict, dict], None]] = [None] * len(questions)
+
+    pending = custom_ids
+    for round_idx in range(max_rounds):
+        if len(pending) == 0:
+            break
+        batch_ids = []
+        for start in range(0, len(pending), provider.max_requests):
+            chunk = pending[start:start + provider.max_requests]
+            batch_ids.append(provider.submit([(custom_id, payloads[index[custom_id]]) for custom_id in chunk]))
+        logger.info(f"round {round_idx}: submitted {len(pending)} requests in batches {batch_ids}")
+
+        outputs = {}
+        for batch_id in batch_ids:
+            wait_for_batch(provider, batch_id, poll_interval=poll_interval, deadline=deadline)
+            outputs.update(provider.results(batch_id))
+
+        failed = []
+        for custom_id in pending:
+            output = outputs.get(custom_id)
+            if output is None or "error" in output:
+                failed.append(custom_id)
+                continue
+            try:
+                p_ans = model.task.answer_type.parser(output["message"]["content"])
+            except GPTOutputParseException:
+                failed.append(custom_id)
+                continue
+            idx = index[custom_id]
+            answers[idx] = (p_ans, output["message"], output["metadata"], payloads[idx])
+        if len(failed) > 0:
+            logger.warning(f"round {round_idx}: {len(failed)} of {len(pending)} requests failed or were not parseable.")
+        pending = failed
+
+    if len(pending) > 0:
+        logger.error(f"{len(pending)} requests still failed after {max_rounds} rounds.")
+    return answers
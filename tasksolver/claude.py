@@ -1,68 +1,153 @@
-import anthropic
 from .common import TaskSpec, ParsedAnswer, Question
-from .exceptions import GPTOutputParseException, GPTMaxTriesExceededException
-import threading
+from .image_policy import ImagePolicy
+from .payload import LazyImage, materialize
+from .prompt_cache import cache_breakpoints
+from .clients import registry
+from .model import BaseModel
+from .concurrency import fan_out
+from .streaming import read_stream
+from .response_cache import cached_ask, cached_aask
+from .singleflight import coalesced_ask, coalesced_aask
+from .hedging import hedged, ahedged
+from .ratelimit import bucket_key, estimate_tokens
+from .keychain import KeyPool, lease_key, all_keys
+import asyncio
 from typing import List, Tuple, Union
-from loguru import logger
-from copy import deepcopy
-import time
-import os
 
-class ClaudeModel(object):
-    def __init__(self, api_key:str,
+class ClaudeModel(BaseModel):
+    save_unparseable = True
+
+    def __init__(self, api_key:Union[str, KeyPool],
                  task:TaskSpec,
-                 model:str = "claude-3-haiku-20240307"):
+                 model:str = "claude-3-haiku-20240307",
+                 prompt_cache:bool=False,
+                 base_url:Union[str, None]=None,
+                 **options):
+        """
+        Args:
+            api_key: an Anthropic key, or a pool of keys to spread requests over.
+            prompt_cache: if True, the static TaskSpec sections (task description,
+                background, examples) are marked as cacheable by the API.
+            base_url: if not None, the API endpoint to use instead of Anthropic's.
+            options: request settings (image_policy, retry_policy, hedging, ...), see `BaseModel`.
+        """
+        super().__init__(task, model, **options)
+        self.claude_key:Union[str, KeyPool] = api_key
+        self.prompt_cache:bool = prompt_cache
+        self.base_url:Union[str, None] = base_url
 
-        self.claude_key:str = api_key
-        self.task:TaskSpec = task
-        self.model:str = model
+    def default_image_policy(self) -> ImagePolicy:
+        # drops the pixels that Claude would downscale away.
+        return ImagePolicy.default_for("claude")
 
-    def ask(self,  payload:dict, n_choices=1) -> Tuple[List[dict], List[dict]]:
+    def warmup(self):
+        """ Opens a pooled connection to the API ahead of the first request.
+        """
+        for api_key in all_keys(self.claude_key):
+            registry.warmup("claude", api_key, base_url=self.base_url)
+        return self
+
+    @cached_ask("claude")
+    @coalesced_ask("claude")
+    def ask(self,  payload:dict, n_choices=1, stream:bool=False) -> Tuple[List[dict], List[dict]]:
         """
         args: 
             payload: json dictionary, prepared by `prepare_payload`
+            stream: if True, streams the responses, and stops each as soon as
+                its answer is decided (see `ParsedAnswer.decided_prefix`).
         """
 
-        def claude_thread(idx, payload, results):
+        def send():
+            # one request, hedged duplicates included: each leases a key and
+            # waits for the rate limiter on its own.
+            with lease_key(self.claude_key) as api_key:
+                client = registry.get("claude", api_key, base_url=self.base_url)
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire(bucket_key(api_key, self.model), tokens=tokens)
+                if stream:
+                    return self.read_response_stream(client, request)
+                return self.parse_response(client.messages.create(**request))
 
-            # creation of payload
-            mod_payload = deepcopy(payload)
+        def claude_request(idx):
+            return send() if stream else hedged(self.hedging, send)
 
+        assert n_choices >= 1
+        if self.rate_limiter is not None:
+            tokens = estimate_tokens(payload["messages"], payload["max_tokens"])
+        # base64-encoded once, and only read by the requests of every choice.
+        request = self.request_kwargs(payload)
+        results = fan_out(claude_request, n_choices)
+        messages:List[dict] = [ res["message"] for res in results]
+        metadata:List[dict] = [ res["metadata"] for res in results]
+        return messages, metadata 
+
+    def read_response_stream(self, client, request:dict) -> dict:
+        """ Streams the response to `request` (see `request_kwargs`). The metadata
+        is that of `message_start` (input tokens), updated by `message_delta`
+        (output tokens), which only comes at the end of the stream.
+        """
+        response_metadata = {}
+        def deltas():
+            response = client.messages.create(**request, stream=True)
             try:
-                raw_response = client.messages.create(
-                    model="claude-3-haiku-20240307",
-                    #messages=[{"role": "user", "content": "Hello, Claude, tell me a number between 1 to 10000 please."}],
-                    messages = [mod_payload["messages"]],
-                    max_tokens=mod_payload["max_tokens"],
-                )
-            except Exception as e:
-                raise e
-
-            response = raw_response.dict()
-            response['content'] = response['content'][0]['text']
-            message = {key: response[key] for key in ['role', 'content']}
-            metadata = response.copy() # okay
-            del metadata["content"]
-            results[idx] = {"message": message, "metadata": metadata} 
-            return
-
-        client = anthropic.Anthropic(api_key = self.claude_key)
+                for event in response:
+                    if event.type == "message_start":
+                        response_metadata.update(event.message.dict())
+                    elif event.type == "message_delta":
+                        response_metadata.update(event.delta.dict())
+                        usage = {key: value for key, value in event.usage.dict().items() if value is not None}
+                        response_metadata["usage"] = dict(response_metadata.get("usage") or {}, **usage)
+                    elif event.type == "content_block_delta" and getattr(event.delta, "text", None):
+                        yield event.delta.text
+            finally:
+                response.close() # cancels the generation
+
+        text, stopped_early = read_stream(deltas(), self.task.answer_type)
+        metadata = self.response_metadata(response_metadata)
+        metadata.update(stream=True, stopped_early=stopped_early)
+        return {"message": {"role": "assistant", "content": text}, "metadata": metadata}
+
+    @cached_aask("claude")
+    @coalesced_aask("claude")
+    async def aask(self, payload:dict, n_choices=1) -> Tuple[List[dict], List[dict]]:
+        """ Same as `ask`: the choices are requested concurrently on the event loop.
+        """
+        async def send():
+            with lease_key(self.claude_key) as api_key:
+                client = registry.get_async("claude", api_key, base_url=self.base_url)
+                if self.rate_limiter is not None:
+                    await self.rate_limiter.aacquire(bucket_key(api_key, self.model), tokens=tokens)
+                return self.parse_response(await client.messages.create(**request))
 
         assert n_choices >= 1
-        results = [None]  * n_choices 
-        if n_choices > 1:
-            claude_jobs = [threading.Thread(target=claude_thread,
-                              args=(idx, payload, results))
-                                for idx in range(n_choices)]
-            for job in claude_jobs:
-                job.start()
-            for job in claude_jobs:
-                job.join()
-        else:
-            claude_thread(0, payload, results)
+        if self.rate_limiter is not None:
+            tokens = estimate_tokens(payload["messages"], payload["max_tokens"])
+        request = self.request_kwargs(payload)
+        results = await asyncio.gather(*[ahedged(self.hedging, send) for _ in range(n_choices)])
         messages:List[dict] = [ res["message"] for res in results]
         metadata:List[dict] = [ res["metadata"] for res in results]
-        return messages, metadata 
+        return messages, metadata
+
+    def request_kwargs(self, payload:dict) -> dict:
+        return dict(model=self.model,
+                    #messages=[{"role": "user", "content": "Hello, Claude, tell me a number between 1 to 10000 please."}],
+                    messages = [materialize(payload["messages"])],
+                    max_tokens=payload["max_tokens"])
+
+    @staticmethod
+    def parse_response(raw_response) -> dict:
+        response = raw_response.dict()
+        response['content'] = response['content'][0]['text']
+        message = {key: response[key] for key in ['role', 'content']}
+        metadata = ClaudeModel.response_metadata(response)
+        return {"message": message, "metadata": metadata}
+
+    @staticmethod
+    def response_metadata(response:dict) -> dict:
+        metadata = response.copy() # okay
+        metadata.pop("content", None)
+        metadata["cached_tokens"] = (response.get("usage") or {}).get("cache_read_input_tokens") or 0
+        return metadata
 
 
     @staticmethod
@@ -70,40 +155,39 @@ class ClaudeModel(object):
             max_tokens=1000,
             verbose:bool=False,
             prepend:Union[dict, None]=None,
+            image_policy:Union[ImagePolicy, None]=None,
+            prompt_cache:bool=False,
             **kwargs
             ) -> dict:
+        """
+        Args:
+            prompt_cache: if True, adds cache-control breakpoints at the end of
+                the task description, background and examples sections.
+        """
 
         content = []
-        dic_list = question.get_json()
-        for dic in question.get_json():
+        # Claude can't fetch urls, so url images are downloaded and inlined.
+        for dic in question.get_json(image_policy=image_policy, inline_urls=True):
             # The case of text
             if dic['type'] == 'text':
                 content.append(dic)
 
             # The case of vision input
             elif dic['type'] == 'image_url':
-                base64enc_image = dic['image_url']['url'].split(',')[1]
-                if base64enc_image.startswith("/9j/"):
-                    image_format = 'jpeg'
-                elif base64enc_image.startswith("iVBORw0KGgo"):
-                    image_format = "png"
-                elif base64enc_image.startswith("R0lGOD") or base64enc_image.startswith("R0lGOD"):
-                    image_format =  "gif"
-                elif base64enc_image.startswith("UklGR"):
-                    image_format =  "webp"
-                else:
-                    raise ValueError("Unknown format")
-
-                modified_dic = {
+                image:LazyImage = dic['image_url']['url']
+                content.append({
                     'type' : "image",
                     'source' : {
                         'type' : "base64",
-                        'media_type' : f"image/{image_format}",
-                        'data' : base64enc_image
+                        'media_type' : image.mime_type,
+                        'data' : image.bare() # base64 is produced in `ask`
                     }
-                }
+                })
 
-                content.append(modified_dic)
+        if prompt_cache:
+            for idx in cache_breakpoints(question):
+                # copy: parts of the TaskSpec prefix are shared between payloads.
+                content[idx] = dict(content[idx], cache_control={"type": "ephemeral"})
 
         payload = {
             "messages": {
@@ -115,83 +199,3 @@ class ClaudeModel(object):
 
 
         return payload
-
-
-    def rough_guess(self, question:Question, max_tokens=1000,
-                    max_tries=10, query_id:int=0,
-                    verbose=False,
-                    **kwargs):
-    
-        p = self.prepare_payload(question, max_tokens = max_tokens, verbose=verbose, prepend=None, 
-                                    model=self.model)
-
-        ok = False
-        while not ok:
-            response, meta_data = self.ask(p) 
-            response = response [0] 
-            try: 
-                parsed_response = self.task.answer_type.parser(response["content"])
-            except GPTOutputParseException as e:
-                if not os.path.exists('errors/'):
-                    # Create the directory if it doesn't exist
-                    os.makedirs('errors/')
-                error_saved = f'errors/{time.strftime("%Y-%m-%d-%H-%M-%S")}.json'
-                with open(error_saved, "w")  as f:
-                    f.write(p_ans.code)
-                logger.warning(f"The following was not parseable. Saved in {error_saved}.")
-                
-                reattempt += 1
-                if reattempt > max_tries:
-                    logger.error(f"max tries ({max_tries}) exceeded.")
-                    raise GPTMaxTriesExceededException
-             
-                logger.warning(f"Reattempt #{reattempt} querying LLM")
-                continue
-            ok = True 
-
-        return parsed_response, response, meta_data, p
-
-
-    def many_rough_guesses(self, num_threads:int,
-                           question:Question, max_tokens=1000,
-                           verbose=False, max_tries=10, 
-                           ) -> List[Tuple[ParsedAnswer, str, dict, dict]]:
-        """
-        Args:
-            num_threads : number of independent threads.
-            all other  arguments are same as those of `rough_guess()`
-
-        Returns
-            List of elements, each element is a tuple following the
-            return signature of `rough_guess()`
-        """
-
-        p = self.prepare_payload(question, max_tokens = max_tokens, verbose=verbose, prepend=None, 
-                                    model=self.model)
-
-        n_choices = num_threads
-
-        ok = False
-        reattempt = 0
-        while not ok:
-            response, meta_data = self.ask(p, n_choices=n_choices)
-            try:
-                parsed_response = [self.task.answer_type.parser(r["content"]) for r in response]
-            except GPTOutputParseException as e:
-                logger.warning(f"The following was not parseable:\n\n{response}\n\nBecause\n\n{e}")
-
-                reattempt += 1
-                if reattempt > max_tries:
-                    logger.error(f"max tries ({max_tries}) exceeded.")
-                    raise GPTMaxTriesExceededException
-             
-                logger.warning(f"Reattempt #{reattempt} querying LLM")
-                continue
-            ok = True 
-
-        return parsed_response, response, meta_data, p
-
-    def run_once(self, question:Question, max_tokens=1000, **kwargs):
-        q = self.task.first_question(question) 
-        p_ans, ans, meta, p = self.rough_guess(q, max_tokens=max_tokens, **kwargs)
-        return p_ans, ans, meta, p
\ No newline at end of file
@@ -0,0 +1,198 @@
+"""
+Shared API clients.
+
+Creating an API client per request costs a fresh connection pool, and so a
+new TCP/TLS handshake on every call. The registry keeps one thread-safe
+client per (backend, api key, base url), backed by a keep-alive connection
+pool, and reuses it for every request made with that key.
+
+Async clients are bound to the event loop they were created on, so they
+are kept per loop, and go away with it.
+"""
+
+import asyncio
+import threading
+import weakref
+from typing import Union, Hashable
+from loguru import logger
+
+
+class ClientRegistry(object):
+    """ Thread-safe registry of API clients.
+
+    Example usage:
+        client = registry.get("openai", api_key)
+        client.chat.completions.create(...)
+
+        # inside a coroutine
+        client = registry.get_async("openai", api_key)
+        await client.chat.completions.create(...)
+    """
+    BACKENDS = ("openai", "claude", "gemini", "ollama")
+
+    def __init__(self, pool_size:int=32, timeout:float=600.0):
+        """
+        Args:
+            pool_size: max connections (and keep-alive connections) per client.
+            timeout: request timeout in seconds, for clients that take one.
+        """
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._clients = {}
+        self._http_clients = {} # key -> underlying httpx client, used for warm-up.
+        self._lock = threading.Lock()
+        self._gemini_key = None # google.generativeai is configured process-wide.
+        self._unbound_gemini = set() # keys of gemini models that read the process-wide key
+        self._async_clients = weakref.WeakKeyDictionary() # event loop -> {key: client}
+
+    def get(self, backend:str, api_key:Union[str, None]=None, base_url:Union[str, None]=None,
+            model:Union[str, None]=None):
+        """ Returns the shared client for `backend`, creating it on first use.
+        Args:
+            model: only used by "gemini", whose clients are bound to a model.
+        """
+        assert backend in self.BACKENDS, f"unknown backend '{backend}'"
+        key = (backend, api_key, base_url, model if backend == "gemini" else None)
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                if key not in self._clients:
+                    self._clients[key] = self._create(key)
+                client = self._clients[key]
+        if key in self._unbound_gemini:
+            self._configure_gemini(api_key)
+        return client
+
+    def _httpx_limits(self):
+        import httpx
+        return httpx.Limits(max_connections=self.pool_size,
+                            max_keepalive_connections=self.pool_size)
+
+    def _create(self, key:Hashable):
+        backend, api_key, base_url, model = key
+        if backend == "openai":
+            import openai
+            http_client_class = getattr(openai, "DefaultHttpxClient", None)
+            if http_client_class is None:
+                import httpx
+                http_client_class = httpx.Client
+            http_client = http_client_class(limits=self._httpx_limits(), timeout=self.timeout)
+            self._http_clients[key] = http_client
+            return openai.OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+        if backend == "claude":
+            import anthropic
+            http_client_class = getattr(anthropic, "DefaultHttpxClient", None)
+            if http_client_class is None:
+                import httpx
+                http_client_class = httpx.Client
+            http_client = http_client_class(limits=self._httpx_limits(), timeout=self.timeout)
+            self._http_clients[key] = http_client
+            return anthropic.Anthropic(api_key=api_key, base_url=base_url, http_client=http_client)
+        if backend == "gemini":
+            import google.generativeai as genai
+            genai.configure(api_key=api_key)
+            self._gemini_key = api_key
+            client = genai.GenerativeModel(model_name=model,
+                                           safety_settings=None,
+                                           generation_config=None)
+            # bind the model to its key now: it only reads the process-wide
+            # configuration on first use, which would race with other keys.
+            try:
+                from google.generativeai import client as genai_client
+                client._client = genai_client.get_default_generative_client()
+            except (ImportError, AttributeError):
+                self._unbound_gemini.add(key)
+            return client
+        if backend == "ollama":
+            import ollama
+            return ollama.Client(host=base_url)
+
+    def get_async(self, backend:str, api_key:Union[str, None]=None, base_url:Union[str, None]=None):
+        """ Returns the shared async client for `backend` on the running event loop.
+        Gemini has no async client: its models run their blocking client in an executor.
+        """
+        assert backend in self.BACKENDS, f"unknown backend '{backend}'"
+        loop = asyncio.get_running_loop()
+        key = (backend, api_key, base_url)
+        with self._lock:
+            clients = self._async_clients.get(loop)
+            if clients is None:
+                clients = self._async_clients[loop] = {}
+            if key not in clients:
+                clients[key] = self._create_async(key)
+            return clients[key]
+
+    def _create_async(self, key:Hashable):
+        backend, api_key, base_url = key
+        if backend == "openai":
+            import openai
+            http_client_class = getattr(openai, "DefaultAsyncHttpxClient", None)
+            if http_client_class is None:
+                import httpx
+                http_client_class = httpx.AsyncClient
+            http_client = http_client_class(limits=self._httpx_limits(), timeout=self.timeout)
+            return openai.AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+        if backend == "claude":
+            import anthropic
+            http_client_class = getattr(anthropic, "DefaultAsyncHttpxClient", None)
+            if http_client_class is None:
+                import httpx
+                http_client_class = httpx.AsyncClient
+            http_client = http_client_class(limits=self._httpx_limits(), timeout=self.timeout)
+            return anthropic.AsyncAnthropic(api_key=api_key, base_url=base_url, http_client=http_client)
+        if backend == "ollama":
+            import ollama
+            return ollama.AsyncClient(host=base_url)
+        raise ValueError(f"no async client for backend '{backend}'")
+
+    def _configure_gemini(self, api_key:str):
+        # genai.configure is global state; only call it when the key changes.
+        if self._gemini_key == api_key:
+            return
+        import google.generativeai as genai
+        with self._lock:
+            if self._gemini_key != api_key:
+                genai.configure(api_key=api_key)
+                self._gemini_key = api_key
+
+    def warmup(self, backend:str, api_key:Union[str, None]=None, base_url:Union[str, None]=None,
+               model:Union[str, None]=None):
+        """ Creates the client and opens a pooled connection to its API, so the
+        first real request doesn't pay for the TCP/TLS handshake.
+        """
+        client = self.get(backend, api_key=api_key, base_url=base_url, model=model)
+        key = (backend, api_key, base_url, None)
+        try:
+            if key in self._http_clients:
+                self._http_clients[key].head(str(client.base_url))
+            elif backend == "ollama":
+                client.list()
+        except Exception as e:
+            # any response (even an error status) means the connection is open.
+            logger.debug(f"warm-up of {backend} client: {e}")
+        return client
+
+    def close(self):
+        """ Closes every pooled connection and forgets the clients.
+        """
+        with self._lock:
+            for http_client in self._http_clients.values():
+                http_client.close()
+            self._clients.clear()
+            self._http_clients.clear()
+            self._unbound_gemini.clear()
+            self._gemini_key = None
+
+    async def aclose(self):
+        """ Closes the async clients of the running event loop.
+        """
+        with self._lock:
+            clients = self._async_clients.pop(asyncio.get_running_loop(), {})
+        for client in clients.values():
+            close = getattr(client, "close", None) or getattr(client, "aclose", None)
+            if close is not None:
+                await close()
+
+
+# shared by every model in the process.
+registry = ClientRegistry()
@@ -5,13 +5,16 @@ import base64
 from abc import abstractmethod
 from PIL import Image
 from loguru import logger
-import requests
 import io
-import threading
+import heapq
+from concurrent.futures import Future
 from bson import ObjectId
 from .utils import URL
-
-io_semaphore = threading.Semaphore(1)
+from .image_cache import image_cache, pil_image_key, file_key, bytes_key
+from .concurrency import get_encode_executor, object_lock
+from .image_policy import ImagePolicy, sniff_mime_type
+from .payload import LazyImage
+from . import remote_images
 
 T = TypeVar('T', bound="ParsedAnswer")
 class ParsedAnswer(object):
@@ -27,18 +30,131 @@ class ParsedAnswer(object):
         # returns an instance of ParsedAnswer
         pass
 
+    @staticmethod
+    def decided_prefix(partial:str) -> Union[int, None]:
+        """ Used when streaming responses: given the text received so far,
+        returns the length of the prefix that already decides the answer (the
+        rest of the stream is then dropped), or None if more text is needed.
+        By default, answers are only parsed once the response is complete.
+
+        Override this where the answer format has a point after which a
+        response that follows it can't change what `parser` returns (e.g. the
+        end of its single answer block). The prefix must parse on its own, to
+        the answer of the complete response.
+        """
+        return None
+
+    @classmethod
+    def incremental_parser(cls) -> "IncrementalParser":
+        return IncrementalParser(cls)
+
     @abstractmethod
     def __str__(self):
         pass
 
 
+class IncrementalParser(object):
+    """ Accumulates a streamed response until its answer is decided.
+
+    Example usage:
+        parser = task.answer_type.incremental_parser()
+        for delta in stream:
+            if parser.feed(delta):
+                break # the rest of the response can't change the answer
+        answer = task.answer_type.parser(parser.text)
+    """
+    def __init__(self, answer_type:Type[ParsedAnswer]):
+        self.answer_type = answer_type
+        self.text = ""
+        self.decided = False
+
+    def feed(self, delta:str) -> bool:
+        """ Adds `delta` to the text, and returns True once the answer is decided.
+        """
+        if self.decided:
+            return True
+        self.text += delta
+        end = self.answer_type.decided_prefix(self.text)
+        if end is not None:
+            self.text = self.text[:end]
+            self.decided = True
+        return self.decided
+
+
+class _Leaf(object):
+    """ Rope node holding a tuple of (component, tag) elements.
+    """
+    __slots__ = ("items", "length")
+    def __init__(self, items:tuple):
+        self.items = items
+        self.length = len(items)
+
+
+class _Concat(object):
+    """ Rope node: the elements of `left` followed by those of `right`.
+    """
+    __slots__ = ("left", "right", "length")
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.length = left.length + right.length
+
+
+class _Tagged(object):
+    """ Rope node: the elements of `child`, with `tags` appended to their tags.
+    """
+    __slots__ = ("child", "tags", "length")
+    def __init__(self, child, tags:tuple):
+        self.child = child
+        self.tags = tags
+        self.length = child.length
+
+
+_EMPTY = _Leaf(())
+
+
+def _concat(left, right):
+    if left.length == 0:
+        return right
+    if right.length == 0:
+        return left
+    return _Concat(left, right)
+
+
+def _flatten(node) -> tuple:
+    """ Returns the (component, tag) elements of a rope, in order.
+    Iterative, as ropes built by repeated appends can be deep.
+    """
+    elements = []
+    stack = [(node, ())]
+    while stack:
+        node, suffix = stack.pop()
+        if isinstance(node, _Leaf):
+            if len(suffix) == 0:
+                elements.extend(node.items)
+            else:
+                for comp, tag in node.items:
+                    elements.append((comp, suffix if tag is None else tuple(tag) + suffix))
+        elif isinstance(node, _Concat):
+            stack.append((node.right, suffix))
+            stack.append((node.left, suffix))
+        else:
+            stack.append((node.child, node.tags + suffix))
+    return tuple(elements)
+
+
 class Question(object):
+    """ An ordered list of (component, tag) elements.
+
+    Elements are stored as an immutable rope, so that concatenating questions
+    (`+`, `append_question`, `prepend_question`, nesting a Question inside
+    another) is O(1). The rope is flattened once, when the elements are read.
+    """
     def __init__(self, elements:Union[None, List[Union[URL, Path, str, ParsedAnswer, Image.Image, 
                         Tuple[Union[URL, Path, str, ParsedAnswer, Image.Image], Union[str, Tuple[str]]]]]]):
-        if elements is None:
-            self.elements = [] 
-        else:
-            self.elements = []
+        root = _EMPTY
+        if elements is not None:
+            items = [] # plain elements not yet added to the rope
             for el in elements:
                 if isinstance(el, tuple):
                     assert len(el) == 2
@@ -55,16 +171,136 @@ class Question(object):
 
                 # if el[0] is an instance of Question
                 if isinstance(el[0], Question):
-                    _question_elements = el[0].eval()
-                    for qe in _question_elements:
-                        if qe[1] == None:
-                            tag = el[1] if el[1] is not None else None # give it the tag
-                        else:
-                            tag = tuple(list(qe[1]) + list(el[1])) if el[1] is not None else qe[1]
-                        self.elements.append((qe[0], tag))
-                            
+                    root = _concat(root, _Leaf(tuple(items)))
+                    items = []
+                    # the nested question's elements get el[1] appended to their tags.
+                    child = el[0]._root
+                    root = _concat(root, child if el[1] is None else _Tagged(child, tuple(el[1])))
                 else: 
-                    self.elements.append(tuple(el))
+                    items.append(tuple(el))
+            root = _concat(root, _Leaf(tuple(items)))
+        self._root = root
+        self._flat = None # (root, flattened elements) of the last flattening
+        self._tag_index = None # (root, {tag: sorted element positions})
+        self._prefix = None # set by `followed_by`, see `get_json`
+        self._json_cache = None
+
+    @classmethod
+    def from_rope(cls, root, prefix:Union["Question", None]=None) -> "Question":
+        question = cls(None)
+        question._root = root
+        question._prefix = prefix
+        return question
+
+    @property
+    def elements(self) -> List[Tuple]:
+        return list(self.flat_elements())
+
+    @elements.setter
+    def elements(self, elements:list):
+        self._root = _Leaf(tuple(tuple(el) for el in elements))
+
+    def flat_elements(self) -> tuple:
+        """ The (component, tag) elements, flattened once per modification.
+        """
+        flat = self._flat
+        if flat is None or flat[0] is not self._root:
+            flat = self._flat = (self._root, _flatten(self._root))
+        return flat[1]
+
+    def tag_index(self) -> dict:
+        """ Maps every tag to the (ascending) positions of the elements that carry it.
+        Built once per modification.
+        """
+        tag_index = self._tag_index
+        if tag_index is None or tag_index[0] is not self._root:
+            index = {}
+            for position, (_, tag) in enumerate(self.flat_elements()):
+                if tag is None:
+                    continue
+                for t in (tag if len(tag) == 1 else dict.fromkeys(tag)):
+                    index.setdefault(t, []).append(position)
+            tag_index = self._tag_index = (self._root, index)
+        return tag_index[1]
+
+    def tags(self) -> List[str]:
+        return list(self.tag_index().keys())
+
+    def _positions_with_any(self, tags:Tuple[str]) -> List[int]:
+        index = self.tag_index()
+        lists = [index[t] for t in dict.fromkeys(tags) if t in index]
+        if len(lists) == 1:
+            return lists[0]
+        positions = []
+        for position in heapq.merge(*lists):
+            if len(positions) == 0 or positions[-1] != position:
+                positions.append(position)
+        return positions
+
+    def _positions_with_all(self, tags:Tuple[str]) -> List[int]:
+        index = self.tag_index()
+        if any(t not in index for t in tags):
+            return []
+        lists = sorted((index[t] for t in dict.fromkeys(tags)), key=len)
+        others = [set(l) for l in lists[1:]]
+        return [position for position in lists[0] if all(position in other for other in others)]
+
+    def select(self, any_tags:Union[None, Tuple[str], str]=None,
+                     all_tags:Union[None, Tuple[str], str]=None,
+                     exclude_tags:Union[None, Tuple[str], str]=None) -> List[Tuple]:
+        """ Returns the (component, tag) elements matching a multi-tag query, in order.
+        Args:
+            any_tags: if not None, keep elements that carry at least one of these tags.
+            all_tags: if not None, keep elements that carry all of these tags.
+            exclude_tags: if not None, drop elements that carry any of these tags.
+        Untagged elements are only kept when neither `any_tags` nor `all_tags` is given.
+
+        Example usage:
+            # everything but the 3rd and 5th examples
+            question.select(exclude_tags=("EXAMPLE_2", "EXAMPLE_4"))
+        """
+        if isinstance(any_tags, str):
+            any_tags = (any_tags,)
+        if isinstance(all_tags, str):
+            all_tags = (all_tags,)
+        if isinstance(exclude_tags, str):
+            exclude_tags = (exclude_tags,)
+
+        elements = self.flat_elements()
+        if any_tags is None and all_tags is None:
+            positions = range(len(elements))
+        elif all_tags is None:
+            positions = self._positions_with_any(any_tags)
+        else:
+            positions = self._positions_with_all(all_tags)
+            if any_tags is not None:
+                keep = set(self._positions_with_any(any_tags))
+                positions = [position for position in positions if position in keep]
+
+        if exclude_tags is not None:
+            excluded = set(self._positions_with_any(exclude_tags))
+            positions = [position for position in positions if position not in excluded]
+        return [elements[position] for position in positions]
+
+    def query(self, any_tags:Union[None, Tuple[str], str]=None,
+                    all_tags:Union[None, Tuple[str], str]=None,
+                    exclude_tags:Union[None, Tuple[str], str]=None) -> "Question":
+        """ Like `select`, but returns a Question.
+        """
+        if any_tags is None and all_tags is None and exclude_tags is None:
+            return Question.from_rope(self._root)
+        return Question(self.select(any_tags=any_tags, all_tags=all_tags, exclude_tags=exclude_tags))
+
+    def __len__(self) -> int:
+        return self._root.length
+
+    def __getstate__(self):
+        # stored flat, to keep pickling independent of the rope's depth.
+        return {"elements": self.flat_elements()}
+
+    def __setstate__(self, state):
+        self.__init__(None)
+        self._root = _Leaf(tuple(tuple(el) for el in state["elements"]))
 
     @staticmethod
     def encode_image(image_path:Union[Path, str]) :
@@ -78,32 +314,57 @@ class Question(object):
 
 
     @staticmethod
-    def get_pil_image_content(image:Image.Image):
-        with io_semaphore:
-            img_byte_array = io.BytesIO()
-            image.save(img_byte_array, format='PNG')  # Save the PIL image to the in-memory stream as PNG
-            img_byte_array.seek(0) 
-            base64enc_image = base64.b64encode(img_byte_array.read()).decode('utf-8') 
-            pack = {"type": "image_url",
+    def encode_pil_image(image:Image.Image, image_policy:Union[ImagePolicy, None]=None) -> LazyImage:
+        with object_lock(image):
+            if image_policy is None:
+                img_byte_array = io.BytesIO()
+                image.save(img_byte_array, format='PNG')  # Save the PIL image to the in-memory stream as PNG
+                data, mime_type = img_byte_array.getvalue(), "image/png"
+            else:
+                data, mime_type = image_policy.encode_image(image)
+        return LazyImage(mime_type, data=data)
+
+    @staticmethod
+    def encode_local_image(image_path:Union[Path, str], image_policy:Union[ImagePolicy, None]=None) -> LazyImage:
+        """ Files that can be sent as-is are only referenced, and read at send time.
+        """
+        if image_policy is None:
+            with open(str(image_path), "rb") as image_file:
+                mime_type = sniff_mime_type(image_file.read(16)) or "image/jpeg"
+            return LazyImage(mime_type, path=image_path)
+
+        mime_type = image_policy.passthrough_mime_type(image_path)
+        if mime_type is not None:
+            file_size = os.path.getsize(image_path)
+            image_policy.record(file_size, file_size)
+            return LazyImage(mime_type, path=image_path)
+        data, mime_type = image_policy.encode_file(image_path)
+        return LazyImage(mime_type, data=data)
+
+    @staticmethod
+    def get_pil_image_content(image:Image.Image, image_policy:Union[ImagePolicy, None]=None):
+        # identical images (e.g. TaskSpec examples) are only encoded once per process.
+        with object_lock(image):
+            key = pil_image_key(image) + (image_policy.key if image_policy is not None else None,)
+        url = image_cache.get_or_create(key, lambda: Question.encode_pil_image(image, image_policy))
+        return {"type": "image_url",
                 "image_url": {
-                    "url": f"data:image/jpeg;base64,{base64enc_image}"
+                    "url": url # LazyImage, base64 is only produced at send time.
                     },
-                "image": image
                 }
-        return pack
 
     @staticmethod
-    def get_local_image_content(image_path:Union[Path, str]):
-        base64enc_image = Question.encode_image(image_path)
+    def get_local_image_content(image_path:Union[Path, str], image_policy:Union[ImagePolicy, None]=None):
+        key = file_key(image_path) + (image_policy.key if image_policy is not None else None,)
+        url = image_cache.get_or_create(key, lambda: Question.encode_local_image(image_path, image_policy))
         return {"type": "image_url", 
                 "image_url": {
-                    "url": f"data:image/jpeg;base64,{base64enc_image}"
+                    "url": url # LazyImage, base64 is only produced at send time.
                     },
-                "image": Image.open(image_path)
                 }
       
     @staticmethod     
-    def get_pil_image_content_savecopy(image:Image.Image):
+    def get_pil_image_content_savecopy(image:Image.Image, image_policy:Union[ImagePolicy, None]=None):
         
         directory = "temporary/"
         if not os.path.exists(directory):
@@ -117,35 +378,66 @@ class Question(object):
         filepath = os.path.join(directory, filename)
         
         # Save the image with the appropriate format based on the file extension
-        image.save(filepath)
+        with object_lock(image):
+            if image_policy is not None:
+                image = image_policy.resize(image)
+            image.save(filepath)
         ret = Question.get_local_image_content(filepath)
         ret["local_path"] = filepath
         return ret
 
+    @staticmethod
+    def encode_remote_image(content:bytes, image_policy:Union[ImagePolicy, None]=None) -> LazyImage:
+        if image_policy is None:
+            return LazyImage(sniff_mime_type(content) or "image/jpeg", data=content)
+        data, mime_type = image_policy.encode_bytes(content)
+        return LazyImage(mime_type, data=data)
+
+    @staticmethod
+    def get_inline_remote_image_content(content:bytes, image_policy:Union[ImagePolicy, None]=None):
+        """ Payload part for an image downloaded from a url, for backends that
+        can't fetch urls themselves.
+        """
+        key = bytes_key(content) + (image_policy.key if image_policy is not None else None,)
+        url = image_cache.get_or_create(key, lambda: Question.encode_remote_image(content, image_policy))
+        return {"type": "image_url",
+                "image_url": {
+                    "url": url # LazyImage, base64 is only produced at send time.
+                    },
+                }
+
     @staticmethod
     def get_remote_image_content(image_url:URL):
         return {"type": "image_url", 
                 "image_url": {
-                    "url": str(image_url),
+                    "url": str(image_url), # we don't pre-read the image from the url. 
                     },
-                "image": None # we don't pre-read the image from the url. 
                 }
 
     def __str__(self):
-        return "\n".join([str(el[0]) for el in self.elements] )       
+        return "\n".join([str(el[0]) for el in self.flat_elements()] )       
 
     def prepend_question (self, other_question:"Question"):
-        self.elements = other_question.eval() + self.elements
+        self._root = _concat(other_question._root, self._root)
         return self
     
     def append_question (self, other_question:"Question"):
-        self.elements = self.elements + other_question.eval()
+        self._root = _concat(self._root, other_question._root)
         return self
 
     def __add__(self, other):
-        return Question(self.elements).append_question(other)
+        return Question.from_rope(_concat(self._root, other._root), prefix=self._prefix)
+
+    def followed_by(self, other:"Question") -> "Question":
+        """ Returns a new question made of this one followed by `other`. The new
+        question reuses this question's cached payload parts in `get_json`, so
+        only the elements of `other` need to be encoded.
+        """
+        return Question.from_rope(_concat(self._root, other._root), prefix=self)
 
     def subquestion(self, filter_tag:Union[Tuple[str], str, None]):
+        if filter_tag is None:
+            return Question.from_rope(self._root)
         return Question(self.eval(filter_tag=filter_tag))
 
     def eval(self, filter_tag:Union[None, Tuple[str], str]=None):
@@ -154,63 +446,134 @@ class Question(object):
             filter_tag: if None, then return everything. Otherwise, return the components that match the
                 tags found in filter_tag.
         """
-        if isinstance(filter_tag , str): 
-            filter_tag = (filter_tag,)
-        return_elements = [] 
-        for comp, tag in self.elements:
-            # NOTE: tag is a tuple or it is None.
-            if filter_tag is None:
-                # all should be allowed
-                return_elements.append((comp, tag))
-            elif tag is not None and len(set(tag).intersection(set(filter_tag))) > 0:
-                return_elements.append((comp, tag))
-            # else, ignore.  (tag = None, or null set intersection)
-        return return_elements
+        if filter_tag is None:
+            return list(self.flat_elements())
+        # tagged elements matching any of filter_tag, looked up in the tag index.
+        return self.select(any_tags=filter_tag)
 
     @property
     def question_components(self):
-        return [el[0] for el in self.elements]
+        return [el[0] for el in self.flat_elements()]
     
-    def images(self) -> List[Image.Image]:
+    def images(self, loader:Union["remote_images.RemoteImageLoader", None]=None) -> List[Image.Image]:
         """ Returns a list of all the images indicated in the Question object.
+        Args:
+            loader: used to download URL images (concurrently, with an on-disk cache).
+                Defaults to the process-wide `remote_images.default_loader`.
         """
+        components = [el[0] for el in self.flat_elements()
+                      if isinstance(el[0], (Image.Image, Path, URL))]
+        urls = [str(component) for component in components if isinstance(component, URL)]
+        if len(urls) > 0:
+            loader = loader if loader is not None else remote_images.default_loader
+            fetched = iter(loader.fetch_many(urls, return_exceptions=True))
+
         imgs = []
-        for el in self.eval():
-            component = el[0]
+        for component in components:
             if isinstance(component, Image.Image):
                 imgs.append(component)
             elif isinstance(component, Path):
                 imgs.append(Image.open(component))
             elif isinstance(component, URL):
-                try:
-                    response= requests.get(str(component))
-                    response.raise_for_status()
-                    img = Image.open(BytesIO(response.content))
-                    imgs.append(img)
-                except requests.RequestException as e:
-                    logger.warning(f"Error fetching the image from URL: {e}")
+                content = next(fetched)
+                if isinstance(content, Exception):
+                    logger.warning(f"Error fetching the image from URL: {content}")
                     continue
+                imgs.append(Image.open(io.BytesIO(content)))
         return imgs                
 
-    def get_json(self, **kwargs): 
+    def get_json(self, image_policy:Union[ImagePolicy, None]=None, inline_urls:bool=False, **kwargs): 
+        """ Returns the payload parts for every question component. Image
+        components are encoded concurrently on the shared encoding pool.
+        Args:
+            image_policy: if not None, how images are resized/recompressed for
+                the target backend. Otherwise images are sent losslessly, at full resolution.
+            inline_urls: if True, URL images are downloaded (concurrently, once per
+                call) and inlined as image bytes. Otherwise the url itself is sent.
+        """
+        if self._prefix is not None and len(kwargs) == 0:
+            rest = self._after_prefix()
+            if rest is not None:
+                return (self._prefix.cached_json(image_policy, inline_urls=inline_urls) 
+                        + self.encode_components([el[0] for el in _flatten(rest)], image_policy,
+                                                 inline_urls=inline_urls))
+        return self.encode_components(self.question_components, image_policy, inline_urls=inline_urls, **kwargs)
+
+    def _after_prefix(self):
+        """ Returns the rope of the elements that follow `self._prefix`, or None
+        if this question no longer starts with it (e.g. after prepend_question).
+        """
+        prefix_root = self._prefix._root
+        node, rights = self._root, []
+        while node is not prefix_root:
+            if not isinstance(node, _Concat):
+                return None
+            rights.append(node.right)
+            node = node.left
+        rest = _EMPTY
+        for right in reversed(rights):
+            rest = _concat(rest, right)
+        return rest
+
+    def cached_json(self, image_policy:Union[ImagePolicy, None]=None, inline_urls:bool=False) -> list:
+        """ `get_json`, memoized per image policy until the question is modified.
+        """
+        cache_key = (image_policy.key if image_policy is not None else None, inline_urls)
+        json_cache = self._json_cache
+        if json_cache is None or json_cache[0] is not self._root:
+            json_cache = self._json_cache = (self._root, {})
+        if cache_key not in json_cache[1]:
+            json_cache[1][cache_key] = self.get_json(image_policy=image_policy, inline_urls=inline_urls)
+        return list(json_cache[1][cache_key])
+
+    @classmethod
+    def encode_components(cls, components:list, image_policy:Union[ImagePolicy, None]=None, 
+                          inline_urls:bool=False, **kwargs) -> list:
+        """ Returns the payload parts for a list of question components.
+        """
+        if inline_urls:
+            # start the downloads first, so that they overlap with encoding.
+            loader = remote_images.default_loader
+            urls = dict.fromkeys(str(el) for el in components if isinstance(el, URL))
+            downloads = {url: loader.executor.submit(loader.fetch, url) for url in urls}
+
         payload = []
-        for el in self.question_components:
+        image_jobs = [] # (payload index, encoding function, argument)
+        for el in components:
             if isinstance(el, str):
-                payload.append(self.get_text_content(el))
+                payload.append(cls.get_text_content(el))
             elif isinstance(el, Image.Image):
                 if "save_local" in kwargs and kwargs["save_local"] is True:
-                    payload.append(self.get_pil_image_content_savecopy(el))
+                    image_jobs.append((len(payload), cls.get_pil_image_content_savecopy, el))
                 else:
-                    payload.append(self.get_pil_image_content(el))
+                    image_jobs.append((len(payload), cls.get_pil_image_content, el))
+                payload.append(None)
             elif isinstance(el, Path):
-                payload.append(self.get_local_image_content(el))
+                image_jobs.append((len(payload), cls.get_local_image_content, el))
+                payload.append(None)
+            elif isinstance(el, URL) and inline_urls:
+                image_jobs.append((len(payload), cls.get_inline_remote_image_content, downloads[str(el)]))
+                payload.append(None)
             elif isinstance(el, URL):
-                payload.append(self.get_remote_image_content(el))
+                payload.append(cls.get_remote_image_content(el))
             elif isinstance(el,ParsedAnswer):
-                payload.append(self.get_text_content(str(el)))
+                payload.append(cls.get_text_content(str(el)))
             else:
-                print(self.question_components)
+                print(components)
                 raise ValueError(f"invalid element type {type(el)} in question input!")       
+
+        if len(image_jobs) == 1:
+            idx, func, arg = image_jobs[0]
+            payload[idx] = func(arg.result() if isinstance(arg, Future) else arg, image_policy)
+        elif len(image_jobs) > 1:
+            executor = get_encode_executor()
+            # local images are encoded while the url images are still downloading.
+            futures = [(idx, executor.submit(func, arg, image_policy)) 
+                        for idx, func, arg in image_jobs if not isinstance(arg, Future)]
+            futures += [(idx, executor.submit(func, arg.result(), image_policy)) 
+                        for idx, func, arg in image_jobs if isinstance(arg, Future)]
+            for idx, future in futures:
+                payload[idx] = future.result()
         return payload 
 
 
@@ -253,6 +616,7 @@ class TaskSpec(object):
         
         self.examples = []
         self.background = None
+        self._prefix = None # (key, prefix) compiled by `prefix_question`
 
     def add_background(self, background:Question):
         self.background = background
@@ -278,22 +642,21 @@ class TaskSpec(object):
         return question.subquestion(filter_tag=filter_tag)
 
     def example_question_component(self, filter_tag:Union[None, Tuple[str], str]=None):
-        question = Question([])
-        question.append_question(Question([("# Examples", "EXAMPLES_TITLE")]))
-        question.append_question(Question([(f"Here are {len(self.examples)} examples:", "EXAMPLES_CONTENT")]))
+        elements = [("# Examples", "EXAMPLES_TITLE"),
+                    (f"Here are {len(self.examples)} examples:", "EXAMPLES_CONTENT")]
         for ex_idx, ex_dict in enumerate(self.examples):
 
-            question.append_question(Question([(f"(Ex #{ex_idx}) Question:", ("EXAMPLES_QUESTION_TITLE", f"EXAMPLE_{ex_idx}"))]))
-            question.append_question(Question([(ex_dict["question"], ("EXAMPLES_QUESTION_CONTENT", f"EXAMPLE_{ex_idx}"))])) # the question
+            elements.append((f"(Ex #{ex_idx}) Question:", ("EXAMPLES_QUESTION_TITLE", f"EXAMPLE_{ex_idx}")))
+            elements.append((ex_dict["question"], ("EXAMPLES_QUESTION_CONTENT", f"EXAMPLE_{ex_idx}"))) # the question
             
             if ex_dict["explanation"] is not None:
-                question.append_question(Question([(f"(Ex #{ex_idx}) Reasoning:", ("EXAMPLES_REASON_TITLE", f"EXAMPLE_{ex_idx}"))]))
-                question.append_question(Question([(ex_dict["explanation"], ("EXAMPLES_REASON_CONTENT", f"EXAMPLE_{ex_idx}"))]))
+                elements.append((f"(Ex #{ex_idx}) Reasoning:", ("EXAMPLES_REASON_TITLE", f"EXAMPLE_{ex_idx}")))
+                elements.append((ex_dict["explanation"], ("EXAMPLES_REASON_CONTENT", f"EXAMPLE_{ex_idx}")))
             
-            question.append_question(Question([(f"(Ex #{ex_idx}) Answer:", ("EXAMPLES_ANSWER_TITLE", f"EXAMPLE_{ex_idx}"))]))
-            question.append_question(Question([(str(ex_dict["answer"]), ("EXAMPLES_ANSWER_CONTENT", f"EXAMPLE_{ex_idx}"))]))
-            question.append_question(Question(["\n\n"]))
-        return question.subquestion(filter_tag=filter_tag)
+            elements.append((f"(Ex #{ex_idx}) Answer:", ("EXAMPLES_ANSWER_TITLE", f"EXAMPLE_{ex_idx}")))
+            elements.append((str(ex_dict["answer"]), ("EXAMPLES_ANSWER_CONTENT", f"EXAMPLE_{ex_idx}")))
+            elements.append("\n\n")
+        return Question(elements).subquestion(filter_tag=filter_tag)
 
     def prompt_question_component(self, user_question, filter_tag:Union[None, Tuple[str], str]=None):
         question = Question([])
@@ -301,19 +664,36 @@ class TaskSpec(object):
         question.append_question(Question([(user_question, "QUESTION_CONTENT")]))
         return question.subquestion(filter_tag=filter_tag)
 
+    def _prefix_key(self) -> tuple:
+        # what the prefix is built from. Questions are compared by rope root,
+        # which every modification of a Question replaces.
+        return (self.description,
+                None if self.background is None else self.background._root,
+                tuple((ex["question"]._root, str(ex["answer"]), ex["explanation"]) for ex in self.examples))
+
+    def prefix_question(self) -> Question:
+        """ The static part of every first question: task description, background
+        and examples. Compiled once, and again whenever any of them changed.
+        The returned Question also caches its encoded payload parts, so it should
+        not be modified.
+        """
+        key = self._prefix_key()
+        cached = getattr(self, "_prefix", None)
+        if cached is None or cached[0] != key:
+            # task description 
+            prefix = self.task_question_component()
+            # background information 
+            if self.background is not None:
+                prefix.append_question(self.background_question_component())
+            # examples 
+            if len(self.examples) > 0: 
+                prefix.append_question(self.example_question_component())
+            cached = self._prefix = (key, prefix)
+        return cached[1]
+
     def first_question(self, question:Question):
-        # task description 
-        first_q = self.task_question_component()
-        # background information 
-        if self.background is not None:
-            first_q.append_question(self.background_question_component())   
-        # examples 
-        if len(self.examples) > 0: 
-            first_q.append_question(self.example_question_component())        
         # finally, the question 
-        first_q.append_question(self.prompt_question_component(question))
-
-        return first_q 
+        return self.prefix_question().followed_by(self.prompt_question_component(question))
     
     def next_question(self, questions_history:List[Question], 
                             answers_history:List[ParsedAnswer], 
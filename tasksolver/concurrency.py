@@ -0,0 +1,148 @@
+"""
+Shared, bounded executors and locking helpers.
+
+Executors are created lazily and reused for the lifetime of the process,
+so that concurrent agents share a fixed number of worker threads.
+"""
+
+import os
+import threading
+import weakref
+from typing import Callable, Dict, List, Any
+from concurrent.futures import ThreadPoolExecutor
+
+# PIL releases the GIL inside its encoders, so threads are enough to encode
+# several images in parallel.
+encode_workers:int = min(8, os.cpu_count() or 1)
+
+# requests mostly wait on the network, so this is a cap on the number of
+# requests in flight rather than on CPU use.
+request_workers:int = 32
+
+_executor_lock = threading.Lock()
+_encode_executor = None
+_request_executor = None
+_in_request_worker = threading.local()
+
+# id(obj) -> lock. Keyed by id rather than by the object, since PIL images
+# are unhashable; entries are removed when their object is collected.
+_object_locks:Dict[int, threading.RLock] = {}
+_object_locks_guard = threading.Lock()
+
+
+def get_encode_executor() -> ThreadPoolExecutor:
+    """ Pool used by `Question.get_json` to encode image components.
+    """
+    global _encode_executor
+    with _executor_lock:
+        if _encode_executor is None:
+            _encode_executor = ThreadPoolExecutor(max_workers=encode_workers,
+                                                  thread_name_prefix="tasksolver-encode")
+        return _encode_executor
+
+
+def set_encode_workers(num_workers:int):
+    """ Resizes the image encoding pool. Work already submitted to the old
+    pool is allowed to finish.
+    """
+    global _encode_executor, encode_workers
+    assert num_workers >= 1
+    with _executor_lock:
+        encode_workers = num_workers
+        old_executor, _encode_executor = _encode_executor, None
+    if old_executor is not None:
+        old_executor.shutdown(wait=False)
+
+
+def get_request_executor() -> ThreadPoolExecutor:
+    """ Pool shared by every model to send concurrent requests (see `fan_out`).
+    """
+    global _request_executor
+    with _executor_lock:
+        if _request_executor is None:
+            _request_executor = ThreadPoolExecutor(max_workers=request_workers,
+                                                   thread_name_prefix="tasksolver-request")
+        return _request_executor
+
+
+def set_request_workers(num_workers:int):
+    """ Sets the max number of concurrent requests, across all models.
+    Work already submitted to the old pool is allowed to finish.
+    """
+    global _request_executor, request_workers
+    assert num_workers >= 1
+    with _executor_lock:
+        request_workers = num_workers
+        old_executor, _request_executor = _request_executor, None
+    if old_executor is not None:
+        old_executor.shutdown(wait=False)
+
+
+def _run_in_request_worker(func:Callable[[int], Any], idx:int):
+    _in_request_worker.active = True
+    try:
+        return func(idx)
+    finally:
+        _in_request_worker.active = False
+
+
+def fan_out(func:Callable[[int], Any], n:int) -> List[Any]:
+    """ Returns [func(0), ..., func(n-1)], computed concurrently on the shared
+    request pool. The first exception raised by a call is re-raised here.
+
+    Arguments passed to `func` through its closure are shared between the
+    calls, and must not be modified by them.
+
+    Example usage:
+        results = fan_out(lambda idx: client.messages.create(**kwargs), n_choices)
+    """
+    assert n >= 1
+    if n == 1 or getattr(_in_request_worker, "active", False):
+        # nothing to parallelize, or already on the pool: waiting on it from
+        # one of its own workers could deadlock.
+        return [func(idx) for idx in range(n)]
+    executor = get_request_executor()
+    futures = [executor.submit(_run_in_request_worker, func, idx) for idx in range(n)]
+    try:
+        return [future.result() for future in futures]
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def object_lock(obj) -> threading.RLock:
+    """ Returns a lock private to `obj` (e.g. a PIL image, which must not be
+    loaded or saved from two threads at once). The lock lives as long as `obj`.
+    """
+    with _object_locks_guard:
+        lock = _object_locks.get(id(obj))
+        if lock is None:
+            lock = _object_locks[id(obj)] = threading.RLock()
+            # runs before the id can be reused by another object.
+            weakref.finalize(obj, _object_locks.pop, id(obj), None)
+        return lock
+
+
+class LockFreePickleMixin(object):
+    """ Pickling for objects holding locks and other per-process state.
+
+    Rate limiters, caches, policies and the like live on model objects, which
+    get pickled with their Agent. The attributes named in `_transient` are left
+    out of the pickled state, and recreated (empty) by their factory on unpickling.
+
+    Example usage:
+        class Counter(LockFreePickleMixin):
+            _transient = {"_lock": threading.Lock}
+    """
+    _transient:Dict[str, Callable[[], Any]] = {"_lock": threading.Lock}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self._transient:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name, factory in self._transient.items():
+            setattr(self, name, factory())
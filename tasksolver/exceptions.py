@@ -60,4 +60,13 @@ class CodeExecutionException(Exception):
     and stops execution.
     @GPT4-doc-end
     """
-    pass
\ No newline at end of file
+    pass
+
+class ResponseCacheMiss(Exception):
+    """
+    @GPT4-doc-begin
+    raised in ask() when a response cache in replay mode has no response
+    for the request.
+    @GPT4-doc-end
+    """
+    pass
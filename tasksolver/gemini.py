@@ -1,105 +1,145 @@
-import os
 from .common import TaskSpec, ParsedAnswer, Question
-from .exceptions import GPTOutputParseException, GPTMaxTriesExceededException
-import threading
-import base64
-import io
+from .image_policy import ImagePolicy
+from .concurrency import fan_out
+from .streaming import read_stream
+from .response_cache import cached_ask
+from .singleflight import coalesced_ask
+from .hedging import hedged
+from .ratelimit import bucket_key, estimate_tokens
+from .keychain import KeyPool, lease_key, all_keys
+from .clients import registry
+from .model import BaseModel
 from typing import List, Tuple, Union
-from loguru import logger
 from google.generativeai.types import generation_types
-from copy import deepcopy
-import google.generativeai as genai
-import time
-import PIL
 
-class GeminiModel(object):
-    def __init__(self, api_key:str,
+class GeminiModel(BaseModel):
+    save_unparseable = True
+
+    def __init__(self, api_key:Union[str, KeyPool],
                  task:TaskSpec,
-                 model:str="gemini-pro-vision"):
-        self.gemini_key:str = api_key
-        self.task:TaskSpec = task
-        self.model:str = model
+                 model:str="gemini-pro-vision",
+                 **options):
+        """
+        Args:
+            api_key: a Gemini key, or a pool of keys to spread requests over.
+            options: request settings (image_policy, retry_policy, hedging, ...), see `BaseModel`.
+        """
+        super().__init__(task, model, **options)
+        self.gemini_key:Union[str, KeyPool] = api_key
+
+    def default_image_policy(self) -> ImagePolicy:
+        # drops the pixels that Gemini would downscale away.
+        return ImagePolicy.default_for("gemini")
+
+    def warmup(self):
+        """ Creates (and configures) the shared client ahead of the first request.
+        """
+        for api_key in all_keys(self.gemini_key):
+            registry.warmup("gemini", api_key, model=self.model)
+        return self
 
 
-    def ask(self,  payload:dict, n_choices=1) -> Tuple[List[dict], List[dict]]:
+    @cached_ask("gemini")
+    @coalesced_ask("gemini")
+    def ask(self,  payload:dict, n_choices=1, stream:bool=False) -> Tuple[List[dict], List[dict]]:
         """
         args: 
             payload: json dictionary, prepared by `prepare_payload`
+            stream: if True, streams the responses, and stops each as soon as
+                its answer is decided (see `ParsedAnswer.decided_prefix`).
         """
 
-        def gemini_thread(idx, payload, results):
+        def gemini_request(idx):
+            return send() if stream else hedged(self.hedging, send)
 
-            mod_payload = payload
+        def send():
+            # hedged duplicates lease a key and wait for the rate limiter too.
+            with lease_key(self.gemini_key) as api_key:
+                client = registry.get("gemini", api_key, model=self.model)
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire(bucket_key(api_key, self.model), tokens=tokens)
+                return generate(client)
+
+        def generate(client):
 
             config_instance = generation_types.GenerationConfig(
                 max_output_tokens=payload["max_tokens"], 
             )
 
-            try:
+            if stream:
                 raw_response = client.generate_content(
-                    contents=payload["messages"],
-                    generation_config=config_instance
+                    contents=contents,
+                    generation_config=config_instance,
+                    stream=True
                 )
-            except Exception as e:
-                raise e
+                text, stopped_early = read_stream(self.stream_deltas(raw_response), self.task.answer_type)
+                # usage of the chunks read so far.
+                return {"message": {'content': text},
+                        "metadata": {"usage_metadata": getattr(raw_response, "usage_metadata", None),
+                                     "stream": True, "stopped_early": stopped_early}}
+
+            raw_response = client.generate_content(
+                contents=contents,
+                generation_config=config_instance
+            )
 
             response = {'content' : raw_response.text}
-            results[idx] = {"message": response, "metadata": raw_response} 
-            return
-
-        genai.configure(api_key=self.gemini_key)
-        client = genai.GenerativeModel(model_name=self.model,
-            safety_settings= None,
-            generation_config = None
-        )
-        
+            return {"message": response, "metadata": raw_response} 
+
         assert n_choices >= 1
-        results = [None]  * n_choices 
-        if n_choices > 1:
-            gemini_jobs = [threading.Thread(target=gemini_thread,
-                              args=(idx, payload, results))
-                                for idx in range(n_choices)]
-            for job in gemini_jobs:
-                job.start()
-            for job in gemini_jobs:
-                job.join()
-        else:
-            gemini_thread(0, payload, results)
+        if self.rate_limiter is not None:
+            tokens = estimate_tokens(payload["messages"], payload["max_tokens"])
+        contents = self.contents(payload) # built once, shared by every request
+        results = fan_out(gemini_request, n_choices)
         messages:List[dict] = [ res["message"] for res in results]
         metadata:List[dict] = [ res["metadata"] for res in results]
         return messages, metadata 
 
 
+    @staticmethod
+    def stream_deltas(raw_response):
+        """ Text deltas of a streamed response. Closing the generator stops the
+        underlying stream, so that the rest of the generation isn't waited for.
+        """
+        try:
+            for chunk in raw_response:
+                yield chunk.text
+        finally:
+            # GenerateContentResponse has no close(): stop the gRPC call (cancel)
+            # or the REST stream (close) it iterates over.
+            iterator = getattr(raw_response, "_iterator", None)
+            stop = getattr(iterator, "cancel", None) or getattr(iterator, "close", None)
+            if stop is not None:
+                stop()
+
+    @staticmethod
+    def contents(payload:dict) -> list:
+        """ The contents to send: the text, then the images as encoded blobs, so
+        that the SDK doesn't encode (PIL) images itself.
+        """
+        return [message if isinstance(message, str) else {"mime_type": message.mime_type, "data": message.read()}
+                for message in payload["messages"]]
+
     @staticmethod
     def prepare_payload(question:Question,
             max_tokens=1000,
             verbose:bool=False,
             prepend:Union[dict, None]=None,
+            image_policy:Union[ImagePolicy, None]=None,
             **kwargs
             ) -> dict:
 
+        # images are encoded (and cached) by the Question, like for the other
+        # backends. Url images are downloaded and inlined.
         strings = []
         images = []
-        for el in question.get_json(save_local=True):
-            if 'text' in el:
-                strings.append(el['text'])
-            elif 'image_url' in el:
-                #Convert the binary encoded version to PIL.image
-                base64enc_image = el['image_url']['url'].split(',', 1)[1]
-                base64_image_str = base64enc_image  # the Base64-encoded string
-                image_data = base64.b64decode(base64_image_str)
-                image_data_io = io.BytesIO(image_data)
-
-                # Read the image from the BytesIO object
-                pil_image = PIL.Image.open(image_data_io)
+        for dic in question.get_json(image_policy=image_policy, inline_urls=True):
+            if dic['type'] == 'text':
+                strings.append(dic['text'])
+            elif dic['type'] == 'image_url':
+                images.append(dic['image_url']['url']) # LazyImage, read in `ask`
 
-                images.append(pil_image)
-
-        string_message = "\n".join(strings)
-        messages = [string_message]
-
-        for image in images:
-            messages.append(image)
+        messages = ["\n".join(strings)] + images
 
         payload = {
             "messages": messages,
@@ -107,86 +147,3 @@ class GeminiModel(object):
         }
         
         return payload
-
-
-    def rough_guess(self, question:Question, max_tokens=1000,
-                    max_tries=10, query_id:int=0,
-                    verbose=False,
-                    **kwargs):
-    
-        p = self.prepare_payload(question, max_tokens = max_tokens, verbose=verbose, prepend=None, 
-                                    model=self.model)
-
-        ok = False
-        while not ok:
-            response, meta_data = self.ask(p) 
-            response = response [0] 
-            try: 
-                parsed_response = self.task.answer_type.parser(response["content"])
-            except GPTOutputParseException as e:
-
-                if not os.path.exists('errors/'):
-                    # Create the directory if it doesn't exist
-                    os.makedirs('errors/')
-
-                error_saved = f'errors/{time.strftime("%Y-%m-%d-%H-%M-%S")}.json'
-                with open(error_saved, "w")  as f:
-                    f.write(p_ans.code)
-                logger.warning(f"The following was not parseable. Saved in {error_saved}.")
-                
-                reattempt += 1
-                if reattempt > max_tries:
-                    logger.error(f"max tries ({max_tries}) exceeded.")
-                    raise GPTMaxTriesExceededException
-             
-                logger.warning(f"Reattempt #{reattempt} querying LLM")
-                continue
-            ok = True 
-
-        return parsed_response, response, meta_data, p
-
-
-    def many_rough_guesses(self, num_threads:int,
-                           question:Question, max_tokens=1000,
-                           verbose=False, max_tries=10, 
-                           ) -> List[Tuple[ParsedAnswer, str, dict, dict]]:
-        """
-        Args:
-            num_threads : number of independent threads.
-            all other  arguments are same as those of `rough_guess()`
-
-        Returns
-            List of elements, each element is a tuple following the
-            return signature of `rough_guess()`
-        """
-
-        p = self.prepare_payload(question, max_tokens = max_tokens, verbose=verbose, prepend=None, 
-                                    model=self.model)
-        #print('In many rough: ', p)
-
-        n_choices = num_threads
-
-        ok = False
-        reattempt = 0
-        while not ok:
-            response, meta_data = self.ask(p, n_choices=n_choices)
-            try:
-                parsed_response = [self.task.answer_type.parser(r["content"]) for r in response]
-            except GPTOutputParseException as e:
-                logger.warning(f"The following was not parseable:\n\n{response}\n\nBecause\n\n{e}")
-
-                reattempt += 1
-                if reattempt > max_tries:
-                    logger.error(f"max tries ({max_tries}) exceeded.")
-                    raise GPTMaxTriesExceededException
-             
-                logger.warning(f"Reattempt #{reattempt} querying LLM")
-                continue
-            ok = True 
-
-        return parsed_response, response, meta_data, p
-
-    def run_once(self, question:Question, max_tokens=1000, **kwargs):
-        q = self.task.first_question(question) 
-        p_ans, ans, meta, p = self.rough_guess(q, max_tokens=max_tokens, **kwargs)
-        return p_ans, ans, meta, p
\ No newline at end of file
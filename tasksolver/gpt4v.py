@@ -1,55 +1,151 @@
 from typing import List, Union, Tuple
 from loguru import logger
 import io
-from openai import OpenAI
 from .common import TaskSpec, ParsedAnswer, Question
-from .exceptions import GPTOutputParseException, GPTMaxTriesExceededException
-
-
-class GPTModel(object):
-    def __init__(self, api_key:str,
+from .image_policy import ImagePolicy
+from .payload import materialize
+from .prompt_cache import cache_breakpoints, prefix_cache_key
+from .clients import registry
+from .model import BaseModel
+from .streaming import read_streams
+from .response_cache import cached_ask, cached_aask
+from .singleflight import coalesced_ask, coalesced_aask
+from .hedging import hedged, ahedged
+from .ratelimit import bucket_key, estimate_tokens
+from .keychain import KeyPool, lease_key, all_keys
+
+
+class GPTModel(BaseModel):
+    def __init__(self, api_key:Union[str, KeyPool],
                  task:TaskSpec, 
                  model:str="gpt-4-vision-preview",
-                 ):
-        self.open_ai_key:str = api_key
-        
-        self.task:TaskSpec = task
-        self.model:str = model
+                 prompt_cache:bool=False,
+                 base_url:Union[str, None]=None,
+                 **options):
+        """
+        Args:
+            api_key: an OpenAI key, or a pool of keys to spread requests over.
+            prompt_cache: if True, requests sharing a TaskSpec prefix are tagged
+                with a `prompt_cache_key`, to improve OpenAI prompt cache hit rates.
+            base_url: if not None, the API endpoint to use instead of OpenAI's.
+            options: request settings (image_policy, retry_policy, hedging, ...), see `BaseModel`.
+        """
+        super().__init__(task, model, **options)
+        self.open_ai_key:Union[str, KeyPool] = api_key
+        self.prompt_cache:bool = prompt_cache
+        self.base_url:Union[str, None] = base_url
+
+    def default_image_policy(self) -> ImagePolicy:
+        # drops the pixels that OpenAI would downscale away.
+        return ImagePolicy.default_for("openai")
+
+    def warmup(self):
+        """ Opens a pooled connection to the API ahead of the first request.
+        """
+        for api_key in all_keys(self.open_ai_key):
+            registry.warmup("openai", api_key, base_url=self.base_url)
+        return self
  
-    def ask(self, payload: dict, n_choices=1) -> Tuple[dict, dict]:
+    @cached_ask("openai")
+    @coalesced_ask("openai")
+    def ask(self, payload: dict, n_choices=1, stream:bool=False) -> Tuple[dict, dict]:
         """
         args:
             payload: json dictionary, prepared by `prepare_payload`
+            stream: if True, streams the response, and stops as soon as the
+                answer of every choice is decided (see `ParsedAnswer.decided_prefix`).
         """
 
-        client = OpenAI(api_key=self.open_ai_key) 
+        def send():
+            # hedged duplicates lease a key and wait for the rate limiter too.
+            with lease_key(self.open_ai_key) as api_key:
+                client = registry.get("openai", api_key, base_url=self.base_url)
+                if self.rate_limiter is not None:
+                    # one request; the prompt is counted once, the answers n times.
+                    self.rate_limiter.acquire(bucket_key(api_key, self.model),
+                                              tokens=estimate_tokens(payload["messages"], n_choices * payload["max_tokens"]))
+                if stream:
+                    return self.ask_stream(client, payload, n_choices)
+                return self.parse_response(client.chat.completions.create(**request))
+
+        if stream:
+            return send()
+        request = self.request_kwargs(payload, n_choices)
+        return hedged(self.hedging, send)
+
+    def ask_stream(self, client, payload:dict, n_choices=1) -> Tuple[dict, dict]:
+        """ Usage is sent in the last chunk, so it is missing from the metadata
+        when every choice is decided before the end of the stream.
+        """
+        usage = {}
+        def deltas():
+            response = client.chat.completions.create(**self.request_kwargs(payload, n_choices), stream=True,
+                                                      stream_options={"include_usage": True})
+            try:
+                for chunk in response:
+                    if getattr(chunk, "usage", None) is not None:
+                        usage.update(chunk.usage.dict())
+                    for choice in chunk.choices:
+                        if choice.delta.content:
+                            yield choice.index, choice.delta.content
+            finally:
+                response.close() # cancels the generation
+
+        results = read_streams(deltas(), n_choices, self.task.answer_type)
+        messages = [{"role": "assistant", "content": text} for text, _ in results]
+        metadata = self.usage_metadata(usage) if len(usage) > 0 else {}
+        metadata.update(stream=True, stopped_early=[decided for _, decided in results])
+        return messages, metadata
 
-        try:
-            response = client.chat.completions.create(
-                model=self.model, #"gpt-4-vision-preview",
-                messages=payload["messages"],
-                max_tokens=payload["max_tokens"],
-                n=n_choices
-            )
-            
-        except Exception as e:
-            # err = e
-            raise e 
-            
+    @cached_aask("openai")
+    @coalesced_aask("openai")
+    async def aask(self, payload:dict, n_choices=1) -> Tuple[dict, dict]:
+        """ Same as `ask`, on the async client of the running event loop.
+        """
+        async def send():
+            with lease_key(self.open_ai_key) as api_key:
+                client = registry.get_async("openai", api_key, base_url=self.base_url)
+                if self.rate_limiter is not None:
+                    await self.rate_limiter.aacquire(bucket_key(api_key, self.model),
+                                                     tokens=estimate_tokens(payload["messages"], n_choices * payload["max_tokens"]))
+                return self.parse_response(await client.chat.completions.create(**request))
+
+        request = self.request_kwargs(payload, n_choices)
+        return await ahedged(self.hedging, send)
+
+    def request_kwargs(self, payload:dict, n_choices=1) -> dict:
+        extra_body = None
+        if payload.get("prompt_cache_key") is not None:
+            extra_body = {"prompt_cache_key": payload["prompt_cache_key"]}
+        return dict(model=self.model, #"gpt-4-vision-preview",
+                    messages=materialize(payload["messages"]), # base64 only exists for the duration of the request
+                    max_tokens=payload["max_tokens"],
+                    n=n_choices,
+                    extra_body=extra_body)
 
+    @staticmethod
+    def parse_response(response) -> Tuple[dict, dict]:
         response = response.dict()
         messages = [choice["message"] for choice in response["choices"]]        
         
-        metadata = response["usage"]
+        metadata = GPTModel.usage_metadata(response["usage"])
 
         return messages, metadata
 
+    @staticmethod
+    def usage_metadata(usage:dict) -> dict:
+        metadata = dict(usage)
+        metadata["cached_tokens"] = (metadata.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        return metadata
+
     @staticmethod
     def prepare_payload(question:Question,
             verbose:bool=False,
             prepend:Union[dict, None]=None,
             model:str="gpt-4-vision-preview",
             max_tokens:int=1000,
+            image_policy:Union[ImagePolicy, None]=None,
+            prompt_cache:bool=False,
             ) -> dict:
         """
         Args: 
@@ -57,14 +153,14 @@ class GPTModel(object):
             verbose: if true, prints out the payload.
             prepend (optional): if not None it should be the "message" from the 
                 GPT output from the previous exchange.
+            image_policy (optional): how images are resized/recompressed.
+            prompt_cache (optional): if True, adds a `prompt_cache_key` identifying
+                the static TaskSpec prefix of the question.
         Returns:
             payload (dict) containing the json to be sent to GPT's API.
 
         """
-        question_dicts = question.get_json()
-        for part in question_dicts:
-            if part["type"]=="image_url":
-                del part["image"] # remove the PIL.Image
+        question_dicts = question.get_json(image_policy=image_policy)
              
         payload = [{"role": "user",
                     "content": question_dicts
@@ -81,13 +177,14 @@ class GPTModel(object):
             "model": model,
             "messages": payload,
             "max_tokens": max_tokens}
-        return payload
-
-    def run_once(self, question:Question, max_tokens=1000):
-        q = self.task.first_question(question) 
-        p_ans, ans, meta, p = self.rough_guess(q, max_tokens=max_tokens)
-        return p_ans, ans, meta, p
 
+        if prompt_cache:
+            # OpenAI caches byte-identical prefixes. The TaskSpec prefix parts come
+            # from its compiled, cached payload, so they are identical across calls.
+            breakpoints = cache_breakpoints(question)
+            if len(breakpoints) > 0:
+                payload["prompt_cache_key"] = prefix_cache_key(question_dicts, breakpoints[-1] + 1)
+        return payload
 
     ############### NOTE : deprecated -- moved to Agent class.
     def run(self, question:Question, verbose:bool=False):
@@ -133,85 +230,3 @@ class GPTModel(object):
         if verbose:
             logger.info(f"Returning answer at iteration {iteration}: \n{str(p_ans)}")
         return latest_answer, ans, meta, p
-
-
-    
-    def many_rough_guesses(self, num_threads:int,
-                           question:Question, max_tokens=1000, 
-                           verbose=False, max_tries=10) -> List[Tuple[ParsedAnswer, str, dict, dict]]:
-        """
-        Args:
-            num_threads : number of independent threads.
-            all other  arguments are same as those of `rough_guess()`
-
-        Returns
-            List of elements, each element is a tuple following the
-            return signature of `rough_guess()`
-        """
-
-        p = self.prepare_payload(question, verbose=verbose, prepend=None, 
-                                    model=self.model,
-                                    max_tokens=max_tokens)
-
-        n_choices = num_threads
-
-        ok = False
-        reattempt = 0
-        while not ok:
-            response, meta_data = self.ask(p, n_choices=n_choices)
-            try:
-                parsed_response = [self.task.answer_type.parser(r["content"]) for r in response]
-            except GPTOutputParseException as e:
-                logger.warning(f"The following was not parseable:\n\n{response}\n\nBecause\n\n{e}")
-
-                reattempt += 1
-                if reattempt > max_tries:
-                    logger.error(f"max tries ({max_tries}) exceeded.")
-                    raise GPTMaxTriesExceededException
-             
-                logger.warning(f"Reattempt #{reattempt} querying LLM")
-                continue
-            ok = True 
-
-        return parsed_response, response, meta_data, p
-
-
-    def rough_guess(self, question:Question, max_tokens=1000, verbose=False,
-                    max_tries=10, query_id:int=0) -> Tuple[ParsedAnswer, str, dict, dict]:
-        """
-        Args:
-            question
-            max_tokens (int) : max tokens in return from
-            verbose (bool) 
-        Returns:
-            answer in the form of ParsedAnswer
-            answer in the form of raw text response from LLM
-            meta data of the response
-            json payload sent to the LLM
-        """
-
-        p = self.prepare_payload(question, verbose=verbose, prepend=None, 
-                                    model=self.model,
-                                    max_tokens=max_tokens)
-
-        ok = False
-        reattempt = 0
-        while not ok:
-            response, meta_data = self.ask(p)
-            response = response[0]
-            try:
-                parsed_response = self.task.answer_type.parser(response["content"])
-            except GPTOutputParseException as e:
-                logger.warning(f"The following was not parseable:\n\n{response}\n\nBecause\n\n{e}")
-
-                reattempt += 1
-                if reattempt > max_tries:
-                    logger.error(f"max tries ({max_tries}) exceeded.")
-                    raise GPTMaxTriesExceededException
-             
-                logger.warning(f"Reattempt #{reattempt} querying LLM")
-                continue
-            ok = True
-        return parsed_response, response, meta_data, p
-            
-        
\ No newline at end of file
@@ -0,0 +1,210 @@
+"""
+Hedged requests.
+
+Provider latency has a long tail. With hedging, a request that hasn't
+returned after a high percentile of recently observed latencies is sent a
+second time, and whichever copy finishes first is used. The extra requests
+are capped to a fraction of all requests, so hedging only ever pays for a
+small, bounded amount of duplicated work.
+"""
+
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Union, Any, Awaitable
+from loguru import logger
+from .concurrency import LockFreePickleMixin
+
+# requests run here rather than on the shared request pool: hedged requests
+# are themselves often sent from the request pool, and waiting on a pool
+# from one of its own workers could deadlock.
+hedge_workers:int = 64
+
+_executor_lock = threading.Lock()
+_hedge_executor = None
+
+
+def get_hedge_executor() -> ThreadPoolExecutor:
+    global _hedge_executor
+    with _executor_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(max_workers=hedge_workers,
+                                                 thread_name_prefix="tasksolver-hedge")
+        return _hedge_executor
+
+
+class LatencyTracker(LockFreePickleMixin):
+    """ Sliding window of recent request latencies.
+    """
+    def __init__(self, window:int=200):
+        self.latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds:float):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def percentile(self, q:float) -> Union[float, None]:
+        """ Returns the `q` quantile (0 < q < 1) of the window, or None if it is empty.
+        """
+        with self._lock:
+            latencies = sorted(self.latencies)
+        if len(latencies) == 0:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def __len__(self):
+        return len(self.latencies)
+
+
+class HedgePolicy(LockFreePickleMixin):
+    """ When to send a duplicate of a slow request.
+
+    Example usage:
+        model = ClaudeModel(api_key, task, hedging=HedgePolicy(percentile=0.95, max_extra=0.05))
+        ...
+        print(model.hedging.report())
+    """
+    def __init__(self,
+                 percentile:float=0.95,
+                 max_extra:float=0.05,
+                 min_samples:int=20,
+                 window:int=200,
+                 ):
+        """
+        Args:
+            percentile: a duplicate is sent once a request takes longer than
+                this percentile of recent latencies.
+            max_extra: cap on extra spend, as a fraction of requests: at most
+                `max_extra * requests` duplicates are ever sent.
+            min_samples: no duplicates are sent until this many latencies were observed.
+            window: number of recent latencies the percentile is computed over.
+        """
+        assert 0 < percentile < 1
+        self.percentile = percentile
+        self.max_extra = max_extra
+        self.min_samples = min_samples
+        self.tracker = LatencyTracker(window=window)
+
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+
+    def delay(self) -> Union[float, None]:
+        """ Seconds after which a request gets a duplicate, or None if not hedging yet.
+        """
+        if len(self.tracker) < self.min_samples:
+            return None
+        return self.tracker.percentile(self.percentile)
+
+    def _start_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def _start_hedge(self) -> bool:
+        # reserves a duplicate within the spend cap.
+        with self._lock:
+            if self.hedges + 1 > self.max_extra * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def _timed(self, func:Callable[[], Any]) -> Callable[[], Any]:
+        def timed():
+            start = time.monotonic()
+            result = func()
+            self.tracker.record(time.monotonic() - start)
+            return result
+        return timed
+
+    def call(self, func:Callable[[], Any]) -> Any:
+        """ Returns `func()` (a blocking request), sending a duplicate if it is slow.
+        The losing request can't be interrupted: its result is discarded.
+        """
+        self._start_request()
+        delay = self.delay()
+        if delay is None:
+            return self._timed(func)()
+
+        executor = get_hedge_executor()
+        primary = executor.submit(self._timed(func))
+        done, _ = wait([primary], timeout=delay)
+        if len(done) > 0 or not self._start_hedge():
+            return primary.result()
+
+        logger.debug(f"request slower than {delay:.2f}s, sending a duplicate.")
+        hedge = executor.submit(self._timed(func))
+        pending = {primary, hedge}
+        error = None
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    if future is hedge:
+                        with self._lock:
+                            self.hedge_wins += 1
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def acall(self, func:Callable[[], Awaitable[Any]]) -> Any:
+        """ Same as `call`, for a coroutine function. The losing request is cancelled.
+        """
+        self._start_request()
+        delay = self.delay()
+        if delay is None:
+            return await self._atimed(func)
+
+        primary = asyncio.ensure_future(self._atimed(func))
+        done, _ = await asyncio.wait([primary], timeout=delay)
+        if len(done) > 0 or not self._start_hedge():
+            return await primary
+
+        logger.debug(f"request slower than {delay:.2f}s, sending a duplicate.")
+        hedge = asyncio.ensure_future(self._atimed(func))
+        pending = {primary, hedge}
+        error = None
+        try:
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            with self._lock:
+                                self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _atimed(self, func:Callable[[], Awaitable[Any]]) -> Any:
+        start = time.monotonic()
+        result = await func()
+        self.tracker.record(time.monotonic() - start)
+        return result
+
+    def report(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests,
+                    "hedges": self.hedges,
+                    "hedge_wins": self.hedge_wins,
+                    "delay": self.delay()}
+
+
+def hedged(policy:Union[HedgePolicy, None], func:Callable[[], Any]) -> Any:
+    """ Returns `func()`, hedged according to `policy` if there is one.
+    """
+    return func() if policy is None else policy.call(func)
+
+
+async def ahedged(policy:Union[HedgePolicy, None], func:Callable[[], Awaitable[Any]]) -> Any:
+    """ Same as `hedged`, for a coroutine function.
+    """
+    return await func() if policy is None else await policy.acall(func)
@@ -0,0 +1,150 @@
+"""
+Process-wide cache for encoded images.
+
+Encoding a PIL image (or reading and base64-ing an image file) is the
+dominant CPU cost when building payloads for few-shot tasks, since the
+same TaskSpec example images are re-encoded on every query. Entries are
+keyed by image content (or file path + mtime/size), so identical images
+share a single encoded copy.
+"""
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Callable, Hashable, Union
+from PIL import Image
+
+
+class EncodedImageCache(object):
+    """ Byte-budgeted LRU cache of encoded images.
+
+    Example usage:
+        cache = EncodedImageCache(max_bytes=64 * 1024 * 1024)
+        encoded = cache.get_or_create(pil_image_key(img), lambda: encode(img))
+        print(cache.stats())
+    """
+    def __init__(self, max_bytes:int=256 * 1024 * 1024):
+        """
+        Args:
+            max_bytes: upper bound on the total size of the cached values.
+                Least recently used entries are evicted once it is exceeded.
+        """
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._pending = {} # key -> Future, for values currently being created
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def sizeof(value) -> int:
+        # LazyImage values only hold `nbytes` in memory (file references hold none).
+        return value.nbytes if hasattr(value, "nbytes") else len(value)
+
+    def get(self, key:Hashable):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key:Hashable, value):
+        nbytes = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self.sizeof(self._entries.pop(key))
+            if nbytes > self.max_bytes:
+                # would evict everything else and still not fit.
+                return value
+            self._entries[key] = value
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= self.sizeof(evicted)
+                self.evictions += 1
+        return value
+
+    def get_or_create(self, key:Hashable, factory:Callable[[], object]):
+        """ Returns the cached value for `key`, calling `factory` to produce
+        (and cache) it on a miss. Concurrent misses on the same key wait for
+        a single call to `factory` instead of encoding the image twice.
+        """
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            pending = self._pending.get(key)
+            owner = pending is None
+            if owner:
+                self.misses += 1
+                pending = self._pending[key] = Future()
+            else:
+                self.hits += 1
+
+        if not owner:
+            return pending.result()
+
+        try:
+            value = self.put(key, factory())
+        except BaseException as e:
+            with self._lock:
+                del self._pending[key]
+            pending.set_exception(e)
+            raise
+        with self._lock:
+            del self._pending[key]
+        pending.set_result(value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "entries": len(self._entries),
+                    "bytes": self.current_bytes,
+                    "max_bytes": self.max_bytes}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def pil_image_key(image:Image.Image) -> tuple:
+    """ Content key of an in-memory image.
+    Hashing the pixel buffer is far cheaper than PNG-encoding it.
+    """
+    digest = hashlib.blake2b(image.tobytes(), digest_size=20)
+    if image.mode == "P":
+        digest.update(bytes(image.getpalette() or []))
+    return ("pil", image.mode, image.size, str(image.info.get("transparency")), digest.hexdigest())
+
+
+def bytes_key(data:bytes) -> tuple:
+    """ Content key of an encoded image held in memory (e.g. downloaded from a url).
+    """
+    return ("bytes", len(data), hashlib.blake2b(data, digest_size=20).hexdigest())
+
+
+def file_key(image_path:Union[Path, str]) -> tuple:
+    """ Key of an image on disk, invalidated whenever the file is modified.
+    """
+    stat = os.stat(image_path)
+    return ("file", os.path.abspath(str(image_path)), stat.st_mtime_ns, stat.st_size)
+
+
+# shared by every Question in the process.
+image_cache = EncodedImageCache()
@@ -0,0 +1,216 @@
+"""
+Per-backend image downscaling and recompression.
+
+Providers downscale images server-side, so pixels beyond their limits cost
+upload bandwidth and image tokens without ever reaching the model. An
+ImagePolicy resizes images to the provider's limits (and optionally
+recompresses them) before they are encoded into a payload.
+"""
+
+import io
+import math
+import threading
+from pathlib import Path
+from typing import Union, Tuple
+from PIL import Image
+from .concurrency import LockFreePickleMixin
+
+MIME_TYPES = {"PNG": "image/png",
+              "JPEG": "image/jpeg",
+              "WEBP": "image/webp",
+              "GIF": "image/gif"}
+
+
+def sniff_mime_type(data:bytes) -> Union[str, None]:
+    """ Returns the mime type of encoded image bytes, or None if unknown.
+    """
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if data.startswith(b"GIF87a") or data.startswith(b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+class ImagePolicy(LockFreePickleMixin):
+    """ How images are resized and encoded before being sent to a backend.
+
+    Example usage:
+        policy = ImagePolicy(max_long_edge=1568, format="JPEG", quality=85)
+        model = ClaudeModel(api_key, task, image_policy=policy)
+        ...
+        print(policy.report())  # bytes saved so far
+    """
+    def __init__(self,
+                 max_long_edge:Union[int, None]=None,
+                 max_short_edge:Union[int, None]=None,
+                 max_pixels:Union[int, None]=None,
+                 format:str="PNG",
+                 quality:int=85,
+                 exact_savings:bool=False,
+                 ):
+        """
+        Args:
+            max_long_edge: images are downscaled so that their longer side is at most this.
+            max_short_edge: images are downscaled so that their shorter side is at most this.
+            max_pixels: images are downscaled so that width * height is at most this.
+            format: one of "PNG" (lossless), "JPEG" or "WEBP".
+            quality: encoder quality for JPEG and WEBP, ignored for PNG.
+            exact_savings: if True, the savings on in-memory images are counted
+                against their full-size PNG, which costs an extra encode per
+                image. Otherwise, against their uncompressed size.
+        """
+        format = format.upper()
+        if format == "JPG":
+            format = "JPEG"
+        assert format in ("PNG", "JPEG", "WEBP"), f"unsupported image format {format}"
+        self.max_long_edge = max_long_edge
+        self.max_short_edge = max_short_edge
+        self.max_pixels = max_pixels
+        self.format = format
+        self.quality = quality
+        self.exact_savings = exact_savings
+
+        self.images_encoded = 0
+        self.source_bytes = 0
+        self.encoded_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def default_for(backend:str) -> "ImagePolicy":
+        """ PNG policy that only removes pixels the provider would discard anyway,
+        per its documented image limits.
+        """
+        if backend == "openai":
+            # high detail: fit within 2048x2048, then the short side within 768.
+            return ImagePolicy(max_long_edge=2048, max_short_edge=768)
+        if backend == "claude":
+            # longer than 1568 px, or over ~1.15 megapixels, is downscaled.
+            return ImagePolicy(max_long_edge=1568, max_pixels=1150000)
+        if backend == "gemini":
+            # larger than 3072x3072 is downscaled.
+            return ImagePolicy(max_long_edge=3072)
+        raise ValueError(f"unknown backend '{backend}'")
+
+    @property
+    def mime_type(self) -> str:
+        return MIME_TYPES[self.format]
+
+    @property
+    def key(self) -> tuple:
+        """ Identifies the encoding produced by this policy (used as part of cache keys).
+        """
+        return (self.max_long_edge, self.max_short_edge, self.max_pixels, self.format,
+                self.quality if self.format != "PNG" else None)
+
+    def target_size(self, size:Tuple[int, int]) -> Tuple[int, int]:
+        width, height = size
+        scale = 1.0
+        if self.max_long_edge is not None:
+            scale = min(scale, self.max_long_edge / max(width, height))
+        if self.max_short_edge is not None:
+            scale = min(scale, self.max_short_edge / min(width, height))
+        if self.max_pixels is not None:
+            scale = min(scale, math.sqrt(self.max_pixels / (width * height)))
+        if scale >= 1.0:
+            return size
+        return (max(1, int(width * scale)), max(1, int(height * scale)))
+
+    def resize(self, image:Image.Image) -> Image.Image:
+        """ Returns a downscaled copy of `image`, or `image` itself if it is within limits.
+        """
+        size = self.target_size(image.size)
+        if size == image.size:
+            return image
+        return image.resize(size, Image.LANCZOS)
+
+    def encode_pil(self, image:Image.Image) -> bytes:
+        image = self.resize(image)
+        if self.format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        if self.format == "PNG":
+            image.save(buffer, format="PNG")
+        else:
+            image.save(buffer, format=self.format, quality=self.quality)
+        return buffer.getvalue()
+
+    def encode_image(self, image:Image.Image) -> Tuple[bytes, str]:
+        """ Encodes an in-memory image.
+        Returns:
+            encoded bytes, and their mime type
+        """
+        data = self.encode_pil(image)
+        # savings are counted against the full-size PNG that was sent before policies.
+        if self.format == "PNG" and self.target_size(image.size) == image.size:
+            baseline = len(data) # that PNG is what was just encoded.
+        elif self.exact_savings:
+            buffer = io.BytesIO()
+            image.save(buffer, format="PNG")
+            baseline = len(buffer.getvalue())
+        else:
+            baseline = image.width * image.height * len(image.getbands())
+        self.record(baseline, len(data))
+        return data, self.mime_type
+
+    def passthrough_mime_type(self, image_path:Union[Path, str]) -> Union[str, None]:
+        """ Returns the mime type of the image file if it can be sent as-is
+        under this policy, otherwise None. Only reads the file header.
+        """
+        with open(str(image_path), "rb") as f:
+            mime_type = sniff_mime_type(f.read(16))
+        if mime_type != self.mime_type:
+            return None
+        with Image.open(str(image_path)) as image:
+            if self.target_size(image.size) != image.size:
+                return None
+        return mime_type
+
+    def encode_file(self, image_path:Union[Path, str]) -> Tuple[bytes, str]:
+        """ Encodes an image file, passing its bytes through untouched when
+        they are already within the policy's limits and format.
+        Returns:
+            encoded bytes, and their mime type
+        """
+        with open(str(image_path), "rb") as f:
+            return self.encode_bytes(f.read())
+
+    def encode_bytes(self, original:bytes) -> Tuple[bytes, str]:
+        """ Same as `encode_file`, for an image that is already in memory
+        (e.g. downloaded from a url).
+        Returns:
+            encoded bytes, and their mime type
+        """
+        original_mime = sniff_mime_type(original)
+
+        with Image.open(io.BytesIO(original)) as image:
+            needs_resize = self.target_size(image.size) != image.size
+            if not needs_resize and original_mime == self.mime_type:
+                data, mime_type = original, original_mime
+            else:
+                data, mime_type = self.encode_pil(image), self.mime_type
+                if not needs_resize and original_mime is not None and len(original) <= len(data):
+                    # recompressing would not have made it any smaller.
+                    data, mime_type = original, original_mime
+        self.record(len(original), len(data))
+        return data, mime_type
+
+    def record(self, source_bytes:int, encoded_bytes:int):
+        with self._lock:
+            self.images_encoded += 1
+            self.source_bytes += source_bytes
+            self.encoded_bytes += encoded_bytes
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.source_bytes - self.encoded_bytes
+
+    def report(self) -> dict:
+        with self._lock:
+            return {"images_encoded": self.images_encoded,
+                    "source_bytes": self.source_bytes,
+                    "encoded_bytes": self.encoded_bytes,
+                    "bytes_saved": self.source_bytes - self.encoded_bytes}
@@ -1,27 +1,212 @@
 import os
-from typing import Union, Dict
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Union, Dict, List, Iterator
+from loguru import logger
+from .retry import status_code, retry_after
+from .concurrency import LockFreePickleMixin
+
+# key file path -> (mtime, key), so that key files are only read once.
+_key_files:Dict[str, tuple] = {}
+_key_files_lock = threading.Lock()
+
+
+def read_key(key:str) -> str:
+    """ Returns `key`, or the first line of the file it names if it is a path.
+    """
+    if not os.path.exists(key): # it's a key
+        return key
+    mtime = os.path.getmtime(key)
+    with _key_files_lock:
+        cached = _key_files.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(key, "r") as f:
+        value = f.readline().strip()
+    with _key_files_lock:
+        _key_files[key] = (mtime, value)
+    return value
+
+
+class KeyPool(LockFreePickleMixin):
+    """ Several API keys for one service. Each request leases a key, chosen
+    among the healthy keys by remaining quota (if `rpm` is given) or by
+    fewest outstanding requests. Keys rejected with 401/403 or 429 are
+    ejected for a while.
+
+    Example usage:
+        pool = KeyPool(["sk-...", "sk-..."], rpm=500)
+        model = GPTModel(pool, task)
+
+        with pool.lease() as key:
+            ... # request using `key`
+    """
+    def __init__(self, keys:List[str], rpm:Union[float, None]=None,
+                 rate_limit_cooldown:float=30.0, auth_cooldown:float=600.0):
+        """
+        Args:
+            keys: api keys, or paths to files holding them.
+            rpm: requests per minute allowed per key. If given, requests go to the
+                key with the most quota left in the last minute.
+            rate_limit_cooldown: seconds a key is ejected after a 429 without Retry-After.
+            auth_cooldown: seconds a key is ejected after a 401/403.
+        """
+        self.keys:List[str] = []
+        self.rpm = rpm
+        self.rate_limit_cooldown = rate_limit_cooldown
+        self.auth_cooldown = auth_cooldown
+
+        self.outstanding:Dict[str, int] = {}
+        self.ejected_until:Dict[str, float] = {}
+        self.requests:Dict[str, deque] = {} # key -> start times in the last minute
+        self._next = 0 # round-robin tie breaking
+        self._lock = threading.Lock()
+        for key in keys:
+            self.add(key)
+
+    def add(self, key:str) -> "KeyPool":
+        key = read_key(key)
+        with self._lock:
+            if key not in self.keys:
+                self.keys.append(key)
+                self.outstanding[key] = 0
+                self.ejected_until[key] = 0.0
+                self.requests[key] = deque()
+        return self
+
+    def remaining(self, key:str, now:float) -> float:
+        """ Requests `key` has left this minute (infinite without `rpm`).
+        """
+        recent = self.requests[key]
+        while len(recent) > 0 and recent[0] < now - 60:
+            recent.popleft()
+        return float("inf") if self.rpm is None else self.rpm - len(recent)
+
+    def acquire(self) -> str:
+        """ Picks a key and counts a request against it. Prefer `lease`.
+        """
+        with self._lock:
+            if len(self.keys) == 0:
+                raise ValueError("No keys in the pool")
+            now = time.time()
+            healthy = [key for key in self.keys if self.ejected_until[key] <= now]
+            if len(healthy) == 0:
+                # everything is ejected: use the key that comes back first.
+                healthy = [min(self.keys, key=lambda key: self.ejected_until[key])]
+            # rotate, so that ties don't always go to the first key.
+            self._next = (self._next + 1) % len(self.keys)
+            order = {key: (idx - self._next) % len(self.keys) for idx, key in enumerate(self.keys)}
+            key = min(healthy, key=lambda key: (-self.remaining(key, now), self.outstanding[key], order[key]))
+            self.outstanding[key] += 1
+            self.requests[key].append(now)
+            return key
+
+    def release(self, key:str, error:Union[BaseException, None]=None) -> bool:
+        """ Ends a request made with `key`. Ejects the key if `error` says it
+        is invalid or rate limited.
+        Returns:
+            True if the key was ejected
+        """
+        cooldown = None
+        status = None if error is None else status_code(error)
+        if status in (401, 403):
+            cooldown = self.auth_cooldown
+        elif status == 429:
+            cooldown = retry_after(error)
+            if cooldown is None:
+                cooldown = self.rate_limit_cooldown
+        with self._lock:
+            self.outstanding[key] -= 1
+            if cooldown is not None:
+                self.ejected_until[key] = max(self.ejected_until[key], time.time() + cooldown)
+        if cooldown is not None:
+            logger.warning(f"ejecting key ...{key[-4:]} for {cooldown:.0f}s after a {status} response.")
+        return cooldown is not None
+
+    def available(self) -> int:
+        """ Number of keys that are not ejected.
+        """
+        with self._lock:
+            now = time.time()
+            return sum(1 for key in self.keys if self.ejected_until[key] <= now)
+
+    @contextmanager
+    def lease(self) -> Iterator[str]:
+        key = self.acquire()
+        try:
+            yield key
+        except BaseException as e:
+            if self.release(key, e) and self.available() > 0:
+                # tells RetryPolicy it can retry right away, with another key.
+                e.other_key_available = True
+            raise
+        self.release(key)
+
+    def health(self) -> Dict[str, dict]:
+        """ State of each key, by its last 4 characters.
+        """
+        with self._lock:
+            now = time.time()
+            return {f"...{key[-4:]}": {"outstanding": self.outstanding[key],
+                                       "ejected_for": max(0.0, self.ejected_until[key] - now),
+                                       "remaining": self.remaining(key, now)}
+                    for key in self.keys}
+
+    def __len__(self):
+        return len(self.keys)
+
+
+@contextmanager
+def lease_key(key:Union[str, KeyPool]) -> Iterator[str]:
+    """ Leases a key from `key` if it is a pool, otherwise uses `key` itself.
+    """
+    if isinstance(key, KeyPool):
+        with key.lease() as leased:
+            yield leased
+    else:
+        yield key
+
+
+def all_keys(key:Union[str, KeyPool]) -> List[str]:
+    return list(key.keys) if isinstance(key, KeyPool) else [key]
+
 
 class KeyChain(object):
-    def __init__(self,keys:Union[None, Dict[str, str]]=None):
-        if keys is None:
-            self.keys = {}
-        else:
+    def __init__(self,keys:Union[None, Dict[str, Union[str, List[str]]]]=None):
+        """
+        Args:
+            keys: service -> key, or list of keys (or key files).
+        """
+        self.keys:Dict[str, KeyPool] = {}
+        if keys is not None:
             assert isinstance(keys, dict), "Keys should be dict."
-            
-         
-    def add_key(self, service:str, key:str):
-        if os.path.exists(key): # it's a file
-            with open(key, "r") as f:
-                key = f.readline().strip()
-        self.keys.update({service: key}) 
-        return self
+            for service, service_keys in keys.items():
+                if isinstance(service_keys, str):
+                    service_keys = [service_keys]
+                for key in service_keys:
+                    self.add_key(service, key)
 
-    def get_key(self, service:str ):
+
+    def add_key(self, service:str, key:str):
+        """ Adds `key` (or the key in the file it names) to the pool of `service`.
+        """
         if service not in self.keys:
-            raise ValueError(f"No keys associated with '{service}'") 
+            self.keys[service] = KeyPool([])
+        self.keys[service].add(key)
+        return self
 
+    def get_pool(self, service:str) -> KeyPool:
+        if service not in self.keys or len(self.keys[service]) == 0:
+            raise ValueError(f"No keys associated with '{service}'")
         return self.keys[service]
 
+    def get_key(self, service:str ):
+        """ Returns a single key of `service`. Use `get_pool` to share the
+        load between all of them.
+        """
+        return self.get_pool(service).keys[0]
+
     def __getitem__(self, service:str):
         return self.get_key(service)
-     
\ No newline at end of file
@@ -0,0 +1,152 @@
+"""
+What the model backends (GPTModel, ClaudeModel, GeminiModel, OllamaModel) share.
+
+Each backend implements `prepare_payload` and `ask` for its provider. The
+request settings common to all of them (retries, hedging, rate limiting,
+caching, coalescing) are set, and documented, by `BaseModel.__init__`, and the
+methods built on top of `ask` are shared here and in `AsyncModelMixin`.
+"""
+
+import os
+import time
+from typing import List, Tuple, Union
+from loguru import logger
+from .common import TaskSpec, ParsedAnswer, Question
+from .image_policy import ImagePolicy
+from .retry import RetryPolicy
+from .hedging import HedgePolicy
+from .ratelimit import RateLimiter
+from .response_cache import ResponseCache
+from .singleflight import SingleFlight
+from .exceptions import GPTOutputParseException
+from .aio import AsyncModelMixin
+
+
+class BaseModel(AsyncModelMixin):
+    """ Base class of the model backends.
+
+    Example usage:
+        model = ClaudeModel(api_key, task, retry_policy=RetryPolicy(max_wait=30),
+                            rate_limiter=limiter, response_cache=cache)
+        p_ans, ans, meta, p = model.run_once(question)
+    """
+    # if True, unparseable responses of `rough_guess` are saved in errors/.
+    save_unparseable:bool = False
+
+    def __init__(self,
+                 task:TaskSpec,
+                 model:str,
+                 image_policy:Union[ImagePolicy, None]=None,
+                 retry_policy:Union[RetryPolicy, None]=None,
+                 hedging:Union[HedgePolicy, None]=None,
+                 rate_limiter:Union[RateLimiter, None]=None,
+                 response_cache:Union[ResponseCache, None]=None,
+                 singleflight:Union[SingleFlight, None]=None):
+        """
+        Args:
+            task: the task to solve.
+            model: the provider's name of the model.
+            image_policy: how images are resized/recompressed before upload. Defaults
+                to `default_image_policy()`.
+            retry_policy: how failed requests (unparseable answers, rate limits,
+                server errors) are retried. Defaults to `RetryPolicy()`.
+            hedging: if not None, slow requests are duplicated according to this
+                policy, and the first response is used. Streamed requests are not hedged.
+            rate_limiter: if not None, requests wait until they fit within its
+                requests- and tokens-per-minute quotas for this key and model.
+            response_cache: if not None, responses are looked up in (and saved to)
+                this cache before calling the API.
+            singleflight: if not None, identical concurrent requests (of any model
+                sharing it) are sent once, and share the response.
+        """
+        self.task:TaskSpec = task
+        self.model:str = model
+        self.image_policy:Union[ImagePolicy, None] = image_policy if image_policy is not None else self.default_image_policy()
+        self.retry_policy:RetryPolicy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.hedging:Union[HedgePolicy, None] = hedging
+        self.rate_limiter:Union[RateLimiter, None] = rate_limiter
+        self.response_cache:Union[ResponseCache, None] = response_cache
+        self.singleflight:Union[SingleFlight, None] = singleflight
+
+    def default_image_policy(self) -> Union[ImagePolicy, None]:
+        """ Image policy used when none is given. None sends images unchanged.
+        """
+        return None
+
+    def payload(self, question:Question, max_tokens=1000, verbose=False) -> dict:
+        """ `prepare_payload` of the question, with this model's settings.
+        """
+        return self.prepare_payload(question, max_tokens=max_tokens, verbose=verbose, prepend=None,
+                                    model=self.model, image_policy=self.image_policy,
+                                    prompt_cache=getattr(self, "prompt_cache", False))
+
+    def parse(self, content:str) -> ParsedAnswer:
+        """ Parses a response with the task's answer type.
+        """
+        try:
+            return self.task.answer_type.parser(content)
+        except GPTOutputParseException:
+            if self.save_unparseable:
+                os.makedirs('errors/', exist_ok=True)
+                error_saved = f'errors/{time.strftime("%Y-%m-%d-%H-%M-%S")}.json'
+                with open(error_saved, "w") as f:
+                    f.write(content)
+                logger.warning(f"The following was not parseable. Saved in {error_saved}.")
+            raise
+
+    def rough_guess(self, question:Question, max_tokens=1000, verbose=False,
+                    max_tries=10, query_id:int=0, stream:bool=False,
+                    max_wait:Union[float, None]=None, **kwargs) -> Tuple[ParsedAnswer, str, dict, dict]:
+        """
+        Args:
+            question
+            max_tokens (int) : max tokens in return from
+            verbose (bool)
+            max_tries (int) : number of attempts at a parseable answer.
+            stream (bool) : if True, streams the response and stops reading it
+                as soon as the answer is decided.
+            max_wait (float) : if not None, bound on the time spent backing off
+                between retries, instead of the retry policy's `max_wait`.
+        Returns:
+            answer in the form of ParsedAnswer
+            answer in the form of raw text response from LLM
+            meta data of the response
+            json payload sent to the LLM
+        """
+        p = self.payload(question, max_tokens=max_tokens, verbose=verbose)
+
+        def attempt():
+            response, meta_data = self.ask(p, stream=stream)
+            response = response[0]
+            parsed_response = self.parse(response["content"])
+            return parsed_response, response, meta_data, p
+
+        return self.retry_policy.call(attempt, max_parse_retries=max_tries, max_wait=max_wait)
+
+    def many_rough_guesses(self, num_threads:int,
+                           question:Question, max_tokens=1000,
+                           verbose=False, max_tries=10,
+                           stream:bool=False, max_wait:Union[float, None]=None,
+                           **kwargs) -> List[Tuple[ParsedAnswer, str, dict, dict]]:
+        """
+        Args:
+            num_threads : number of independent threads.
+            all other  arguments are same as those of `rough_guess()`
+
+        Returns
+            List of elements, each element is a tuple following the
+            return signature of `rough_guess()`
+        """
+        p = self.payload(question, max_tokens=max_tokens, verbose=verbose)
+
+        def attempt():
+            response, meta_data = self.ask(p, n_choices=num_threads, stream=stream)
+            parsed_response = [self.parse(r["content"]) for r in response]
+            return parsed_response, response, meta_data, p
+
+        return self.retry_policy.call(attempt, max_parse_retries=max_tries, max_wait=max_wait)
+
+    def run_once(self, question:Question, max_tokens=1000, **kwargs):
+        q = self.task.first_question(question)
+        p_ans, ans, meta, p = self.rough_guess(q, max_tokens=max_tokens, **kwargs)
+        return p_ans, ans, meta, p
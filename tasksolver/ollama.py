@@ -1,152 +1,153 @@
-import ollama
 from .common import TaskSpec, ParsedAnswer, Question
-from .exceptions import GPTOutputParseException, GPTMaxTriesExceededException
-import threading
+from .image_policy import ImagePolicy
+from .clients import registry
+from .model import BaseModel
+from .concurrency import fan_out
+from .streaming import read_stream
+from .response_cache import cached_ask, cached_aask
+from .singleflight import coalesced_ask, coalesced_aask
+from .hedging import hedged, ahedged
+from .ratelimit import bucket_key, estimate_tokens
+import asyncio
 from typing import List, Tuple, Union
-from loguru import logger
-from copy import deepcopy
-import time
 
-class OllamaModel(object):
+class OllamaModel(BaseModel):
     def __init__(self, 
                  task:TaskSpec,
-                 model:str):
-        self.task:TaskSpec = task
-        self.model:str = model
+                 model:str,
+                 host:Union[str, None]=None,
+                 **options):
+        """
+        Args:
+            host: if not None, the Ollama server to use instead of the default one.
+            options: request settings (image_policy, retry_policy, hedging, ...), see `BaseModel`.
+                By default, images are passed to the local model unchanged.
+        """
+        super().__init__(task, model, **options)
+        self.host:Union[str, None] = host
+
+    def warmup(self):
+        """ Opens a pooled connection to the Ollama server ahead of the first request.
+        """
+        registry.warmup("ollama", base_url=self.host)
+        return self
 
-    def ask(self,  payload:dict, n_choices=1) -> Tuple[List[dict], List[dict]]:
+    @cached_ask("ollama")
+    @coalesced_ask("ollama")
+    def ask(self,  payload:dict, n_choices=1, stream:bool=False) -> Tuple[List[dict], List[dict]]:
         """
         args: 
             payload: json dictionary, prepared by `prepare_payload`
+            stream: if True, streams the responses, and stops each as soon as
+                its answer is decided (see `ParsedAnswer.decided_prefix`).
         """
 
-        def ollama_thread(idx, payload, results):
+        def ollama_request(idx):
+            if stream:
+                self.wait_for_limiter(tokens)
+                return self.read_response_stream(client, message)
+            return self.parse_response(hedged(self.hedging, send))
 
-            # creation of payload
-            string_message = "\n".join([el["text"] for el in payload["messages"]["content"]])
-            mod_payload = deepcopy(payload)
-            mod_payload["messages"]["content"] = string_message # overridding with string version
-            #print('string_message: ', string_message)
-            #print('mod_payload["messages"]: ', payload["messages"])
+        def send():
+            self.wait_for_limiter(tokens)
+            return client.chat(model=self.model, messages=[message])
 
-            
-            try:
-                response = ollama.chat(model=self.model, messages=[
-                        mod_payload["messages"]])
-            except Exception as e:
-                raise e
-            message = response["message"]
-            metadata = response.copy()
-            del metadata["message"]
-            results[idx] = {"message": message, "metadata": metadata} 
-            return
+        client = registry.get("ollama", base_url=self.host)
+        message = self.chat_message(payload) # built once, shared by every request
+        tokens = estimate_tokens(payload["messages"])
 
         assert n_choices >= 1
-        results = [None]  * n_choices 
-        if n_choices > 1:
-            ollama_jobs = [threading.Thread(target=ollama_thread,
-                              args=(idx, payload, results))
-                                for idx in range(n_choices)]
-            for job in ollama_jobs:
-                job.start()
-            for job in ollama_jobs:
-                job.join()
-        else:
-            ollama_thread(0, payload, results)
+        results = fan_out(ollama_request, n_choices)
         messages:List[dict] = [ res["message"] for res in results]
         metadata:List[dict] = [ res["metadata"] for res in results]
         return messages, metadata 
 
+    def wait_for_limiter(self, tokens:int):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(bucket_key(self.host, self.model), tokens=tokens)
+
+    def read_response_stream(self, client, message:dict) -> dict:
+        def deltas():
+            response = client.chat(model=self.model, messages=[message], stream=True)
+            try:
+                for chunk in response:
+                    yield chunk["message"]["content"]
+            finally:
+                close = getattr(response, "close", None)
+                if close is not None:
+                    close() # stops the generation
+
+        text, stopped_early = read_stream(deltas(), self.task.answer_type)
+        return {"message": {"role": "assistant", "content": text},
+                "metadata": {"stream": True, "stopped_early": stopped_early}}
+
+    @cached_aask("ollama")
+    @coalesced_aask("ollama")
+    async def aask(self, payload:dict, n_choices=1) -> Tuple[List[dict], List[dict]]:
+        """ Same as `ask`: the choices are requested concurrently on the event loop.
+        """
+        client = registry.get_async("ollama", base_url=self.host)
+
+        message = self.chat_message(payload)
+        tokens = estimate_tokens(payload["messages"])
+
+        async def send():
+            if self.rate_limiter is not None:
+                await self.rate_limiter.aacquire(bucket_key(self.host, self.model), tokens=tokens)
+            return await client.chat(model=self.model, messages=[message])
+
+        async def ollama_task():
+            return self.parse_response(await ahedged(self.hedging, send))
+
+        assert n_choices >= 1
+        results = await asyncio.gather(*[ollama_task() for _ in range(n_choices)])
+        messages:List[dict] = [ res["message"] for res in results]
+        metadata:List[dict] = [ res["metadata"] for res in results]
+        return messages, metadata
+
+    @staticmethod
+    def chat_message(payload:dict) -> dict:
+        """ The chat message to send, with images as raw bytes (the client
+        encodes them into the request body).
+        """
+        message = dict(payload["messages"])
+        if len(message.get("images", [])) > 0:
+            message["images"] = [image.read() for image in message["images"]]
+        else:
+            message.pop("images", None)
+        return message
+
+    @staticmethod
+    def parse_response(response) -> dict:
+        message = response["message"]
+        metadata = dict(response)
+        del metadata["message"]
+        return {"message": message, "metadata": metadata}
+
     @staticmethod
     def prepare_payload(question:Question,
             verbose:bool=False,
             prepend:Union[dict, None]=None,
+            image_policy:Union[ImagePolicy, None]=None,
             **kwargs
             ) -> dict:
 
 
+        # Ollama takes the text as one string, and the images separately.
+        strings = []
+        images = []
+        for dic in question.get_json(image_policy=image_policy, inline_urls=True):
+            if dic['type'] == 'text':
+                strings.append(dic['text'])
+            elif dic['type'] == 'image_url':
+                images.append(dic['image_url']['url']) # LazyImage, read in `ask`
+
         payload = {
             "messages": {
                 'role': 'user',
-                'content': question.get_json()
+                'content': "\n".join(strings),
+                'images': images,
             },
         }
         
         return payload
-
-
-    def rough_guess(self, question:Question,
-                    max_tries=10, query_id:int=0,
-                    verbose=False,
-                    **kwargs):
-    
-        p = self.prepare_payload(question, verbose=verbose, prepend=None, 
-                                    model=self.model)
-
-        ok = False
-        while not ok:
-            response, meta_data = self.ask(p) 
-            response = response [0] 
-            try: 
-                parsed_response = self.task.answer_type.parser(response["content"])
-            except GPTOutputParseException as e:
-                logger.warning(f"The following was not parseable:\n\n{response}\n\nBecause\n\n{e}")
-                
-                reattempt += 1
-                if reattempt > max_tries:
-                    logger.error(f"max tries ({max_tries}) exceeded.")
-                    raise GPTMaxTriesExceededException
-             
-                logger.warning(f"Reattempt #{reattempt} querying LLM")
-                continue
-            ok = True 
-
-        return parsed_response, response, meta_data, p
-
-
-    def many_rough_guesses(self, num_threads:int,
-                           question:Question, 
-                           verbose=False, max_tries=10, 
-                           **kwargs) -> List[Tuple[ParsedAnswer, str, dict, dict]]:
-        """
-        Args:
-            num_threads : number of independent threads.
-            all other  arguments are same as those of `rough_guess()`
-
-        Returns
-            List of elements, each element is a tuple following the
-            return signature of `rough_guess()`
-        """
-
-        p = self.prepare_payload(question, verbose=verbose, prepend=None, 
-                                    model=self.model)
-
-        #  TODO
-        n_choices = num_threads
-
-        # TODO: wrap in robust-ask method, repeatedly asks until parseable output. 
-        ok = False
-        reattempt = 0
-        while not ok:
-            response, meta_data = self.ask(p, n_choices=n_choices)
-            try:
-                parsed_response = [self.task.answer_type.parser(r["content"]) for r in response]
-            except GPTOutputParseException as e:
-                logger.warning(f"The following was not parseable:\n\n{response}\n\nBecause\n\n{e}")
-
-                # TODO provide the parse error message into GPT for the next round to be parsable
-                reattempt += 1
-                if reattempt > max_tries:
-                    logger.error(f"max tries ({max_tries}) exceeded.")
-                    raise GPTMaxTriesExceededException
-             
-                logger.warning(f"Reattempt #{reattempt} querying LLM")
-                continue
-            ok = True 
-
-        return parsed_response, response, meta_data, p
-
-    def run_once(self, question:Question, **kwargs):
-        q = self.task.first_question(question) 
-        p_ans, ans, meta, p = self.rough_guess(q, **kwargs)
-        return p_ans, ans, meta, p
\ No newline at end of file
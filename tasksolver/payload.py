@@ -0,0 +1,94 @@
+"""
+Lazy payload parts.
+
+Payloads hold images as LazyImage references (encoded bytes, or a path to
+an image file) instead of base64 strings. The base64 text, which is ~1.33x
+the size of the image, is only produced by `materialize` right before the
+request body is sent, and is released as soon as the request returns.
+"""
+
+import base64
+from pathlib import Path
+from typing import Union
+
+
+class LazyImage(object):
+    """ An encoded image whose base64 form is produced on demand.
+    """
+    __slots__ = ("data", "path", "mime_type", "as_data_url")
+
+    def __init__(self, mime_type:str, data:Union[bytes, None]=None,
+                 path:Union[Path, str, None]=None, as_data_url:bool=True):
+        """
+        Args:
+            mime_type: e.g. "image/png"
+            data: encoded image bytes. Exactly one of `data` and `path` should be given.
+            path: image file, read only when the image is materialized.
+            as_data_url: if True, materializes to a `data:` url, otherwise to bare base64.
+        """
+        assert (data is None) != (path is None), "exactly one of data and path must be given"
+        self.data = data
+        self.path = path
+        self.mime_type = mime_type
+        self.as_data_url = as_data_url
+
+    @property
+    def nbytes(self) -> int:
+        """ Bytes held in memory by this reference.
+        """
+        return 0 if self.data is None else len(self.data)
+
+    def read(self) -> bytes:
+        if self.data is not None:
+            return self.data
+        with open(str(self.path), "rb") as f:
+            return f.read()
+
+    def base64(self) -> str:
+        return base64.b64encode(self.read()).decode('utf-8')
+
+    def data_url(self) -> str:
+        return f"data:{self.mime_type};base64,{self.base64()}"
+
+    def bare(self) -> "LazyImage":
+        """ View of the same image that materializes to bare base64 (no `data:` prefix).
+        """
+        return LazyImage(self.mime_type, data=self.data, path=self.path, as_data_url=False)
+
+    def materialize(self) -> str:
+        return self.data_url() if self.as_data_url else self.base64()
+
+    def __str__(self):
+        return self.materialize()
+
+    def __repr__(self):
+        source = f"{self.nbytes} bytes" if self.data is not None else str(self.path)
+        return f"LazyImage({self.mime_type}, {source})"
+
+    # immutable, so copies can share the underlying bytes.
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __getstate__(self):
+        return (self.data, self.path, self.mime_type, self.as_data_url)
+
+    def __setstate__(self, state):
+        self.data, self.path, self.mime_type, self.as_data_url = state
+
+
+def materialize(obj):
+    """ Returns a copy of `obj` (nested dicts/lists) with every LazyImage
+    replaced by its base64 text. Only containers are copied.
+    """
+    if isinstance(obj, LazyImage):
+        return obj.materialize()
+    if isinstance(obj, dict):
+        return {key: materialize(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [materialize(value) for value in obj]
+    if isinstance(obj, tuple):
+        return tuple(materialize(value) for value in obj)
+    return obj
@@ -0,0 +1,58 @@
+"""
+Provider prompt caching for the static TaskSpec prefix.
+
+First questions are a long, fixed prefix (task description, background,
+few-shot examples) followed by a short user question. Providers can cache
+that prefix server-side: Claude at explicit cache-control breakpoints,
+OpenAI automatically, for byte-identical prefixes.
+"""
+
+import hashlib
+from typing import List
+from .common import Question
+from .payload import LazyImage
+
+# sections of `TaskSpec.prefix_question`, in order. Their elements are tagged
+# <SECTION>_TITLE, <SECTION>_CONTENT, EXAMPLES_QUESTION_CONTENT, etc.
+STATIC_SECTIONS = ("TASK_DESC", "BACKGROUND", "EXAMPLES")
+
+# Claude accepts at most 4 cache breakpoints per request.
+MAX_BREAKPOINTS = 4
+
+
+def cache_breakpoints(question:Question) -> List[int]:
+    """ Returns the positions of the last element of each static TaskSpec
+    section found in `question`, in ascending order. Payload parts line up
+    with question elements, so these are also positions in `get_json()`.
+    """
+    index = question.tag_index()
+    breakpoints = []
+    for section in STATIC_SECTIONS:
+        positions = [index[tag][-1] for tag in index if tag.startswith(section + "_")]
+        if len(positions) > 0:
+            breakpoints.append(max(positions))
+    # the static sections come first; anything tagged after the user's
+    # question is not a cacheable prefix.
+    question_positions = index.get("QUESTION_TITLE", [])
+    if len(question_positions) > 0:
+        breakpoints = [b for b in breakpoints if b < question_positions[0]]
+    return sorted(set(breakpoints))[-MAX_BREAKPOINTS:]
+
+
+def prefix_cache_key(parts:list, prefix_length:int) -> str:
+    """ Stable identifier of the first `prefix_length` payload parts, used to
+    route requests sharing a prefix to the same OpenAI cache.
+    Images are identified by their size and type rather than hashed.
+    """
+    digest = hashlib.sha256()
+    for part in parts[:prefix_length]:
+        if part["type"] == "text":
+            digest.update(part["text"].encode("utf-8"))
+        else:
+            image = part["image_url"]["url"]
+            if isinstance(image, LazyImage):
+                digest.update(f"{image.mime_type}:{image.nbytes}:{image.path}".encode("utf-8"))
+            else:
+                digest.update(str(image).encode("utf-8"))
+        digest.update(b"\x00")
+    return "tasksolver-" + digest.hexdigest()[:32]
@@ -0,0 +1,180 @@
+"""
+Client-side rate limiting.
+
+A RateLimiter paces requests to stay within a provider's requests-per-minute
+and tokens-per-minute quotas, so that agents sharing an API key wait locally
+instead of spending retries on 429s. Quotas are tracked per (api key, model)
+with token buckets, held in memory (shared by the threads of a process) or
+in an SQLite file (shared by every process on the host).
+"""
+
+import os
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from typing import Union, Dict, Tuple
+from loguru import logger
+from PIL import Image
+from .payload import LazyImage
+from .concurrency import LockFreePickleMixin
+
+# rough cost of an image once downscaled to the provider's limits.
+IMAGE_TOKENS = 1000
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(payload, max_tokens:int=0) -> int:
+    """ Rough number of tokens a request counts for against a TPM quota:
+    the prepared payload's text and images, plus the `max_tokens` reserved
+    for the answer.
+    """
+    chars = 0
+    images = 0
+    stack = [payload]
+    while len(stack) > 0:
+        obj = stack.pop()
+        if isinstance(obj, str):
+            if not obj.startswith("data:"):
+                chars += len(obj)
+        elif isinstance(obj, (LazyImage, Image.Image)):
+            images += 1
+        elif isinstance(obj, dict):
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+    return chars // CHARS_PER_TOKEN + images * IMAGE_TOKENS + max_tokens
+
+
+def bucket_key(api_key:Union[str, None], model:str) -> str:
+    """ Name of the buckets of an (api key, model) pair. Keys are hashed, so they
+    never end up in the SQLite file.
+    """
+    digest = hashlib.sha256(str(api_key).encode("utf-8")).hexdigest()[:16]
+    return f"{digest}:{model}"
+
+
+class RateLimiter(LockFreePickleMixin):
+    """ Token buckets enforcing requests- and tokens-per-minute quotas.
+
+    Example usage:
+        limiter = RateLimiter(rpm=500, tpm=30000, path="~/.cache/tasksolver/ratelimit.sqlite")
+        model = GPTModel(api_key, task, rate_limiter=limiter)
+    """
+    _transient = {"_lock": threading.Lock, "_local": threading.local, "_buckets": dict}
+
+    def __init__(self,
+                 rpm:Union[float, None]=None,
+                 tpm:Union[float, None]=None,
+                 path:Union[str, None]=None,
+                 ):
+        """
+        Args:
+            rpm: requests per minute, or None for no request limit.
+            tpm: (estimated) tokens per minute, or None for no token limit.
+            path: if not None, an SQLite file holding the buckets, so that every
+                process using the same file shares the quota.
+        """
+        self.rpm = rpm
+        self.tpm = tpm
+        self.path = None if path is None else os.path.expanduser(path)
+
+        self._lock = threading.Lock()
+        self._buckets:Dict[str, Tuple[float, float]] = {} # name -> (level, last update)
+        self._local = threading.local()
+
+    def _rates(self, key:str, requests:int, tokens:int) -> Dict[str, Tuple[float, float]]:
+        # bucket name -> (cost, capacity). Buckets refill at capacity per minute,
+        # and hold at most one minute worth of quota.
+        costs = {}
+        if self.rpm is not None:
+            costs[key + ":requests"] = (min(requests, self.rpm), self.rpm)
+        if self.tpm is not None:
+            costs[key + ":tokens"] = (min(tokens, self.tpm), self.tpm)
+        return costs
+
+    @staticmethod
+    def _take(buckets:Dict[str, Tuple[float, float]], costs:Dict[str, Tuple[float, float]], now:float) -> float:
+        """ Takes `costs` from `buckets` if all of them can pay, and returns 0.
+        Otherwise takes nothing, and returns how long to wait until they can.
+        """
+        levels = {}
+        wait = 0.0
+        for name, (cost, capacity) in costs.items():
+            level, updated = buckets.get(name, (capacity, now))
+            level = min(capacity, level + (now - updated) * capacity / 60)
+            levels[name] = level
+            if level < cost:
+                wait = max(wait, (cost - level) * 60 / capacity)
+        if wait > 0:
+            return wait
+        for name, (cost, capacity) in costs.items():
+            buckets[name] = (levels[name] - cost, now)
+        return 0.0
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            connection.execute("CREATE TABLE IF NOT EXISTS buckets "
+                               "(name TEXT PRIMARY KEY, level REAL, updated REAL)")
+            self._local.connection = connection
+        return connection
+
+    def _try_acquire(self, costs:Dict[str, Tuple[float, float]]) -> float:
+        if self.path is None:
+            with self._lock:
+                return self._take(self._buckets, costs, time.monotonic())
+
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE") # one writer at a time, across processes
+        try:
+            names = list(costs)
+            rows = connection.execute(
+                f"SELECT name, level, updated FROM buckets WHERE name IN ({','.join('?' * len(names))})",
+                names).fetchall()
+            buckets = {name: (level, updated) for name, level, updated in rows}
+            wait = self._take(buckets, costs, time.time())
+            if wait == 0:
+                connection.executemany("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)",
+                                       [(name,) + buckets[name] for name in names])
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return wait
+
+    def acquire(self, key:str, requests:int=1, tokens:int=0) -> float:
+        """ Blocks until `requests` requests totalling `tokens` tokens fit in
+        the quota of `key` (see `bucket_key`), and takes them.
+        Returns:
+            seconds spent waiting
+        """
+        costs = self._rates(key, requests, tokens)
+        if len(costs) == 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            wait = self._try_acquire(costs)
+            if wait == 0:
+                if waited > 0:
+                    logger.debug(f"rate limited: waited {waited:.1f}s for {key}")
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    async def aacquire(self, key:str, requests:int=1, tokens:int=0) -> float:
+        """ Same as `acquire`, without blocking the event loop while waiting.
+        """
+        costs = self._rates(key, requests, tokens)
+        if len(costs) == 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            wait = self._try_acquire(costs)
+            if wait == 0:
+                return waited
+            await asyncio.sleep(wait)
+            waited += wait
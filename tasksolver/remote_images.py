@@ -0,0 +1,184 @@
+"""
+Fetching images referenced by URL.
+
+A RemoteImageLoader downloads images concurrently over a pooled
+requests.Session, with timeouts, and keeps an on-disk cache keyed by URL.
+Cached entries are revalidated with ETag/Last-Modified, so repeated runs
+only re-download images that changed. Entries served without either
+validator are treated as immutable and reused as-is.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Union, Tuple
+from loguru import logger
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def default_cache_dir() -> str:
+    return os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                        "tasksolver", "images")
+
+
+class RemoteImageLoader(object):
+    """ Concurrent, pooled, cached image downloads.
+
+    Example usage:
+        loader = RemoteImageLoader(max_workers=16)
+        contents = loader.fetch_many(["https://.../a.png", "https://.../b.png"])
+    """
+    def __init__(self,
+                 cache_dir:Union[str, None]="default",
+                 max_workers:int=8,
+                 timeout:Tuple[float, float]=(3.05, 30),
+                 ):
+        """
+        Args:
+            cache_dir: directory of the on-disk cache. "default" uses
+                ~/.cache/tasksolver/images, None disables the disk cache.
+            max_workers: number of concurrent downloads (and pooled connections per host).
+            timeout: (connect, read) timeouts in seconds.
+        """
+        self.cache_dir = default_cache_dir() if cache_dir == "default" else cache_dir
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+        self._session = None
+        self._executor = None
+        self._pending = {} # url -> Future of the download in progress
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session = session
+            return self._session
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix="tasksolver-fetch")
+            return self._executor
+
+    def _cache_paths(self, url:str) -> Tuple[str, str]:
+        name = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return (os.path.join(self.cache_dir, name + ".bin"),
+                os.path.join(self.cache_dir, name + ".json"))
+
+    def _read_cache(self, url:str) -> Union[Tuple[bytes, dict], None]:
+        if self.cache_dir is None:
+            return None
+        data_path, meta_path = self._cache_paths(url)
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            with open(data_path, "rb") as f:
+                return f.read(), meta
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, url:str, content:bytes, meta:dict):
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        data_path, meta_path = self._cache_paths(url)
+        # write-then-rename, so concurrent readers never see partial files.
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(data_path + suffix, "wb") as f:
+            f.write(content)
+        with open(meta_path + suffix, "w") as f:
+            json.dump(meta, f)
+        os.replace(data_path + suffix, data_path)
+        os.replace(meta_path + suffix, meta_path)
+
+    def fetch(self, url:str) -> bytes:
+        """ Returns the content at `url`, from the disk cache if it is still valid.
+        Concurrent fetches of the same url (e.g. from several agents) share one download.
+        """
+        url = str(url)
+        with self._lock:
+            pending = self._pending.get(url)
+            owner = pending is None
+            if owner:
+                pending = self._pending[url] = Future()
+        if not owner:
+            return pending.result()
+
+        try:
+            content = self._fetch(url)
+        except BaseException as e:
+            with self._lock:
+                del self._pending[url]
+            pending.set_exception(e)
+            raise
+        with self._lock:
+            del self._pending[url]
+        pending.set_result(content)
+        return content
+
+    def _fetch(self, url:str) -> bytes:
+        cached = self._read_cache(url)
+        headers = {}
+        if cached is not None:
+            if not cached[1].get("etag") and not cached[1].get("last_modified"):
+                return cached[0]
+            if cached[1].get("etag"):
+                headers["If-None-Match"] = cached[1]["etag"]
+            if cached[1].get("last_modified"):
+                headers["If-Modified-Since"] = cached[1]["last_modified"]
+
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+            if response.status_code == 304 and cached is not None:
+                return cached[0]
+            response.raise_for_status()
+        except requests.RequestException as e:
+            if cached is not None:
+                logger.warning(f"Could not revalidate {url} ({e}), using the cached copy.")
+                return cached[0]
+            raise
+
+        content = response.content
+        if "no-store" not in response.headers.get("Cache-Control", ""):
+            try:
+                self._write_cache(url, content, {"url": url,
+                                                 "etag": response.headers.get("ETag"),
+                                                 "last_modified": response.headers.get("Last-Modified"),
+                                                 "content_type": response.headers.get("Content-Type")})
+            except OSError as e:
+                logger.warning(f"Could not write {url} to the image cache: {e}")
+        return content
+
+    def fetch_many(self, urls:List[str], return_exceptions:bool=False) -> List[Union[bytes, Exception]]:
+        """ Fetches `urls` concurrently. Results are in the same order as `urls`.
+        Args:
+            return_exceptions: if True, failed downloads are returned as their
+                exception instead of being raised.
+        """
+        if len(urls) == 0:
+            return []
+        futures = [self.executor.submit(self.fetch, url) for url in urls]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except requests.RequestException as e:
+                if not return_exceptions:
+                    raise
+                results.append(e)
+        return results
+
+
+# shared by every Question in the process.
+default_loader = RemoteImageLoader()
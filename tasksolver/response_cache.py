@@ -0,0 +1,249 @@
+"""
+Persistent response cache.
+
+Reruns of the same evaluation send byte-identical payloads. With a
+ResponseCache, `ask` (and `aask`) first look up a hash of the request
+(backend, model, payload including image bytes, number of choices) in an
+SQLite file, and only call the provider on a miss. Entries expire after a TTL,
+and the least recently used ones are evicted once the file exceeds its size
+budget. In replay mode the cache is read-only, and a miss raises instead of
+calling the provider, so that replayed runs are fast and deterministic.
+"""
+
+import os
+import time
+import json
+import pickle
+import hashlib
+import sqlite3
+import functools
+import threading
+from typing import Callable, Union, Any, Tuple
+from loguru import logger
+from PIL import Image
+from .payload import LazyImage
+from .concurrency import LockFreePickleMixin
+from .exceptions import ResponseCacheMiss, GPTOutputParseException
+
+
+def _canonical(obj:Any) -> Any:
+    # JSON-able form of a payload, with images replaced by a hash of their content.
+    if isinstance(obj, LazyImage):
+        return {"image_sha256": hashlib.sha256(obj.read()).hexdigest()}
+    if isinstance(obj, Image.Image):
+        digest = hashlib.sha256(obj.tobytes()).hexdigest()
+        return {"pil_image_sha256": digest, "mode": obj.mode, "size": list(obj.size)}
+    if isinstance(obj, bytes):
+        return {"bytes_sha256": hashlib.sha256(obj).hexdigest()}
+    if isinstance(obj, dict):
+        return {str(key): _canonical(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_canonical(value) for value in obj]
+    if obj is None or isinstance(obj, (str, int, float, bool)):
+        return obj
+    return str(obj)
+
+
+def request_key(backend:str, model:str, payload:dict, n_choices:int=1, stream:bool=False) -> str:
+    """ Hash identifying a request: equal for byte-identical requests, whatever
+    the order of the payload's keys or the way its images are held.
+    """
+    canonical = {"backend": backend, "model": model, "payload": _canonical(payload),
+                 "n": n_choices, "stream": stream}
+    text = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ResponseCache(LockFreePickleMixin):
+    """ (messages, metadata) returned by `ask`, by request hash, in an SQLite file.
+
+    Example usage:
+        cache = ResponseCache("~/.cache/tasksolver/responses.sqlite", ttl=7 * 24 * 3600)
+        model = GPTModel(api_key, task, response_cache=cache)
+
+        # replaying an evaluation: never calls the API.
+        model = GPTModel(api_key, task, response_cache=ResponseCache(path, replay=True))
+    """
+    _transient = {"_lock": threading.Lock, "_local": threading.local}
+
+    def __init__(self,
+                 path:str,
+                 ttl:Union[float, None]=None,
+                 max_bytes:Union[int, None]=1 << 30,
+                 replay:bool=False,
+                 ):
+        """
+        Args:
+            path: the SQLite file. It can be shared by several processes.
+            ttl: if not None, seconds after which an entry is ignored and deleted.
+            max_bytes: if not None, least recently used entries are evicted
+                once the stored responses exceed this size.
+            replay: if True, the cache is only read, and a miss raises
+                ResponseCacheMiss instead of calling the provider.
+        """
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.replay = replay
+
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            if self.replay:
+                connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=60,
+                                             isolation_level=None)
+            else:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+                connection.execute("PRAGMA journal_mode=WAL") # readers don't wait for writers
+                connection.execute("CREATE TABLE IF NOT EXISTS responses "
+                                   "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, created REAL, accessed REAL)")
+                connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self._local.connection = connection
+        return connection
+
+    def _count(self, hit:bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key:str) -> Union[Tuple[Any, Any], None]:
+        """ The cached (messages, metadata) of `key`, or None.
+        """
+        connection = self._connection()
+        row = connection.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is not None and self.ttl is not None and row[1] + self.ttl < now:
+            if not self.replay:
+                connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            row = None
+        if row is None:
+            return None
+        if not self.replay:
+            connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        return pickle.loads(row[0])
+
+    def put(self, key:str, value:Tuple[Any, Any]):
+        if self.replay:
+            return
+        try:
+            blob = pickle.dumps(value)
+        except Exception:
+            # e.g. Gemini's raw responses: their text is in `messages` anyway.
+            messages, metadata = value
+            metadata = [repr(m) for m in metadata] if isinstance(metadata, list) else repr(metadata)
+            blob = pickle.dumps((messages, metadata))
+        now = time.time()
+        connection = self._connection()
+        connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                           (key, blob, len(blob), now, now))
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+
+    def evict(self, max_bytes:int) -> int:
+        """ Deletes the least recently used entries until at most `max_bytes` are stored.
+        Returns:
+            number of entries deleted
+        """
+        connection = self._connection()
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= max_bytes:
+            return 0
+        deleted = 0
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for key, size in connection.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+                if total <= max_bytes:
+                    break
+                connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                total -= size
+                deleted += 1
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        logger.debug(f"response cache: evicted {deleted} entries.")
+        return deleted
+
+    def delete(self, key:str):
+        if not self.replay:
+            self._connection().execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def lookup(self, key:str, valid:Union[Callable[[Tuple[Any, Any]], bool], None]=None) -> Union[Tuple[Any, Any], None]:
+        """ Same as `get`, raising ResponseCacheMiss on a miss in replay mode.
+        Args:
+            valid: if not None, entries it rejects are misses, and are deleted.
+        """
+        value = self.get(key)
+        if value is not None and valid is not None and not valid(value):
+            self.delete(key)
+            value = None
+        self._count(value is not None)
+        if value is None and self.replay:
+            raise ResponseCacheMiss(f"no cached response for request {key}")
+        return value
+
+    def report(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+def parses(model, value:Tuple[Any, Any]) -> bool:
+    """ Whether every message of an `ask` result parses as `model`'s answer type.
+    Unparseable responses are not cached, so that parse retries reach the provider.
+    """
+    try:
+        for message in value[0]:
+            model.task.answer_type.parser(message["content"])
+    except GPTOutputParseException:
+        return False
+    return True
+
+
+def cached_ask(backend:str):
+    """ Decorates a model's `ask(payload, n_choices, stream)` to go through the
+    model's `response_cache`, if it has one. Only parseable responses are stored.
+    """
+    def decorator(ask):
+        @functools.wraps(ask)
+        def wrapper(self, payload:dict, n_choices=1, stream:bool=False):
+            cache = getattr(self, "response_cache", None)
+            if cache is None:
+                return ask(self, payload, n_choices=n_choices, stream=stream)
+            key = request_key(backend, self.model, payload, n_choices, stream)
+            value = cache.lookup(key, valid=lambda value: parses(self, value))
+            if value is None:
+                value = ask(self, payload, n_choices=n_choices, stream=stream)
+                if parses(self, value):
+                    cache.put(key, value)
+            return value
+        return wrapper
+    return decorator
+
+
+def cached_aask(backend:str):
+    """ Same as `cached_ask`, for `aask(payload, n_choices)`. SQLite lookups are
+    local and short, so they run on the event loop.
+    """
+    def decorator(aask):
+        @functools.wraps(aask)
+        async def wrapper(self, payload:dict, n_choices=1):
+            cache = getattr(self, "response_cache", None)
+            if cache is None:
+                return await aask(self, payload, n_choices=n_choices)
+            key = request_key(backend, self.model, payload, n_choices)
+            value = cache.lookup(key, valid=lambda value: parses(self, value))
+            if value is None:
+                value = await aask(self, payload, n_choices=n_choices)
+                if parses(self, value):
+                    cache.put(key, value)
+            return value
+        return wrapper
+    return decorator
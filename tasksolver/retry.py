@@ -0,0 +1,193 @@
+"""
+Retrying model calls.
+
+Errors raised while asking a model are classified as:
+    parse: the answer could not be parsed, ask again right away.
+    rate_limit: the provider is throttling us (429), back off, honoring Retry-After.
+    transient: connection errors, timeouts and server errors, back off.
+    fatal: anything else (bad request, authentication, ...), raised immediately.
+
+Each call gets its own budget of retries per kind, and of total time spent
+waiting. Backoff is exponential with full jitter, so that concurrent agents
+hitting the same limit don't retry in lockstep.
+"""
+
+import time
+import random
+import asyncio
+import email.utils
+from typing import Callable, Union, Any, Awaitable
+from loguru import logger
+from .exceptions import GPTOutputParseException, GPTMaxTriesExceededException
+
+PARSE = "parse"
+RATE_LIMIT = "rate_limit"
+TRANSIENT = "transient"
+FATAL = "fatal"
+
+# SDK exception class names, so that the SDKs don't have to be imported here.
+_RATE_LIMIT_ERRORS = ("RateLimitError", "ResourceExhausted", "TooManyRequests")
+_TRANSIENT_ERRORS = ("APIConnectionError", "APITimeoutError", "InternalServerError",
+                     "ServiceUnavailable", "DeadlineExceeded", "TransportError",
+                     "TimeoutException", "OverloadedError")
+
+
+def status_code(error:BaseException) -> Union[int, None]:
+    """ HTTP status of the response that caused `error`, if there was one.
+    """
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is None:
+        status = getattr(error, "code", None) # google.api_core
+    return status if isinstance(status, int) else None
+
+
+def classify(error:BaseException) -> str:
+    """ Returns one of PARSE, RATE_LIMIT, TRANSIENT or FATAL.
+    """
+    if isinstance(error, GPTOutputParseException):
+        return PARSE
+    names = {cls.__name__ for cls in type(error).__mro__}
+    status = status_code(error)
+    if status == 429 or names.intersection(_RATE_LIMIT_ERRORS):
+        return RATE_LIMIT
+    if status is not None and (status in (408, 409) or status >= 500):
+        return TRANSIENT
+    if names.intersection(_TRANSIENT_ERRORS) or isinstance(error, (ConnectionError, TimeoutError)):
+        return TRANSIENT
+    return FATAL
+
+
+def retry_after(error:BaseException) -> Union[float, None]:
+    """ Seconds to wait before retrying, as requested by the server, if it did.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers is None:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers.get("retry-after-ms")) / 1000
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            # an HTTP date
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryState(object):
+    """ Retries spent by one call of `RetryPolicy.call`.
+    """
+    def __init__(self):
+        self.retries = {PARSE: 0, RATE_LIMIT: 0, TRANSIENT: 0}
+        self.waited = 0.0
+
+
+class RetryPolicy(object):
+    """ When, and how long after, a failed model call is retried.
+
+    Example usage:
+        policy = RetryPolicy(max_rate_limit_retries=3, max_wait=30)
+        model = GPTModel(api_key, task, retry_policy=policy)
+    """
+    def __init__(self,
+                 max_parse_retries:int=10,
+                 max_rate_limit_retries:int=8,
+                 max_transient_retries:int=5,
+                 base_delay:float=1.0,
+                 max_delay:float=60.0,
+                 max_wait:float=300.0,
+                 ):
+        """
+        Args:
+            max_parse_retries: retries after unparseable answers, per call.
+            max_rate_limit_retries: retries after 429s, per call.
+            max_transient_retries: retries after connection and server errors, per call.
+            base_delay: backoff before the first retry, in seconds (before jitter).
+            max_delay: upper bound of a single backoff, in seconds.
+            max_wait: upper bound of the total time a call spends backing off.
+        """
+        self.max_parse_retries = max_parse_retries
+        self.max_rate_limit_retries = max_rate_limit_retries
+        self.max_transient_retries = max_transient_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+
+    def budget(self, kind:str) -> int:
+        return {PARSE: self.max_parse_retries,
+                RATE_LIMIT: self.max_rate_limit_retries,
+                TRANSIENT: self.max_transient_retries}[kind]
+
+    def backoff(self, retry:int) -> float:
+        """ Exponential backoff with full jitter, for the `retry`-th retry (from 1).
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (retry - 1)))
+
+    def next_delay(self, state:RetryState, error:BaseException,
+                   max_parse_retries:Union[int, None]=None,
+                   max_wait:Union[float, None]=None) -> float:
+        """ Returns how long to wait before retrying after `error`, or raises
+        if the error is fatal or the call's budget is spent.
+        """
+        max_wait = self.max_wait if max_wait is None else max_wait
+        kind = classify(error)
+        if kind == FATAL:
+            if not getattr(error, "other_key_available", False):
+                raise error
+            kind = TRANSIENT # e.g. a revoked key of a KeyPool: retry with another key
+        budget = self.budget(kind) if kind != PARSE or max_parse_retries is None else max_parse_retries
+        state.retries[kind] += 1
+        if state.retries[kind] > budget:
+            logger.error(f"max tries ({budget}) exceeded for {kind} errors.")
+            if kind == PARSE:
+                raise GPTMaxTriesExceededException from error
+            raise error
+
+        if kind == PARSE or getattr(error, "other_key_available", False):
+            delay = 0.0 # not a load problem, or the next request goes to another key (see KeyPool)
+        else:
+            delay = retry_after(error)
+            if delay is None:
+                delay = self.backoff(state.retries[kind])
+        if state.waited + delay > max_wait:
+            logger.error(f"retry wait budget ({max_wait}s) exceeded.")
+            raise error
+        state.waited += delay
+        logger.warning(f"{kind} error ({type(error).__name__}: {error}), "
+                       f"retry #{state.retries[kind]} in {delay:.1f}s")
+        return delay
+
+    def call(self, func:Callable[[], Any], max_parse_retries:Union[int, None]=None,
+             max_wait:Union[float, None]=None) -> Any:
+        """ Returns `func()`, retrying it according to this policy.
+        Args:
+            max_parse_retries: if not None, overrides the policy's parse retry budget for this call.
+            max_wait: if not None, overrides the policy's wait budget for this call.
+        """
+        state = RetryState()
+        while True:
+            try:
+                return func()
+            except Exception as e:
+                delay = self.next_delay(state, e, max_parse_retries=max_parse_retries, max_wait=max_wait)
+            if delay > 0:
+                time.sleep(delay)
+
+    async def acall(self, func:Callable[[], Awaitable[Any]], max_parse_retries:Union[int, None]=None,
+                    max_wait:Union[float, None]=None) -> Any:
+        """ Same as `call`, for a coroutine function.
+        """
+        state = RetryState()
+        while True:
+            try:
+                return await func()
+            except Exception as e:
+                delay = self.next_delay(state, e, max_parse_retries=max_parse_retries, max_wait=max_wait)
+            if delay > 0:
+                await asyncio.sleep(delay)
@@ -0,0 +1,301 @@
+"""
+Routing between several models.
+
+A ModelRouter holds several models (e.g. a GPTModel, a ClaudeModel and an
+OllamaModel for the same task) and can be used wherever a single model is,
+including as an Agent's `visual_interface`. Each call goes to the first
+available model, in order or by weight. Failing providers are taken out of
+rotation by a circuit breaker, and a call that hasn't returned within the
+failover deadline is also sent to the next model. A model that only gives
+unparseable answers is failed over too, but doesn't count as failing.
+"""
+
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import wait, FIRST_COMPLETED
+from typing import List, Union, Tuple, Any
+from loguru import logger
+from .common import Question
+from .hedging import LatencyTracker, get_hedge_executor
+from .concurrency import LockFreePickleMixin
+from .exceptions import GPTMaxTriesExceededException
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker(LockFreePickleMixin):
+    """ Takes a provider out of rotation when too many of its recent calls fail.
+
+    Closed: calls go through. Once at least `min_calls` of the last `window`
+    calls were made and more than `failure_rate` of them failed, it opens.
+    Open: calls are refused for `cooldown` seconds, then it is half open.
+    Half open: one trial call goes through. Success closes it, failure re-opens it.
+    """
+    def __init__(self, failure_rate:float=0.5, min_calls:int=5, window:int=20, cooldown:float=30.0):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.outcomes = deque(maxlen=window) # True for success
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    def _update(self):
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = HALF_OPEN
+            self.trial_running = False
+
+    def available(self) -> bool:
+        """ Whether `allow` would let a call through now.
+        """
+        with self._lock:
+            self._update()
+            return self.state == CLOSED or (self.state == HALF_OPEN and not self.trial_running)
+
+    def allow(self) -> bool:
+        """ Whether a call may go through now. In half open state, allowing
+        a call makes it the trial call.
+        """
+        with self._lock:
+            self._update()
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def release(self):
+        """ Ends an allowed call without recording an outcome (it says nothing
+        about the provider's health). Frees the half open trial.
+        """
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.trial_running = False
+
+    def record(self, success:bool):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.trial_running = False
+                if success:
+                    self.state = CLOSED
+                    self.outcomes.clear()
+                else:
+                    self._open()
+                return
+            self.outcomes.append(success)
+            failures = self.outcomes.count(False)
+            if (self.state == CLOSED and len(self.outcomes) >= self.min_calls
+                    and failures > self.failure_rate * len(self.outcomes)):
+                self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+
+    def error_rate(self) -> float:
+        with self._lock:
+            return 0.0 if len(self.outcomes) == 0 else self.outcomes.count(False) / len(self.outcomes)
+
+
+class ModelRouter(object):
+    """ Routes calls over several models, with failover.
+
+    Example usage:
+        router = ModelRouter([GPTModel(openai_key, task, model="gpt-4o-mini"),
+                              ClaudeModel(claude_key, task),
+                              OllamaModel(task, "llava")],
+                             deadline=20)
+        agent = Agent(None, task, visual_interface=router)
+    """
+    def __init__(self,
+                 models:List[Any],
+                 weights:Union[List[float], None]=None,
+                 deadline:Union[float, None]=None,
+                 failure_rate:float=0.5,
+                 min_calls:int=5,
+                 window:int=20,
+                 cooldown:float=30.0,
+                 max_wait:Union[float, None]=10.0,
+                 ):
+        """
+        Args:
+            models: the models to route between. They should share a task.
+            weights: if None, calls go to the first available model, in order.
+                Otherwise, the first model tried is drawn with these weights.
+            deadline: if not None, a call that hasn't returned after this many
+                seconds is also sent to the next model, and the first answer wins.
+            failure_rate, min_calls, window, cooldown: circuit breaker settings, see `CircuitBreaker`.
+            max_wait: if not None, bound on the time a model spends backing off
+                between its own retries (see `RetryPolicy`), before the call fails
+                over to the next model. Passed to the models' calls as `max_wait`.
+        """
+        assert len(models) > 0
+        assert weights is None or len(weights) == len(models)
+        self.models = list(models)
+        self.weights = weights
+        self.deadline = deadline
+        self.max_wait = max_wait
+        self.task = self.models[0].task
+        self.breakers = [CircuitBreaker(failure_rate, min_calls, window, cooldown) for _ in self.models]
+        self.latencies = [LatencyTracker(window=window) for _ in self.models]
+
+    def order(self) -> Tuple[List[int], bool]:
+        """ Indices of the models to try, in order, and whether their circuits
+        should be ignored. Models with an open circuit are left out, unless all of them are.
+        """
+        indices = list(range(len(self.models)))
+        if self.weights is not None:
+            # weighted shuffle: draw the models one by one, without replacement.
+            indices.sort(key=lambda idx: random.random() ** (1.0 / self.weights[idx]) if self.weights[idx] > 0 else 0.0,
+                         reverse=True)
+        available = [idx for idx in indices if self.breakers[idx].available()]
+        if len(available) == 0:
+            logger.warning("every model's circuit is open, trying all of them.")
+            return indices, True
+        return available, False
+
+    def _next(self, candidates:List[int], force:bool) -> Union[int, None]:
+        # pops the next model whose circuit lets the call through (which makes
+        # it the trial call of a half open circuit).
+        while len(candidates) > 0:
+            idx = candidates.pop(0)
+            if force or self.breakers[idx].allow():
+                return idx
+        return None
+
+    def _attempt(self, idx:int, method:str, args:tuple, kwargs:dict) -> Any:
+        start = time.monotonic()
+        try:
+            result = getattr(self.models[idx], method)(*args, **kwargs)
+        except GPTMaxTriesExceededException:
+            # the provider answered, but not parseably: fail over without
+            # counting it against the provider.
+            self.breakers[idx].release()
+            logger.warning(f"{type(self.models[idx]).__name__} gave no parseable answer.")
+            raise
+        except Exception as e:
+            self.breakers[idx].record(False)
+            logger.warning(f"{type(self.models[idx]).__name__} failed: {type(e).__name__}: {e}")
+            raise
+        self.breakers[idx].record(True)
+        self.latencies[idx].record(time.monotonic() - start)
+        return result
+
+    async def _aattempt(self, idx:int, method:str, args:tuple, kwargs:dict) -> Any:
+        start = time.monotonic()
+        try:
+            result = await getattr(self.models[idx], method)(*args, **kwargs)
+        except GPTMaxTriesExceededException:
+            # the provider answered, but not parseably: fail over without
+            # counting it against the provider.
+            self.breakers[idx].release()
+            logger.warning(f"{type(self.models[idx]).__name__} gave no parseable answer.")
+            raise
+        except Exception as e:
+            self.breakers[idx].record(False)
+            logger.warning(f"{type(self.models[idx]).__name__} failed: {type(e).__name__}: {e}")
+            raise
+        self.breakers[idx].record(True)
+        self.latencies[idx].record(time.monotonic() - start)
+        return result
+
+    def route(self, method:str, *args, **kwargs) -> Any:
+        """ Calls `method` on the models, failing over until one of them succeeds.
+        Raises the last error if they all fail.
+        """
+        if self.max_wait is not None:
+            kwargs.setdefault("max_wait", self.max_wait)
+        error = RuntimeError("no model available")
+        candidates, force = self.order()
+        if self.deadline is None:
+            idx = self._next(candidates, force)
+            while idx is not None:
+                try:
+                    return self._attempt(idx, method, args, kwargs)
+                except Exception as e:
+                    error = e
+                idx = self._next(candidates, force)
+            raise error
+
+        executor = get_hedge_executor()
+        pending = set()
+        while True:
+            idx = self._next(candidates, force)
+            if idx is not None:
+                pending.add(executor.submit(self._attempt, idx, method, args, kwargs))
+            if len(pending) == 0:
+                raise error
+            # without a model left to fail over to, wait for the running calls.
+            timeout = self.deadline if len(candidates) > 0 else None
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+            # timed out, or failed: move on to the next model.
+
+    async def aroute(self, method:str, *args, **kwargs) -> Any:
+        """ Same as `route`, for coroutine methods. Slower calls are cancelled
+        once one succeeds.
+        """
+        if self.max_wait is not None:
+            kwargs.setdefault("max_wait", self.max_wait)
+        error = RuntimeError("no model available")
+        candidates, force = self.order()
+        pending = set()
+        try:
+            while True:
+                idx = self._next(candidates, force)
+                if idx is not None:
+                    pending.add(asyncio.ensure_future(self._aattempt(idx, method, args, kwargs)))
+                if len(pending) == 0:
+                    raise error
+                timeout = self.deadline if len(candidates) > 0 else None
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def run_once(self, question:Question, **kwargs):
+        return self.route("run_once", question, **kwargs)
+
+    def rough_guess(self, question:Question, **kwargs):
+        return self.route("rough_guess", question, **kwargs)
+
+    def many_rough_guesses(self, num_threads:int, question:Question, **kwargs):
+        return self.route("many_rough_guesses", num_threads, question, **kwargs)
+
+    async def arun_once(self, question:Question, **kwargs):
+        return await self.aroute("arun_once", question, **kwargs)
+
+    async def arough_guess(self, question:Question, **kwargs):
+        return await self.aroute("arough_guess", question, **kwargs)
+
+    async def amany_rough_guesses(self, num_threads:int, question:Question, **kwargs):
+        return await self.aroute("amany_rough_guesses", num_threads, question, **kwargs)
+
+    def warmup(self):
+        for model in self.models:
+            model.warmup()
+        return self
+
+    def report(self) -> List[dict]:
+        """ Rolling health of each model.
+        """
+        return [{"model": f"{type(model).__name__}({model.model})",
+                 "state": breaker.state,
+                 "error_rate": breaker.error_rate(),
+                 "p50_latency": latencies.percentile(0.5),
+                 "p95_latency": latencies.percentile(0.95)}
+                for model, breaker, latencies in zip(self.models, self.breakers, self.latencies)]
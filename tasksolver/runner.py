@@ -0,0 +1,267 @@
+"""
+Running a TaskSpec over a dataset.
+
+Questions are streamed from a JSONL file or a directory, and answered with
+`run_once` by a bounded number of concurrent requests per model. Every result
+is appended to a checkpoint JSONL file as soon as it arrives, so that a
+crashed or interrupted run resumes where it left off: questions that already
+have a result in the checkpoint are skipped.
+
+Usage:
+    tasksolver-run my_tasks:task data/questions.jsonl results.jsonl \\
+        --model gpt-4o-mini --model claude --keys keys.json --concurrency 16
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import importlib
+from pathlib import Path
+from typing import Iterator, Iterable, List, Tuple, Union, Set, Any
+from loguru import logger
+from .common import Question, TaskSpec
+from .utils import URL
+
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".webp", ".gif", ".bmp")
+TEXT_SUFFIXES = (".txt", ".md")
+
+
+def question_from_json(elements:Union[list, str]) -> Question:
+    """ Builds a Question from JSON elements: strings are text, and
+    {"image": path}, {"url": url} or {"text": text} objects are the matching components.
+    """
+    if isinstance(elements, str):
+        elements = [elements]
+    components = []
+    for el in elements:
+        if isinstance(el, str):
+            components.append(el)
+        elif "image" in el:
+            components.append(Path(el["image"]))
+        elif "url" in el:
+            components.append(URL(el["url"]))
+        else:
+            components.append(el["text"])
+    return Question(components)
+
+
+def iter_jsonl(path:str) -> Iterator[Tuple[str, Question]]:
+    """ (id, question) of every line of a JSONL file. A line is either a list
+    of elements (see `question_from_json`), or {"id": ..., "question": elements};
+    lines without an id are identified by their line number.
+    """
+    with open(path, "r") as f:
+        for line_number, line in enumerate(f):
+            if line.strip() == "":
+                continue
+            row = json.loads(line)
+            if isinstance(row, dict):
+                yield str(row.get("id", line_number)), question_from_json(row["question"])
+            else:
+                yield str(line_number), question_from_json(row)
+
+
+def iter_directory(path:str) -> Iterator[Tuple[str, Question]]:
+    """ (id, question) of every image or text file in a directory (recursively),
+    in sorted order, identified by their path relative to the directory.
+    """
+    root = Path(path)
+    for file in sorted(root.rglob("*")):
+        suffix = file.suffix.lower()
+        if suffix in IMAGE_SUFFIXES:
+            yield str(file.relative_to(root)), Question([file])
+        elif suffix in TEXT_SUFFIXES:
+            yield str(file.relative_to(root)), Question([file.read_text()])
+
+
+def iter_dataset(path:str) -> Iterator[Tuple[str, Question]]:
+    return iter_directory(path) if os.path.isdir(path) else iter_jsonl(path)
+
+
+def count_dataset(path:str) -> int:
+    """ Number of questions in a dataset, without building them.
+    """
+    if os.path.isdir(path):
+        return sum(1 for file in Path(path).rglob("*")
+                   if file.suffix.lower() in IMAGE_SUFFIXES + TEXT_SUFFIXES)
+    with open(path, "r") as f:
+        return sum(1 for line in f if line.strip() != "")
+
+
+def read_checkpoint(path:str) -> Set[str]:
+    """ Ids of the questions answered in a checkpoint file. Failed questions
+    are not included, so that they are run again. A line cut short by a crash is ignored.
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            if "error" not in row:
+                done.add(row["id"])
+    return done
+
+
+class DatasetRunner(object):
+    """ Runs `run_once` on every question of a dataset, with checkpointing.
+
+    Example usage:
+        runner = DatasetRunner([GPTModel(api_key, task, model="gpt-4o-mini")], "results.jsonl")
+        runner.run(iter_dataset("questions.jsonl"), total=count_dataset("questions.jsonl"))
+    """
+    def __init__(self,
+                 models:List[Any],
+                 checkpoint:str,
+                 concurrency:int=8,
+                 max_tokens:int=1000,
+                 report_interval:float=10.0,
+                 ):
+        """
+        Args:
+            models: models (or ModelRouters) answering the questions. Each one
+                takes the next question as soon as one of its requests ends, so
+                faster backends answer more of them.
+            checkpoint: JSONL file results are appended to.
+            concurrency: number of concurrent requests per model.
+            report_interval: seconds between progress reports.
+        """
+        assert len(models) > 0
+        self.models = models
+        self.checkpoint = checkpoint
+        self.concurrency = concurrency
+        self.max_tokens = max_tokens
+        self.report_interval = report_interval
+
+    def _open_checkpoint(self):
+        directory = os.path.dirname(os.path.abspath(self.checkpoint))
+        os.makedirs(directory, exist_ok=True)
+        f = open(self.checkpoint, "a+b")
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n") # after a line cut short by a crash
+        return f
+
+    async def arun(self, items:Iterable[Tuple[str, Question]], total:Union[int, None]=None) -> dict:
+        """ Answers the (id, question) items that have no result in the checkpoint yet.
+        Args:
+            total: number of items, for the ETA.
+        Returns:
+            counts of answered, failed and skipped questions, and the seconds spent.
+        """
+        done = read_checkpoint(self.checkpoint)
+        stats = {"answered": 0, "failed": 0, "skipped": 0}
+        items = iter(items)
+        start = time.monotonic()
+        last_report = start
+
+        def next_item():
+            # skips answered questions; items are only read one at a time.
+            for item_id, question in items:
+                if item_id in done:
+                    stats["skipped"] += 1
+                    continue
+                return item_id, question
+            return None
+
+        def report(final:bool=False):
+            elapsed = time.monotonic() - start
+            finished = stats["answered"] + stats["failed"]
+            rate = finished / elapsed if elapsed > 0 else 0.0
+            message = f"{finished} done ({stats['failed']} failed, {stats['skipped']} skipped), {rate:.2f}/s"
+            if total is not None and not final:
+                remaining = total - finished - stats["skipped"]
+                eta = remaining / rate if rate > 0 else float("inf")
+                message += f", {remaining} left, ETA {eta / 60:.1f} min"
+            logger.info(message)
+
+        with self._open_checkpoint() as f:
+            def write(row:dict):
+                f.write((json.dumps(row, default=str) + "\n").encode("utf-8"))
+                f.flush()
+
+            async def worker(model):
+                nonlocal last_report
+                while True:
+                    item = next_item()
+                    if item is None:
+                        return
+                    item_id, question = item
+                    started = time.monotonic()
+                    try:
+                        p_ans, ans, meta, _ = await model.arun_once(question, max_tokens=self.max_tokens)
+                    except Exception as e:
+                        logger.warning(f"{item_id} failed: {type(e).__name__}: {e}")
+                        stats["failed"] += 1
+                        write({"id": item_id, "error": f"{type(e).__name__}: {e}"})
+                    else:
+                        stats["answered"] += 1
+                        write({"id": item_id,
+                               "answer": str(p_ans),
+                               "response": ans["content"] if isinstance(ans, dict) else ans,
+                               "model": type(model).__name__ + (f"({model.model})" if hasattr(model, "model") else ""),
+                               "metadata": meta,
+                               "seconds": time.monotonic() - started})
+                    if time.monotonic() - last_report >= self.report_interval:
+                        last_report = time.monotonic()
+                        report()
+
+            await asyncio.gather(*[worker(model) for model in self.models for _ in range(self.concurrency)])
+
+        report(final=True)
+        stats["seconds"] = time.monotonic() - start
+        return stats
+
+    def run(self, items:Iterable[Tuple[str, Question]], total:Union[int, None]=None) -> dict:
+        """ Same as `arun`, from synchronous code.
+        """
+        return asyncio.run(self.arun(items, total=total))
+
+
+def load_task(name:str) -> TaskSpec:
+    """ Imports a TaskSpec (or a function returning one) named "module:attribute".
+    """
+    module, _, attribute = name.partition(":")
+    task = getattr(importlib.import_module(module), attribute)
+    return task if isinstance(task, TaskSpec) else task()
+
+
+def main(argv:Union[List[str], None]=None):
+    from .agent import make_model
+    from .keychain import KeyChain
+
+    parser = argparse.ArgumentParser(description="Runs a TaskSpec over a dataset, with checkpointing.")
+    parser.add_argument("task", help="module:attribute of a TaskSpec, or of a function returning one")
+    parser.add_argument("dataset", help="JSONL file, or directory of images and text files")
+    parser.add_argument("checkpoint", help="JSONL file results are appended to; rerun to resume")
+    parser.add_argument("--model", action="append", default=None,
+                        help="vision model, as in Agent. Repeat to spread questions over several models.")
+    parser.add_argument("--keys", default=None, help="JSON file of service -> key(s), for a KeyChain")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent requests per model")
+    parser.add_argument("--max-tokens", type=int, default=1000)
+    parser.add_argument("--report-interval", type=float, default=10.0)
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, os.getcwd()) # so that the task's module can be found
+    task = load_task(args.task)
+    keys = None
+    if args.keys is not None:
+        with open(args.keys, "r") as f:
+            keys = KeyChain(json.load(f))
+    models = [make_model(keys, task, vision_model) for vision_model in (args.model or ["gpt-4o-mini"])]
+
+    runner = DatasetRunner(models, args.checkpoint, concurrency=args.concurrency,
+                           max_tokens=args.max_tokens, report_interval=args.report_interval)
+    stats = runner.run(iter_dataset(args.dataset), total=count_dataset(args.dataset))
+    logger.info(f"finished: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+In-flight request coalescing.
+
+When several agents of a process ask an identical question at the same time
+(the same `task.completed` evaluation, duplicate dataset rows, ...), only the
+first request is sent: the others wait for it, and all of them get its
+response. Requests are identified by the same hash as in the response cache,
+and are only coalesced while one is outstanding; nothing is remembered after
+it returns.
+"""
+
+import asyncio
+import threading
+import functools
+import weakref
+from typing import Callable, Dict, Any, Awaitable
+from .response_cache import request_key
+from .concurrency import LockFreePickleMixin
+
+
+class _Call(object):
+    """ An outstanding blocking call, and what it returned or raised.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(LockFreePickleMixin):
+    """ Shares the result of concurrent calls with the same key.
+
+    Example usage:
+        flights = SingleFlight() # shared by the models of every agent
+        models = [GPTModel(api_key, task, singleflight=flights) for _ in range(100)]
+        ...
+        print(flights.report())
+    """
+    _transient = {"_lock": threading.Lock, "_inflight": dict, "_ainflight": weakref.WeakKeyDictionary}
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._inflight:Dict[str, _Call] = {}
+        # event loop -> key -> task; tasks belong to their loop.
+        self._ainflight = weakref.WeakKeyDictionary()
+
+    def call(self, key:str, func:Callable[[], Any]) -> Any:
+        """ Returns `func()`, or the result of the call of `func` already
+        outstanding for `key`. Errors are raised in every caller.
+        """
+        with self._lock:
+            self.calls += 1
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.done.set()
+        return call.result
+
+    async def acall(self, key:str, func:Callable[[], Awaitable[Any]]) -> Any:
+        """ Same as `call`, for a coroutine function, among the callers on the
+        running event loop. The call is shared: cancelling one caller doesn't
+        cancel it for the others.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self.calls += 1
+            inflight = self._ainflight.setdefault(loop, {})
+            task = inflight.get(key)
+            if task is None:
+                task = inflight[key] = loop.create_task(func())
+                task.add_done_callback(lambda _: inflight.pop(key, None))
+            else:
+                self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def report(self) -> dict:
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.coalesced}
+
+
+def coalesced_ask(backend:str):
+    """ Decorates a model's `ask(payload, n_choices, stream)` so that identical
+    concurrent requests go through the model's `singleflight`, if it has one.
+    """
+    def decorator(ask):
+        @functools.wraps(ask)
+        def wrapper(self, payload:dict, n_choices=1, stream:bool=False):
+            flights = getattr(self, "singleflight", None)
+            if flights is None:
+                return ask(self, payload, n_choices=n_choices, stream=stream)
+            key = request_key(backend, self.model, payload, n_choices, stream)
+            return flights.call(key, lambda: ask(self, payload, n_choices=n_choices, stream=stream))
+        return wrapper
+    return decorator
+
+
+def coalesced_aask(backend:str):
+    """ Same as `coalesced_ask`, for `aask(payload, n_choices)`.
+    """
+    def decorator(aask):
+        @functools.wraps(aask)
+        async def wrapper(self, payload:dict, n_choices=1):
+            flights = getattr(self, "singleflight", None)
+            if flights is None:
+                return await aask(self, payload, n_choices=n_choices)
+            key = request_key(backend, self.model, payload, n_choices)
+            return await flights.acall(key, lambda: aask(self, payload, n_choices=n_choices))
+        return wrapper
+    return decorator
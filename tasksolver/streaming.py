@@ -0,0 +1,51 @@
+"""
+Reading streamed responses.
+
+Backends stream their responses as text deltas. The deltas are fed to the
+answer type's incremental parser, and the stream is closed (cancelling the
+rest of the generation) as soon as the answer is decided.
+"""
+
+from typing import Iterator, List, Tuple, Type
+from .common import ParsedAnswer
+
+
+def read_stream(deltas:Iterator[str], answer_type:Type[ParsedAnswer]) -> Tuple[str, bool]:
+    """ Reads a stream of text deltas until it ends, or until the answer is decided.
+    Returns:
+        the text read, and whether the stream was stopped early
+    """
+    parser = answer_type.incremental_parser()
+    try:
+        for delta in deltas:
+            if parser.feed(delta):
+                return parser.text, True
+    finally:
+        close = getattr(deltas, "close", None)
+        if close is not None:
+            close()
+    return parser.text, False
+
+
+def read_streams(deltas:Iterator[Tuple[int, str]], n:int,
+                 answer_type:Type[ParsedAnswer]) -> List[Tuple[str, bool]]:
+    """ Same as `read_stream`, for a stream of (choice index, delta) carrying `n`
+    choices. The stream is stopped once every choice is decided.
+    Returns:
+        for each choice, the text read and whether it was decided before the stream ended
+    """
+    parsers = [answer_type.incremental_parser() for _ in range(n)]
+    undecided = n
+    try:
+        for idx, delta in deltas:
+            if parsers[idx].decided:
+                continue
+            if parsers[idx].feed(delta):
+                undecided -= 1
+                if undecided == 0:
+                    break
+    finally:
+        close = getattr(deltas, "close", None)
+        if close is not None:
+            close()
+    return [(parser.text, parser.decided) for parser in parsers]
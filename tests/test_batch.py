@@ -0,0 +1,36 @@
+import json
+from tasksolver.common import TaskSpec, Question
+from tasksolver.answer_types import LeftOrRight
+from tasksolver.gpt4v import GPTModel
+from tasksolver.batch import run_batch, LocalBatchProvider
+
+
+def test_empty_batch(tmp_path):
+    provider = LocalBatchProvider(str(tmp_path), respond=lambda body: "")
+    assert run_batch(None, [], provider=provider, poll_interval=0) == []
+    assert list(tmp_path.iterdir()) == [] # nothing was submitted
+
+
+def test_local_round_trip(tmp_path):
+    task = TaskSpec(name="t", description="Pick a side.", answer_type=LeftOrRight,
+                    followup_func=None, completed_func=None)
+    model = GPTModel("key", task, model="gpt-4o-mini")
+    calls = []
+
+    def respond(body):
+        text = json.dumps(body)
+        calls.append("second" in text)
+        if "second" in text and calls.count(True) == 1:
+            return "I can't tell." # not parseable: resubmitted in the next batch
+        return "```right```" if "second" in text else "```left```"
+
+    provider = LocalBatchProvider(str(tmp_path), respond=respond)
+    answers = run_batch(model, [Question(["first"]), Question(["second"])],
+                        provider=provider, poll_interval=0)
+
+    assert [str(p_ans) for p_ans, _, _, _ in answers] == ["left", "right"]
+    assert answers[1][1] == {"role": "assistant", "content": "```right```"}
+    batches = sorted(tmp_path.iterdir())
+    assert len(batches) == 2
+    with open(batches[1] / "requests.jsonl") as f:
+        assert [json.loads(line)["custom_id"] for line in f] == ["item-1"]
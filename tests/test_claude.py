@@ -0,0 +1,71 @@
+import time
+import threading
+from types import SimpleNamespace
+from PIL import Image
+from tasksolver.common import TaskSpec, Question
+from tasksolver.answer_types import TextAnswer
+from tasksolver.claude import ClaudeModel
+from tasksolver.hedging import HedgePolicy
+from tasksolver.keychain import KeyPool
+from tasksolver.payload import LazyImage
+from tasksolver import claude
+
+
+class FakeClient(object):
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.messages = SimpleNamespace(create=self.create)
+
+    def create(self, **request):
+        with self._lock:
+            self.calls += 1
+            first = self.calls == 1
+        if first:
+            time.sleep(self.delay)
+        return SimpleNamespace(dict=lambda: {"role": "assistant", "content": [{"text": "hi"}], "usage": {}})
+
+
+class CountingLimiter(object):
+    def __init__(self):
+        self.acquired = []
+
+    def acquire(self, key, tokens=0):
+        self.acquired.append(key)
+
+
+def make_model(**kwargs):
+    task = TaskSpec(name="t", description="d", answer_type=TextAnswer,
+                    followup_func=None, completed_func=None)
+    return ClaudeModel("key", task, **kwargs)
+
+
+def test_images_are_encoded_once_for_every_choice(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(claude.registry, "get", lambda *args, **kwargs: client)
+    materialized = []
+    materialize = LazyImage.materialize
+    monkeypatch.setattr(LazyImage, "materialize", lambda self: materialized.append(self) or materialize(self))
+
+    model = make_model()
+    payload = model.prepare_payload(Question(["hi", Image.new("RGB", (4, 4))]), image_policy=None)
+    messages, _ = model.ask(payload, n_choices=3)
+    assert len(messages) == 3 and client.calls == 3
+    assert len(materialized) == 1
+
+
+def test_hedged_duplicates_lease_a_key_and_wait_for_the_limiter(monkeypatch):
+    client = FakeClient(delay=0.5)
+    keys = []
+    monkeypatch.setattr(claude.registry, "get", lambda backend, api_key, **kwargs: keys.append(api_key) or client)
+
+    hedging = HedgePolicy(percentile=0.5, max_extra=1.0, min_samples=1)
+    hedging.tracker.record(0.01)
+    limiter = CountingLimiter()
+    model = make_model(hedging=hedging, rate_limiter=limiter)
+    model.claude_key = KeyPool(["a", "b"])
+    model.ask(model.prepare_payload(Question(["hi"])))
+    assert hedging.hedges == 1
+    assert len(limiter.acquired) == 2
+    assert sorted(keys) == ["a", "b"] # the primary request still holds its key
@@ -0,0 +1,69 @@
+from PIL import Image
+from tasksolver.common import TaskSpec, Question
+from tasksolver.answer_types import LeftOrRight
+from tasksolver.ollama import OllamaModel
+from tasksolver.claude import ClaudeModel
+from tasksolver.image_policy import ImagePolicy
+from tasksolver.retry import RetryPolicy
+from tasksolver.exceptions import GPTOutputParseException
+from tasksolver import ollama
+
+
+class FakeClient(object):
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def chat(self, model, messages):
+        self.requests.append(messages[0])
+        return {"message": {"role": "assistant", "content": self.responses.pop(0)}, "eval_count": 3}
+
+
+class CountingLimiter(object):
+    def __init__(self):
+        self.acquired = []
+
+    def acquire(self, key, tokens=0):
+        self.acquired.append(tokens)
+
+
+def make_task():
+    return TaskSpec(name="t", description="d", answer_type=LeftOrRight,
+                    followup_func=None, completed_func=None)
+
+
+def test_options_are_set_by_the_base_class():
+    policy = ImagePolicy(max_long_edge=64)
+    retry_policy = RetryPolicy(max_wait=1)
+    model = OllamaModel(make_task(), "llava", host="http://gpu:11434",
+                        image_policy=policy, retry_policy=retry_policy)
+    assert model.host == "http://gpu:11434"
+    assert model.image_policy is policy and model.retry_policy is retry_policy
+    assert OllamaModel(make_task(), "llava").image_policy is None
+    assert ClaudeModel("key", make_task()).image_policy.key == ImagePolicy.default_for("claude").key
+
+
+def test_shared_rough_guess_retries_and_waits_for_the_limiter(monkeypatch):
+    client = FakeClient(["no idea", "```\nleft\n```"])
+    monkeypatch.setattr(ollama.registry, "get", lambda *args, **kwargs: client)
+    limiter = CountingLimiter()
+    model = OllamaModel(make_task(), "llava", rate_limiter=limiter,
+                        retry_policy=RetryPolicy(base_delay=0.0))
+
+    p_ans, ans, meta, p = model.rough_guess(Question(["Which one?", Image.new("RGB", (4, 4))]))
+    assert str(p_ans) == "left"
+    assert meta[0]["eval_count"] == 3
+    assert len(client.requests) == 2 and len(limiter.acquired) == 2
+    assert isinstance(client.requests[0]["images"][0], bytes)
+
+
+def test_unparseable_answers_are_saved_where_asked(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for model in [OllamaModel(make_task(), "llava"), ClaudeModel("key", make_task())]:
+        try:
+            model.parse("no idea")
+        except GPTOutputParseException:
+            pass
+    # only Claude (and Gemini) keep the unparseable responses.
+    saved = list((tmp_path / "errors").iterdir())
+    assert len(saved) == 1 and saved[0].read_text() == "no idea"
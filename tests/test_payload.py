@@ -0,0 +1,52 @@
+import gc
+from PIL import Image
+from tasksolver.common import Question
+from tasksolver.image_policy import ImagePolicy
+from tasksolver.payload import LazyImage
+from tasksolver import concurrency
+
+
+def test_payload_from_pil_image():
+    image = Image.new("RGB", (4, 4), color=(255, 0, 0))
+    for image_policy in (None, ImagePolicy.default_for("openai")):
+        question = Question(["hi", image])
+        payload = question.get_json(image_policy=image_policy)
+        assert payload[0] == {"type": "text", "text": "hi"}
+        encoded = payload[1]["image_url"]["url"]
+        assert isinstance(encoded, LazyImage)
+        assert len(encoded.read()) > 0
+
+
+def test_object_lock_released_with_object():
+    image = Image.new("RGB", (4, 4))
+    key = id(image)
+    with concurrency.object_lock(image):
+        pass
+    assert key in concurrency._object_locks
+    del image
+    gc.collect()
+    assert key not in concurrency._object_locks
+
+
+def test_image_policy_counts_savings_against_png():
+    image = Image.new("RGB", (64, 64), color=(0, 128, 255))
+    policy = ImagePolicy(max_long_edge=2048)
+    policy.encode_image(image)
+    assert policy.bytes_saved == 0 # same PNG as before
+
+    policy = ImagePolicy(max_long_edge=16, exact_savings=True)
+    data, _ = policy.encode_image(image)
+    assert policy.source_bytes < len(image.tobytes())
+    assert policy.bytes_saved == policy.source_bytes - len(data)
+
+
+def test_image_policy_estimates_savings_without_encoding_twice(monkeypatch):
+    image = Image.new("RGB", (64, 64), color=(0, 128, 255))
+    saves = []
+    save = Image.Image.save
+    monkeypatch.setattr(Image.Image, "save", lambda self, *args, **kwargs: saves.append(self.size) or save(self, *args, **kwargs))
+    policy = ImagePolicy(max_long_edge=16)
+    data, _ = policy.encode_image(image)
+    assert saves == [(16, 16)]
+    assert policy.source_bytes == 64 * 64 * 3
+    assert policy.bytes_saved == policy.source_bytes - len(data)
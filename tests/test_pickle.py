@@ -0,0 +1,26 @@
+import pickle
+from tasksolver.common import TaskSpec
+from tasksolver.answer_types import YesNo
+from tasksolver.gpt4v import GPTModel
+from tasksolver.hedging import HedgePolicy
+from tasksolver.keychain import KeyPool
+from tasksolver.ratelimit import RateLimiter
+from tasksolver.response_cache import ResponseCache
+from tasksolver.singleflight import SingleFlight
+
+
+def test_model_with_shared_state_pickles(tmp_path):
+    task = TaskSpec(name="t", description="d", answer_type=YesNo,
+                    followup_func=None, completed_func=None)
+    model = GPTModel(KeyPool(["a", "b"]), task,
+                     hedging=HedgePolicy(),
+                     rate_limiter=RateLimiter(rpm=10),
+                     response_cache=ResponseCache(str(tmp_path / "cache.sqlite")),
+                     singleflight=SingleFlight())
+    model.singleflight.calls = 3
+    copy = pickle.loads(pickle.dumps(model))
+    assert copy.singleflight.report() == {"calls": 3, "coalesced": 0}
+    with copy.open_ai_key.lease() as key:
+        assert key in ("a", "b")
+    copy.rate_limiter.acquire("bucket")
+    assert copy.hedging.report()["requests"] == 0
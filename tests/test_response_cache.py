@@ -0,0 +1,43 @@
+from tasksolver.common import TaskSpec
+from tasksolver.answer_types import YesNoWhy
+from tasksolver.response_cache import ResponseCache, cached_ask
+from tasksolver.retry import RetryPolicy
+
+GOOD = "[#reason] because [#finalanswer] yes"
+
+
+class FakeModel(object):
+    def __init__(self, task, responses, response_cache):
+        self.task = task
+        self.model = "fake"
+        self.responses = list(responses)
+        self.calls = 0
+        self.response_cache = response_cache
+
+    @cached_ask("fake")
+    def ask(self, payload, n_choices=1, stream=False):
+        self.calls += 1
+        return [{"role": "assistant", "content": self.responses.pop(0)}], {}
+
+    def rough_guess(self, payload):
+        def attempt():
+            response, _ = self.ask(payload)
+            return self.task.answer_type.parser(response[0]["content"])
+        return RetryPolicy().call(attempt, max_parse_retries=3)
+
+
+def make_task():
+    return TaskSpec(name="t", description="d", answer_type=YesNoWhy,
+                    followup_func=None, completed_func=None)
+
+
+def test_unparseable_responses_are_not_cached(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+    model = FakeModel(make_task(), ["not an answer", GOOD], cache)
+    model.rough_guess({"messages": "q"})
+    assert model.calls == 2
+
+    # the parseable response was stored, and is replayed.
+    replay = FakeModel(make_task(), [], ResponseCache(str(tmp_path / "cache.sqlite"), replay=True))
+    replay.rough_guess({"messages": "q"})
+    assert replay.calls == 0
@@ -0,0 +1,68 @@
+from tasksolver.common import TaskSpec, Question
+from tasksolver.answer_types import LeftOrRight
+from tasksolver.router import ModelRouter, CLOSED
+from tasksolver.retry import RetryPolicy
+from tasksolver.exceptions import GPTOutputParseException, GPTMaxTriesExceededException
+
+
+class FakeModel(object):
+    def __init__(self, task, answer=None, error=None):
+        self.task = task
+        self.model = "fake"
+        self.answer = answer
+        self.error = error
+        self.calls = []
+
+    def rough_guess(self, question, **kwargs):
+        self.calls.append(kwargs)
+        if self.error is not None:
+            raise self.error
+        return self.answer
+
+
+def make_task():
+    return TaskSpec(name="t", description="d", answer_type=LeftOrRight,
+                    followup_func=None, completed_func=None)
+
+
+def test_unparseable_answers_fail_over_without_opening_the_circuit():
+    task = make_task()
+    unparseable = FakeModel(task, error=GPTMaxTriesExceededException())
+    router = ModelRouter([unparseable, FakeModel(task, answer="left")], min_calls=2)
+    for _ in range(5):
+        assert router.rough_guess(Question(["Which one?"])) == "left"
+    assert len(unparseable.calls) == 5
+    assert router.breakers[0].state == CLOSED and router.breakers[0].error_rate() == 0.0
+
+    failing = FakeModel(task, error=ConnectionError("down"))
+    router = ModelRouter([failing, FakeModel(task, answer="left")], min_calls=2)
+    for _ in range(5):
+        router.rough_guess(Question(["Which one?"]))
+    assert len(failing.calls) == 2 # out of rotation once its circuit opened
+
+
+def test_retry_wait_is_bounded_behind_the_router():
+    task = make_task()
+    model = FakeModel(task, answer="left")
+    ModelRouter([model], max_wait=2.0).rough_guess(Question(["Which one?"]))
+    ModelRouter([model], max_wait=2.0).rough_guess(Question(["Which one?"]), max_wait=0.0)
+    assert [call["max_wait"] for call in model.calls] == [2.0, 0.0]
+
+    calls = []
+    def attempt():
+        calls.append(None)
+        raise ConnectionError("down")
+    policy = RetryPolicy(base_delay=60.0, max_delay=60.0)
+    try:
+        policy.call(attempt, max_wait=0.0)
+    except ConnectionError:
+        pass
+    assert len(calls) == 1 # the first backoff is already over the budget
+
+    def unparseable():
+        raise GPTOutputParseException("no answer")
+    try:
+        policy.call(unparseable, max_parse_retries=1, max_wait=0.0)
+        assert False
+    except GPTMaxTriesExceededException:
+        pass
@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+from tasksolver.common import TaskSpec
+from tasksolver.answer_types import LeftOrRight, PythonExecutableAnswer, YesNoWhy
+from tasksolver.gpt4v import GPTModel
+from tasksolver.streaming import read_stream
+
+# (answer type, well-formed response, its decided prefix)
+RESPONSES = [
+    (PythonExecutableAnswer,
+     "We set x.\n```python\nx = 1\n```\nThis sets x to 1, as asked.",
+     "We set x.\n```python\nx = 1\n```"),
+    (LeftOrRight,
+     "The right one follows the prompt.\n```\nright\n```\nThe left one is more realistic.",
+     "The right one follows the prompt.\n```\nright\n```"),
+    (YesNoWhy,
+     "[#reason]\nthe cube is red.\n[#finalanswer]\nyes.\n\n",
+     "[#reason]\nthe cube is red.\n[#finalanswer]\nyes."),
+]
+
+
+def chunks(text, size=3):
+    return (text[idx:idx + size] for idx in range(0, len(text), size))
+
+
+def test_stops_at_decided_prefix():
+    for answer_type, response, prefix in RESPONSES:
+        text, stopped_early = read_stream(chunks(response), answer_type)
+        assert stopped_early
+        assert text == prefix
+        assert str(answer_type.parser(text)) == str(answer_type.parser(response))
+
+
+def test_undecided_answers_are_read_to_the_end():
+    response = "```\nmaybe\n```\nActually:\n```\nleft\n```"
+    text, stopped_early = read_stream(chunks(response), LeftOrRight)
+    assert not stopped_early
+    assert text == response
+
+
+def test_streamed_metadata_keeps_usage():
+    usage = SimpleNamespace(dict=lambda: {"prompt_tokens": 10, "completion_tokens": 5,
+                                          "prompt_tokens_details": {"cached_tokens": 4}})
+    stream = [SimpleNamespace(usage=None, choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content="```\nleft"))]),
+              SimpleNamespace(usage=None, choices=[SimpleNamespace(index=0, delta=SimpleNamespace(content="\n```"))]),
+              SimpleNamespace(usage=usage, choices=[])]
+
+    class Response(object):
+        def __iter__(self):
+            return iter(stream)
+        def close(self):
+            pass
+
+    requests = []
+    def create(**kwargs):
+        requests.append(kwargs)
+        return Response()
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    task = TaskSpec(name="t", description="d", answer_type=LeftOrRight,
+                    followup_func=None, completed_func=None)
+    model = GPTModel("key", task)
+    # the answer is decided with the second chunk; usage comes in the third.
+    messages, metadata = model.ask_stream(client, {"messages": [], "max_tokens": 10})
+    assert messages[0]["content"] == "```\nleft\n```"
+    assert requests[0]["stream_options"] == {"include_usage": True}
+    assert metadata["stopped_early"] == [True]
+    assert "prompt_tokens" not in metadata
+
+    stream[1].choices[0].delta.content = "\n"
+    messages, metadata = model.ask_stream(client, {"messages": [], "max_tokens": 10})
+    assert metadata["stopped_early"] == [False]
+    assert metadata["prompt_tokens"] == 10 and metadata["cached_tokens"] == 4
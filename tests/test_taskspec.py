@@ -0,0 +1,36 @@
+from tasksolver.common import TaskSpec, Question
+from tasksolver.answer_types import YesNo
+
+
+def make_task():
+    return TaskSpec(name="t", description="Say yes.", answer_type=YesNo,
+                    followup_func=None, completed_func=None)
+
+
+def texts(question):
+    return [el["text"] for el in question.get_json() if el["type"] == "text"]
+
+
+def test_prefix_follows_description_changes():
+    task = make_task()
+    assert "Say yes." in texts(task.first_question(Question(["q"])))
+    task.description = "Say no."
+    first = texts(task.first_question(Question(["q"])))
+    assert "Say no." in first and "Say yes." not in first
+
+
+def test_prefix_follows_example_changes():
+    task = make_task()
+    example = Question(["first example"])
+    task.add_example(example, YesNo("yes"))
+    task.first_question(Question(["q"]))
+
+    example.append_question(Question(["more"]))
+    assert "more" in texts(task.first_question(Question(["q"])))
+    task.examples.append({"question": Question(["second example"]), "answer": YesNo("no"), "explanation": None})
+    assert "second example" in texts(task.first_question(Question(["q"])))
+
+
+def test_prefix_is_compiled_once():
+    task = make_task()
+    assert task.prefix_question() is task.prefix_question()